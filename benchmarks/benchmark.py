@@ -0,0 +1,460 @@
+"""
+Benchmarks for the generation and ingestion hot paths.
+
+Every case runs in a fresh process and reports its (best) wall time, throughput
+(notes or beats per second) and peak RSS. Import and CLI startup times are
+measured in new interpreters. Cases use the bundled
+results/*.mid files and synthetic inputs of increasing size, so no ASAP
+checkout is needed.
+
+Usage (from the repository root):
+    python -m benchmarks.benchmark                  # compare with the baseline
+    python -m benchmarks.benchmark --save_baseline  # store a new baseline
+"""
+import argparse
+import atexit
+import json
+import multiprocessing
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from src.data import ROOT_PATH
+from src.instrumentation import get_peak_rss
+
+BASELINE_PATH = ROOT_PATH / "benchmarks" / "baseline.json"
+RESULTS_PATH = ROOT_PATH / "results"
+
+SIZES = [1_000, 10_000, 100_000]
+BEAT_SIZES = [10, 100, 1000]  # number of pieces for beat-level estimators
+
+# fast cases are repeated until they ran for MIN_TOTAL_TIME seconds
+MIN_TOTAL_TIME = 0.5
+MAX_REPEATS = 50
+
+
+def synthetic_notes(n_notes, seed=0):
+    """Random two-hand note array with about 8 notes per second"""
+    from src.note_array import NOTE_DTYPE
+
+    rng = np.random.default_rng(seed)
+    notes = np.zeros(n_notes, dtype=NOTE_DTYPE)
+    notes["start"] = np.sort(rng.uniform(0, n_notes / 8, n_notes))
+    notes["end"] = notes["start"] + rng.uniform(0.05, 1.0, n_notes)
+    notes["instrument"] = rng.integers(0, 2, n_notes)
+    notes["pitch"] = np.where(
+        notes["instrument"] == 0,
+        rng.integers(60, 90, n_notes),
+        rng.integers(30, 60, n_notes),
+    )
+    notes["velocity"] = rng.integers(20, 100, n_notes)
+    return notes
+
+
+def synthetic_performance(notes, seed=1):
+    """Slower, jittered copy of a note array, with a few notes dropped"""
+    rng = np.random.default_rng(seed)
+    performance = notes[rng.random(len(notes)) > 0.03].copy()
+    jitter = rng.normal(0, 0.02, len(performance))
+    performance["start"] = performance["start"] * 1.2 + jitter
+    performance["end"] = performance["end"] * 1.2 + jitter
+    performance["velocity"] = np.clip(
+        performance["velocity"] + rng.normal(0, 10, len(performance)), 1, 127
+    )
+    return performance
+
+
+def synthetic_beats(n_pieces, n_beats=400, seed=0):
+    """beats_list_dict-shaped data for 4/4 pieces at 120 bpm"""
+    rng = np.random.default_rng(seed)
+    keys = [
+        "bpm_list",
+        "midi_beats_list",
+        "midi_downbeats_list",
+        "performance_beats_list",
+        "performance_downbeats_list",
+        "velocity_beats_list",
+        "perf_velocity_beats_list",
+        "midi_beat_positions_list",
+    ]
+    beats_list_dict = {key: [] for key in keys}
+    for _ in range(n_pieces):
+        midi_beats = 0.5 * np.arange(n_beats)
+        performance_beats = np.cumsum(rng.uniform(0.4, 0.7, n_beats))
+        beats_list_dict["bpm_list"].append(120.0)
+        beats_list_dict["midi_beats_list"].append(midi_beats.tolist())
+        beats_list_dict["midi_downbeats_list"].append(midi_beats[::4].tolist())
+        beats_list_dict["performance_beats_list"].append(performance_beats.tolist())
+        beats_list_dict["performance_downbeats_list"].append(
+            performance_beats[::4].tolist()
+        )
+        beats_list_dict["velocity_beats_list"].append(
+            rng.uniform(30, 80, n_beats).tolist()
+        )
+        beats_list_dict["perf_velocity_beats_list"].append(
+            rng.uniform(30, 80, n_beats).tolist()
+        )
+        beats_list_dict["midi_beat_positions_list"].append(
+            (np.arange(n_beats) % 4).astype(np.int16)
+        )
+    return beats_list_dict
+
+
+def write_synthetic_corpus(path, n_pieces, n_beats=200):
+    """MIDI score/performance pairs with their metadata and annotations"""
+    import pandas as pd
+    import pretty_midi
+
+    rows = []
+    json_data = {}
+    for i in range(n_pieces):
+        notes = synthetic_notes(n_beats * 4, seed=i)
+        for name, piece_notes in [
+            ("midi_score.mid", notes),
+            ("performance.mid", synthetic_performance(notes, seed=i)),
+        ]:
+            midi_data = pretty_midi.PrettyMIDI()
+            midi_data.instruments = [
+                pretty_midi.Instrument(0),
+                pretty_midi.Instrument(0),
+            ]
+            for note in piece_notes:
+                midi_data.instruments[note["instrument"]].notes.append(
+                    pretty_midi.Note(
+                        int(note["velocity"]),
+                        int(note["pitch"]),
+                        float(note["start"]),
+                        float(note["end"]),
+                    )
+                )
+            (path / str(i)).mkdir(parents=True, exist_ok=True)
+            midi_data.write(str(path / str(i) / name))
+
+        beats = 0.5 * np.arange(n_beats)
+        performance_path = str(path / str(i) / "performance.mid")
+        rows.append(
+            {
+                "composer": "Synthetic",
+                "midi_score": str(path / str(i) / "midi_score.mid"),
+                "midi_performance": performance_path,
+            }
+        )
+        json_data[performance_path] = {
+            "midi_score_beats": beats.tolist(),
+            "midi_score_downbeats": beats[::4].tolist(),
+            "midi_score_time_signatures": {"0.0": ["4/4", 4]},
+            "performance_beats": (beats * 1.2).tolist(),
+        }
+    return pd.DataFrame(rows), json_data
+
+
+# Benchmark cases: take a size, prepare the inputs and return
+# (function to time, number of items it processes, unit)
+
+
+def bench_load_notes(size):
+    from src.note_array import load_notes
+
+    midi_paths = sorted(RESULTS_PATH.glob("*.mid"))
+
+    def run():
+        return sum(len(load_notes(path, cache_path=None)) for path in midi_paths)
+
+    return run, run(), "notes"
+
+
+def bench_align_notes(size):
+    from src.alignment import align_notes
+
+    notes = synthetic_notes(size)
+    performance = synthetic_performance(notes)
+    beats = 0.5 * np.arange(int(notes["start"].max() / 0.5) + 2)
+    return lambda: align_notes(notes, performance, beats, beats * 1.2), size, "notes"
+
+
+def bench_align_bundled(size):
+    from src.alignment import align_notes
+    from src.note_array import load_notes
+
+    notes = load_notes(RESULTS_PATH / "original_midi.mid", cache_path=None)
+    performance = load_notes(RESULTS_PATH / "generated_midi.mid", cache_path=None)
+    return lambda: align_notes(notes, performance), len(notes), "notes"
+
+
+def bench_humanize_notes(size):
+    from src.interpret import humanize_notes
+
+    notes = synthetic_notes(size)
+
+    def run():
+        humanize_notes(notes, onset_percentage=1, duration_percentage=5, seed=0)
+
+    return run, size, "notes"
+
+
+def bench_pedal(size):
+    from src.interpret import get_pedal_changes
+
+    left_hand = synthetic_notes(size)
+    left_hand = left_hand[left_hand["instrument"] == 1]
+
+    def run():
+        for mode in ["onset", "bass", "harmony"]:
+            get_pedal_changes(left_hand, mode)
+
+    return run, len(left_hand), "notes"
+
+
+def bench_velocity_profile(size):
+    from src.velocity_profiles import apply_velocity_profile, learn_velocity_profile
+
+    notes = synthetic_notes(size)
+    # 4/4 at 120 bpm
+    beats = np.arange(0, notes["end"].max() + 0.5, 0.5)
+    downbeats = beats[::4]
+    rng = np.random.default_rng(1)
+    performances = []
+    for _ in range(4):
+        performance = notes.copy()
+        performance["velocity"] += rng.integers(-10, 10, size, dtype=np.int16)
+        performances.append(performance)
+    matches = np.stack([np.arange(size), np.arange(size)], axis=1)
+
+    def run():
+        profile = learn_velocity_profile(
+            notes, performances, [matches] * 4, beats, downbeats
+        )
+        apply_velocity_profile(notes, profile, beats, downbeats)
+
+    return run, size, "notes"
+
+
+def bench_interpret(size):
+    from src.interpret import interpret
+    from src.note_array import load_notes
+    from src.synthetic import write_synthetic_piece
+
+    # a piece of size measures with its MusicXML score, see src/synthetic.py
+    tmp_path = Path(tempfile.mkdtemp())
+    atexit.register(shutil.rmtree, tmp_path)
+    rows, _ = write_synthetic_piece(tmp_path, "Synthetic", "Piece", 2, size, [0])
+    piece_path = tmp_path / rows[0]["folder"]
+
+    def run():
+        with tempfile.TemporaryDirectory() as save_path:
+            interpret(
+                str(piece_path / "midi_score.mid"),
+                str(piece_path / "xml_score.musicxml"),
+                [str(tmp_path / row["midi_performance"]) for row in rows],
+                seed=0,
+                cache_path=None,
+                save_path=save_path,
+            )
+
+    n_notes = len(load_notes(piece_path / "midi_score.mid", cache_path=None))
+    return run, n_notes, "notes"
+
+
+def bench_create_midi_performance_pairs(size):
+    from src.data import create_midi_performance_pairs
+
+    tmp_path = Path(tempfile.mkdtemp())
+    atexit.register(shutil.rmtree, tmp_path)
+    df, json_data = write_synthetic_corpus(tmp_path, size)
+    n_beats = sum(len(piece["midi_score_beats"]) for piece in json_data.values())
+
+    def run():
+        create_midi_performance_pairs(
+            df, json_data, "4/4", exclude_path=None, save_path=tmp_path
+        )
+
+    return run, n_beats, "beats"
+
+
+def bench_estimator_fit(size):
+    from src.estimators import Estimator
+
+    beats_list_dict = synthetic_beats(size)
+
+    def run():
+        for data_type in ["time", "velocity"]:
+            Estimator(estimator_type="random", data_type=data_type).fit(
+                **beats_list_dict
+            )
+
+    n_beats = sum(len(beats) for beats in beats_list_dict["midi_beats_list"])
+    return run, n_beats, "beats"
+
+
+def bench_average_over_subcorpus(size):
+    from src.plots import average_over_subcorpus
+
+    beats_list_dict = synthetic_beats(size)
+
+    def run():
+        average_over_subcorpus(
+            beats_list_dict["midi_beats_list"],
+            beats_list_dict["midi_beats_list"],
+            beats_list_dict["performance_beats_list"],
+            {"random": beats_list_dict["perf_velocity_beats_list"]},
+            "time",
+        )
+
+    n_beats = sum(len(beats) for beats in beats_list_dict["midi_beats_list"])
+    return run, n_beats, "beats"
+
+
+def bench_import(module):
+    # in a new interpreter, so that the module is not already imported
+    cmd = [sys.executable, "-c", f"import {module}"]
+    return lambda: subprocess.run(cmd, check=True, cwd=ROOT_PATH), 1, "imports"
+
+
+def bench_cli_help(size):
+    # startup of the CLI up to argument parsing
+    cmd = [sys.executable, str(ROOT_PATH / "run_transfer.py"), "--help"]
+
+    def run():
+        subprocess.run(cmd, check=True, cwd=ROOT_PATH, stdout=subprocess.DEVNULL)
+
+    return run, 1, "runs"
+
+
+# name -> (function, sizes or other case arguments), None for the bundled files
+BENCHMARKS = {
+    "import": (
+        bench_import,
+        ["run_transfer", "src.data", "src.estimators", "src.plots", "src.interpret"],
+    ),
+    "cli_help": (bench_cli_help, [None]),
+    "load_notes[bundled]": (bench_load_notes, [None]),
+    "align_notes[bundled]": (bench_align_bundled, [None]),
+    "align_notes": (bench_align_notes, SIZES),
+    "humanize_notes": (bench_humanize_notes, SIZES),
+    "pedal": (bench_pedal, SIZES),
+    "velocity_profile": (bench_velocity_profile, SIZES),
+    "interpret[synthetic]": (bench_interpret, [16, 64]),
+    "create_midi_performance_pairs": (bench_create_midi_performance_pairs, [1, 4]),
+    "estimator_fit": (bench_estimator_fit, BEAT_SIZES),
+    "average_over_subcorpus": (bench_average_over_subcorpus, BEAT_SIZES),
+}
+
+
+def _run_case(name, size, connection):
+    function, _ = BENCHMARKS[name]
+    run, n_items, unit = function(size)  # imports and inputs are not timed
+    # repeat fast cases and keep the best time to reduce noise
+    wall_time = float("inf")
+    total_time = 0
+    for _ in range(MAX_REPEATS):
+        start = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+        wall_time = min(wall_time, elapsed)
+        total_time += elapsed
+        if total_time > MIN_TOTAL_TIME:
+            break
+    connection.send((wall_time, n_items, unit, get_peak_rss()))
+    connection.close()
+
+
+def run_case(name, size):
+    """Run one benchmark case in a fresh process"""
+    context = multiprocessing.get_context("spawn")
+    parent_connection, child_connection = context.Pipe(duplex=False)
+    process = context.Process(target=_run_case, args=(name, size, child_connection))
+    process.start()
+    result = parent_connection.recv()
+    process.join()
+    wall_time, n_items, unit, peak_rss = result
+    return {
+        "wall_time": wall_time,
+        "items": n_items,
+        "unit": unit,
+        "throughput": n_items / wall_time,
+        "peak_rss": peak_rss,
+    }
+
+
+def run_benchmarks(selected=None):
+    results = {}
+    for name, (_, sizes) in BENCHMARKS.items():
+        if selected is not None and not any(s in name for s in selected):
+            continue
+        for size in sizes:
+            case = name if size is None else f"{name}[{size}]"
+            results[case] = run_case(name, size)
+            result = results[case]
+            print(
+                f"{case:45s} {result['wall_time']:9.3f}s "
+                f"{result['throughput']:14,.0f} {result['unit']}/s "
+                f"{result['peak_rss'] / 2**20:9.1f} MB"
+            )
+    return results
+
+
+def compare_with_baseline(results, baseline, tolerance):
+    """Returns the names of the cases slower than tolerance times the baseline"""
+    regressions = []
+    print("\nComparison with baseline (throughput ratio, > 1 is faster):")
+    for case, result in results.items():
+        if case not in baseline:
+            print(f"{case:45s} {'new':>9s}")
+            continue
+        ratio = result["throughput"] / baseline[case]["throughput"]
+        flag = ""
+        if ratio * tolerance < 1:
+            flag = "REGRESSION"
+            regressions.append(case)
+        print(f"{case:45s} {ratio:9.2f}x {flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Benchmark generation hot paths")
+
+    args.add_argument(
+        "-k",
+        "--select",
+        nargs="*",
+        default=None,
+        type=str,
+        help="Only run benchmarks whose name contains one of these strings",
+    )
+
+    args.add_argument(
+        "--save_baseline",
+        action="store_true",
+        help=f"Store the results as the new baseline in {BASELINE_PATH.name}",
+    )
+
+    args.add_argument(
+        "--tolerance",
+        default=1.5,
+        type=float,
+        help="Slowdown factor above which a case is a regression (default: 1.5)",
+    )
+
+    args = args.parse_args()
+
+    results = run_benchmarks(args.select)
+
+    if args.save_baseline:
+        baseline = {}
+        if BASELINE_PATH.exists():
+            with open(BASELINE_PATH) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(BASELINE_PATH, "w") as f:
+            json.dump(baseline, f, indent=2)
+        print(f"\nBaseline saved to {BASELINE_PATH}")
+    elif BASELINE_PATH.exists():
+        with open(BASELINE_PATH) as f:
+            baseline = json.load(f)
+        if compare_with_baseline(results, baseline, args.tolerance):
+            sys.exit(1)
@@ -1,63 +1,219 @@
 import argparse
-import os
-import shutil
+import glob
+import logging
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
 
-import music21
+from src.audio import copy_if_changed, render_audio
+from src.data import DATASET_PATH, ROOT_PATH, get_piece_paths
+from src.instrumentation import (
+    enable_profiling,
+    get_peak_rss,
+    get_profiler,
+    setup_logging,
+    stage,
+)
 
-from src.data import DATASET_PATH, ROOT_PATH
-from src.interpret import interpret
+logger = logging.getLogger(__name__)
 
+# piece generated when neither -m nor -c is given
+DEFAULT_MIDI_ROOT_PATH = "Schubert/Impromptu_op.90_D.899/3"
 
-def save_midi(original_xml_path, original_midi_path, save_audio):
-    # save midi
-    save_path = ROOT_PATH / "results"
 
-    # write original_midi
-    xml_score: music21.stream.Score = music21.converter.parse(original_xml_path)
-    xml_score.write("midi", str(save_path / "xml_midi.mid"))
-
-    shutil.copy(str(original_midi_path), str(save_path / "original_midi.mid"))
-    # write generated_midi
-    # is is done in interpret itself
+def save_midi(original_midi_path, save_audio, save_path=ROOT_PATH / "results"):
+    """
+    Copy the original MIDI next to the generated ones (xml_midi.mid and the
+    generated MIDI files are written by interpret itself) and render them
+    to WAV files if save_audio. Up-to-date WAV files are not rendered again.
+    """
+    save_path = Path(save_path)
+    copy_if_changed(original_midi_path, save_path / "original_midi.mid")
 
     if save_audio:
-        # create wav from midi
-        filename = str(save_path / "original_midi")
-        cmd = f"fluidsynth -ni font.sf2 {filename}.mid -F {filename}.wav -r 16000 > /dev/null"
-        os.system(cmd)
-
-        filename = str(save_path / "xml_midi")
-        cmd = f"fluidsynth -ni font.sf2 {filename}.mid -F {filename}.wav -r 16000 > /dev/null"
-        os.system(cmd)
-
-        filename = str(save_path / "generated_midi")
-        cmd = f"fluidsynth -ni font.sf2 {filename}.mid -F {filename}.wav -r 16000 > /dev/null"
-        os.system(cmd)
-
-        filename = str(save_path / "generated_midi_with_pedal")
-        cmd = f"fluidsynth -ni font.sf2 {filename}.mid -F {filename}.wav -r 16000 > /dev/null"
-        os.system(cmd)
-
-
-def run_transfer(midi_root_path, save_audio):
-    xml_path = DATASET_PATH / midi_root_path / "xml_score.musicxml"
-    midi_path = DATASET_PATH / midi_root_path / "midi_score.mid"
-
-    performed_midi_paths = []
-    performed_midis = os.listdir(str(DATASET_PATH / midi_root_path))
-    for performed_midi_name in performed_midis:
-        if not performed_midi_name.endswith("mid"):
-            continue
-        if performed_midi_name == "midi_score.mid":
-            continue
-        performed_midi_path = DATASET_PATH / midi_root_path / performed_midi_name
-        performed_midi_paths.append(str(performed_midi_path))
-
-    interpret(str(midi_path), str(xml_path), performed_midi_paths)
-    save_midi(
-        original_xml_path=xml_path,
-        original_midi_path=midi_path,
-        save_audio=save_audio,
+        render_audio(
+            [
+                save_path / "original_midi.mid",
+                save_path / "xml_midi.mid",
+                save_path / "generated_midi.mid",
+                save_path / "generated_midi_with_pedal.mid",
+            ]
+        )
+
+
+def run_transfer(
+    midi_root_path,
+    save_audio,
+    seed=None,
+    pedal_mode="onset",
+    save_path=ROOT_PATH / "results",
+    low_memory=False,
+    profile_amplitude=1.0,
+):
+    # music21 is slow to import, load it only when generating
+    from src.interpret import interpret
+
+    xml_path, midi_path, performed_midi_paths = get_piece_paths(midi_root_path)
+
+    with stage("interpret"):
+        interpret(
+            str(midi_path),
+            str(xml_path),
+            performed_midi_paths,
+            seed=seed,
+            pedal_mode=pedal_mode,
+            profile_amplitude=profile_amplitude,
+            save_path=save_path,
+            return_score=False,
+            low_memory=low_memory,
+        )
+    with stage("save_midi"):
+        save_midi(
+            original_midi_path=midi_path,
+            save_audio=save_audio,
+            save_path=save_path,
+        )
+
+
+def find_pieces(patterns=(), composers=()):
+    """
+    List the ASAP pieces matching glob patterns or composers
+
+    Args:
+        patterns: list of str piece paths relative to DATASET_PATH,
+                  may contain glob wildcards (e.g. "Schubert/Impromptu_op.90_D.899/*")
+        composers: list of str composer names, all their pieces are used
+
+    Returns:
+        pieces: sorted list of str piece paths relative to DATASET_PATH
+    """
+    pieces = set()
+    for pattern in patterns:
+        matches = [
+            Path(path)
+            for path in glob.glob(str(DATASET_PATH / pattern))
+            if (Path(path) / "xml_score.musicxml").exists()
+        ]
+        if not matches:
+            logger.warning("no piece matches %s", pattern)
+        pieces.update(path.relative_to(DATASET_PATH).as_posix() for path in matches)
+    for composer in composers:
+        for path in (DATASET_PATH / composer).glob("**/xml_score.musicxml"):
+            pieces.add(path.parent.relative_to(DATASET_PATH).as_posix())
+    return sorted(pieces)
+
+
+def run_piece(
+    midi_root_path,
+    save_audio,
+    seed,
+    pedal_mode,
+    save_path,
+    profile_name,
+    low_memory,
+    profile_amplitude,
+):
+    """
+    Batch worker: run_transfer on one piece, never raises
+
+    Returns:
+        result: tuple (midi_root_path, wall time, peak RSS of the worker
+                process so far, None or the formatted error)
+    """
+    start = time.perf_counter()
+    try:
+        if profile_name is not None:
+            enable_profiling()
+        run_transfer(
+            midi_root_path,
+            save_audio,
+            seed,
+            pedal_mode,
+            save_path,
+            low_memory,
+            profile_amplitude,
+        )
+        if profile_name is not None:
+            get_profiler().write(Path(save_path) / profile_name)
+        error = None
+    except Exception:
+        error = traceback.format_exc()
+    return midi_root_path, time.perf_counter() - start, get_peak_rss(), error
+
+
+def run_batch(
+    pieces,
+    save_audio,
+    seed=None,
+    pedal_mode="onset",
+    output_path=ROOT_PATH / "results" / "batch",
+    max_workers=None,
+    profile_name=None,
+    low_memory=False,
+    profile_amplitude=1.0,
+):
+    """
+    run_transfer over many pieces in a process pool, the outputs of every
+    piece are written to output_path / <piece path>
+
+    Args:
+        pieces: list of str piece paths relative to DATASET_PATH
+        save_audio, seed, pedal_mode, low_memory, profile_amplitude: see
+            run_transfer
+        output_path: root dir of the per-piece outputs
+        max_workers: size of the process pool (None for the number of CPUs)
+        profile_name: if not None, a profile with this name is written in
+                      every piece output dir
+
+    Returns:
+        results: list of (piece, wall time, peak RSS, error) tuples, in the
+                 order of pieces
+    """
+    output_path = Path(output_path)
+    results = {}
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                run_piece,
+                piece,
+                save_audio,
+                seed,
+                pedal_mode,
+                output_path / piece,
+                profile_name,
+                low_memory,
+                profile_amplitude,
+            )
+            for piece in pieces
+        ]
+        for future in as_completed(futures):
+            piece, wall_time, peak_rss, error = future.result()
+            if error is None:
+                logger.info("%s done in %.1fs", piece, wall_time)
+            else:
+                logger.error("%s failed:\n%s", piece, error)
+            results[piece] = (piece, wall_time, peak_rss, error)
+    return [results[piece] for piece in pieces]
+
+
+def print_batch_summary(results):
+    # workers generate several pieces, their peak RSS is the one of the
+    # process up to the end of the piece
+    width = max(len("piece"), *(len(piece) for piece, _, _, _ in results))
+    print(f"{'piece':<{width}}  {'time [s]':>8}  {'RSS [MB]':>8}  status")
+    for piece, wall_time, peak_rss, error in results:
+        status = "ok" if error is None else error.strip().splitlines()[-1]
+        print(
+            f"{piece:<{width}}  {wall_time:>8.1f}  {peak_rss / 2**20:>8.1f}  {status}"
+        )
+    n_failed = sum(error is not None for _, _, _, error in results)
+    total_time = sum(wall_time for _, wall_time, _, _ in results)
+    max_rss = max(peak_rss for _, _, peak_rss, _ in results)
+    print(
+        f"{len(results) - n_failed}/{len(results)} pieces generated, "
+        f"{n_failed} failed, {total_time:.1f}s of total generation time, "
+        f"peak RSS {max_rss / 2**20:.1f} MB per worker"
     )
 
 
@@ -94,9 +250,36 @@ if __name__ == "__main__":
     args.add_argument(
         "-m",
         "--midi_root_path",
-        default="Schubert/Impromptu_op.90_D.899/3",
+        default=[],
+        nargs="+",
+        type=str,
+        help="Path(s) that will be used for midi_generation, glob patterns are "
+        "accepted; several pieces run in batch mode (default: "
+        f"{DEFAULT_MIDI_ROOT_PATH} if no composer is given)",
+    )
+
+    args.add_argument(
+        "-c",
+        "--composer",
+        default=[],
+        nargs="+",
+        type=str,
+        help="Generate all pieces of these composers in batch mode (default: None)",
+    )
+
+    args.add_argument(
+        "--output_dir",
+        default=str(ROOT_PATH / "results" / "batch"),
         type=str,
-        help="Path that will be used for midi_generation (default: Schubert/Impromptu_op.90_D.899/3)",
+        help="Batch mode: root dir of the per-piece output dirs (default: results/batch)",
+    )
+
+    args.add_argument(
+        "--workers",
+        default=None,
+        type=int,
+        help="Batch and service modes: number of worker processes "
+        "(default: number of CPUs in batch mode, 1 in service mode)",
     )
 
     args.add_argument(
@@ -107,6 +290,114 @@ if __name__ == "__main__":
         help="Whether to convert midi to wav or not (default: False)",
     )
 
+    args.add_argument(
+        "--seed",
+        default=None,
+        type=int,
+        help="Random seed for reproducible generation (default: None)",
+    )
+
+    args.add_argument(
+        "--pedal_mode",
+        default="onset",
+        choices=["onset", "bass", "harmony"],
+        type=str,
+        help="When to re-pedal: every left hand onset, bass or harmony changes (default: onset)",
+    )
+
+    args.add_argument(
+        "--profile_amplitude",
+        default=1.0,
+        type=float,
+        help="Scale of the velocity profile learned from the performances, "
+        "0 to disable it (default: 1.0)",
+    )
+
+    args.add_argument(
+        "--serve",
+        action="store_true",
+        help="Run as a long-running generation service reading JSON-lines "
+        "requests, see src/service.py (default: False)",
+    )
+
+    args.add_argument(
+        "--socket",
+        default=None,
+        type=str,
+        help="Service mode: unix socket to listen on (default: None, use stdin/stdout)",
+    )
+
+    args.add_argument(
+        "--low_memory",
+        action="store_true",
+        help="Do not memoize the music21 score, so that it is released as soon "
+        "as it is rendered, to run many generations side by side (default: False)",
+    )
+
+    args.add_argument(
+        "--log_level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        type=str,
+        help="Logging level (default: INFO)",
+    )
+
+    args.add_argument(
+        "--profile",
+        default=None,
+        type=str,
+        help="Write per-stage wall time, note counts and peak memory to this JSON "
+        "file, in Chrome trace format (default: None, no profiling)",
+    )
+
     args = args.parse_args()
 
-    run_transfer(args.midi_root_path, args.save_audio)
+    setup_logging(args.log_level)
+
+    if args.serve:
+        from src.service import serve
+
+        serve(socket_path=args.socket, max_workers=args.workers or 1)
+        raise SystemExit(0)
+
+    if not args.midi_root_path and not args.composer:
+        args.midi_root_path = [DEFAULT_MIDI_ROOT_PATH]
+    batch_mode = (
+        len(args.composer) > 0
+        or len(args.midi_root_path) > 1
+        or any(c in args.midi_root_path[0] for c in "*?[")
+    )
+    if not batch_mode:
+        if args.profile is not None:
+            enable_profiling()
+
+        run_transfer(
+            args.midi_root_path[0],
+            args.save_audio,
+            args.seed,
+            args.pedal_mode,
+            low_memory=args.low_memory,
+            profile_amplitude=args.profile_amplitude,
+        )
+
+        if args.profile is not None:
+            get_profiler().write(args.profile)
+    else:
+        pieces = find_pieces(args.midi_root_path, args.composer)
+        if not pieces:
+            raise SystemExit(f"No pieces found in {DATASET_PATH}")
+        logger.info("generating %d pieces", len(pieces))
+        results = run_batch(
+            pieces,
+            args.save_audio,
+            args.seed,
+            args.pedal_mode,
+            output_path=args.output_dir,
+            max_workers=args.workers,
+            profile_name=None if args.profile is None else Path(args.profile).name,
+            low_memory=args.low_memory,
+            profile_amplitude=args.profile_amplitude,
+        )
+        print_batch_summary(results)
+        if any(error is not None for _, _, _, error in results):
+            raise SystemExit(1)
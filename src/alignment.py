@@ -0,0 +1,306 @@
+import hashlib
+import os
+from pathlib import Path
+
+import numpy as np
+
+from src.data import DATASET_PATH, ROOT_PATH
+from src.note_array import file_signature, load_notes
+
+ALIGNMENT_CACHE_PATH = ROOT_PATH / "data" / "cache" / "alignments"
+
+
+def get_performance_annotation(performance_midi_path, json_data):
+    """
+    Find the ASAP annotation entry of a performance
+
+    Args:
+        performance_midi_path: str or Path to the performed MIDI
+        json_data: dict with annotations (None if not available)
+
+    Returns:
+        annotation: dict with midi_score_beats, performance_beats, etc.
+                    None if the performance is not annotated
+    """
+    if json_data is None:
+        return None
+    try:
+        key = Path(performance_midi_path).resolve().relative_to(DATASET_PATH.resolve())
+    except ValueError:
+        return None
+    return json_data.get(key.as_posix())
+
+
+def warp_onsets(onsets, score_beats, performance_beats):
+    """
+    Map score times to expected performance times using corresponding beats.
+    Times outside the annotated beats are extrapolated linearly.
+    """
+    score_beats = np.asarray(score_beats, dtype=np.float64)
+    performance_beats = np.asarray(performance_beats, dtype=np.float64)
+    warped = np.interp(onsets, score_beats, performance_beats)
+
+    slope_first = (performance_beats[1] - performance_beats[0]) / (
+        score_beats[1] - score_beats[0]
+    )
+    slope_last = (performance_beats[-1] - performance_beats[-2]) / (
+        score_beats[-1] - score_beats[-2]
+    )
+    before = onsets < score_beats[0]
+    after = onsets > score_beats[-1]
+    warped[before] = performance_beats[0] + slope_first * (
+        onsets[before] - score_beats[0]
+    )
+    warped[after] = performance_beats[-1] + slope_last * (
+        onsets[after] - score_beats[-1]
+    )
+    return warped
+
+
+def banded_dtw(
+    expected_onsets, score_pitches, onsets, pitches, band_width, pitch_penalty
+):
+    """
+    DTW between two onset-sorted note sequences, restricted to a band of
+    2 * band_width + 1 performance notes around the expected position
+    of every score note. Runs in O(n * band_width).
+
+    Returns:
+        path: (k, 2) int array of (score index, performance index) cells
+    """
+    n, m = len(expected_onsets), len(onsets)
+    width = 2 * band_width + 1
+
+    centers = np.searchsorted(onsets, expected_onsets)
+    centers = np.maximum.accumulate(centers)  # the band must be monotonic
+    lows = np.clip(centers - band_width, 0, max(m - width, 0))
+    columns = lows[:, None] + np.arange(width)[None, :]
+    valid = columns < m
+    columns = np.minimum(columns, m - 1)
+
+    cost = np.abs(expected_onsets[:, None] - onsets[columns])
+    cost += pitch_penalty * (score_pitches[:, None] != pitches[columns])
+    cost[~valid] = np.inf
+
+    acc = np.full((n, width), np.inf)
+    band = np.arange(width)
+    previous = np.zeros(width)  # open begin: the path may start anywhere in row 0
+    for i in range(n):
+        if i > 0:
+            # vertical and diagonal predecessors, shifted into the current band
+            vertical_index = band + lows[i] - lows[i - 1]
+            diagonal_index = vertical_index - 1
+            vertical = np.where(
+                vertical_index < width,
+                acc[i - 1, np.minimum(vertical_index, width - 1)],
+                np.inf,
+            )
+            diagonal = np.where(
+                (diagonal_index >= 0) & (diagonal_index < width),
+                acc[i - 1, np.clip(diagonal_index, 0, width - 1)],
+                np.inf,
+            )
+            previous = np.minimum(vertical, diagonal)
+            if not np.isfinite(previous).any():
+                previous = np.zeros(width)  # band jump: restart the path here
+        # horizontal moves: acc[j] = min_k (previous[k] + cost[k..j])
+        row_cost = cost[i]
+        finite_cost = np.where(np.isfinite(row_cost), row_cost, 0)
+        cumulative = np.cumsum(finite_cost)
+        shifted = np.concatenate(([0.0], cumulative[:-1]))
+        acc[i] = cumulative + np.minimum.accumulate(previous - shifted)
+        acc[i, ~valid[i]] = np.inf
+
+    # open end: backtrack from the cheapest cell of the last row
+    path = []
+    i, k = n - 1, int(np.argmin(acc[n - 1]))
+    while True:
+        path.append((i, lows[i] + k))
+        if i == 0:
+            break
+        shift = lows[i] - lows[i - 1]
+        candidates = [
+            (acc[i - 1, k + shift - 1] if 0 <= k + shift - 1 < width else np.inf, -1),
+            (acc[i - 1, k + shift] if 0 <= k + shift < width else np.inf, 0),
+            (acc[i, k - 1] if k > 0 else np.inf, 1),
+        ]
+        best, move = min(candidates)
+        if not np.isfinite(best):
+            break
+        if move == -1:
+            i, k = i - 1, k + shift - 1
+        elif move == 0:
+            i, k = i - 1, k + shift
+        else:
+            k -= 1
+    return np.array(path[::-1], dtype=np.int64)
+
+
+def align_notes(
+    score_notes,
+    performance_notes,
+    score_beats=None,
+    performance_beats=None,
+    band_width=16,
+    pitch_penalty=10.0,
+    max_deviation=0.5,
+    chord_radius=4,
+):
+    """
+    Note-level alignment of a score with one of its performances
+
+    Score onsets are first warped into performance time using the ASAP beat
+    annotations (or a global linear map if none are given), then a banded
+    DTW over onset/pitch features pairs the notes.
+
+    Args:
+        score_notes: note array of the unperformed MIDI
+        performance_notes: note array of the performed MIDI
+        score_beats: list of annotated beats in the score (midi_score_beats)
+        performance_beats: list of corresponding performed beats
+        band_width: number of performance notes considered on each side
+                    of the expected position
+        pitch_penalty: DTW cost (in seconds) of pairing different pitches
+        max_deviation: max distance (in seconds) between the warped score
+                       onset and the performed onset of a match
+        chord_radius: number of performance notes around the DTW path
+                      searched for the matching pitch
+
+    Returns:
+        matches: (k, 2) int array of (score note index, performance note index),
+                 one-to-one and with equal pitches
+    """
+    if len(score_notes) == 0 or len(performance_notes) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+
+    score_order = np.lexsort((score_notes["pitch"], score_notes["start"]))
+    performance_order = np.lexsort(
+        (performance_notes["pitch"], performance_notes["start"])
+    )
+    score_onsets = score_notes["start"][score_order]
+    score_pitches = score_notes["pitch"][score_order]
+    onsets = performance_notes["start"][performance_order]
+    pitches = performance_notes["pitch"][performance_order]
+
+    if score_beats is not None and len(score_beats) > 1:
+        expected_onsets = warp_onsets(score_onsets, score_beats, performance_beats)
+    else:
+        score_span = max(score_onsets[-1] - score_onsets[0], 1e-6)
+        scale = (onsets[-1] - onsets[0]) / score_span
+        expected_onsets = onsets[0] + (score_onsets - score_onsets[0]) * scale
+
+    path = banded_dtw(
+        expected_onsets, score_pitches, onsets, pitches, band_width, pitch_penalty
+    )
+    # the path pairs score and performance regions, chord notes may come in a
+    # different order: look for the pitch in the neighbourhood of the path
+    path_low = np.full(len(score_onsets), len(onsets))
+    path_high = np.full(len(score_onsets), -1)
+    np.minimum.at(path_low, path[:, 0], path[:, 1])
+    np.maximum.at(path_high, path[:, 0], path[:, 1])
+    on_path = path_high >= 0
+    path_low = np.where(on_path, path_low - chord_radius, 0)
+    path_high = np.where(on_path, path_high + chord_radius, -1)
+
+    width = int((path_high - path_low).max()) + 1
+    columns = path_low[:, None] + np.arange(width)[None, :]
+    inside = (columns >= 0) & (columns < len(onsets)) & (columns <= path_high[:, None])
+    columns = np.clip(columns, 0, len(onsets) - 1)
+    deviation = np.abs(expected_onsets[:, None] - onsets[columns])
+    deviation[~inside | (pitches[columns] != score_pitches[:, None])] = np.inf
+
+    best = np.argmin(deviation, axis=1)
+    score_index = np.arange(len(score_onsets))
+    deviation = deviation[score_index, best]
+    keep = deviation <= max_deviation
+    score_index = score_index[keep]
+    performance_index = columns[score_index, best[keep]]
+    deviation = deviation[keep]
+
+    # make the matching one-to-one, keeping the closest pairs
+    order = np.argsort(deviation, kind="stable")
+    score_index, performance_index = score_index[order], performance_index[order]
+    _, first = np.unique(performance_index, return_index=True)
+    first = np.sort(first)
+    score_index, performance_index = score_index[first], performance_index[first]
+
+    matches = np.stack(
+        [score_order[score_index], performance_order[performance_index]], axis=1
+    )
+    return matches[np.argsort(matches[:, 0])]
+
+
+def annotation_signature(annotation):
+    """Hash of the beats of an ASAP annotation used by align_notes, "None" if None"""
+    if annotation is None:
+        return "None"
+    signature = hashlib.sha1()
+    for name in ["midi_score_beats", "performance_beats"]:
+        signature.update(np.asarray(annotation[name], dtype=np.float64).tobytes())
+        signature.update(b"|")
+    return signature.hexdigest()
+
+
+def get_alignment(
+    score_midi_path,
+    performance_midi_path,
+    score_notes=None,
+    performance_notes=None,
+    annotation=None,
+    cache_path=ALIGNMENT_CACHE_PATH,
+    **align_kwargs,
+):
+    """
+    Cached version of align_notes for a pair of MIDI files.
+    The cache is keyed by both files (path, size, mtime), the annotated beats
+    and the alignment parameters, so it is invalidated whenever one of them
+    changes.
+
+    Args:
+        score_midi_path: str path to the unperformed MIDI
+        performance_midi_path: str path to the performed MIDI
+        score_notes: note array of the unperformed MIDI (loaded if None)
+        performance_notes: note array of the performed MIDI (loaded if None)
+        annotation: ASAP annotation of the performance (or None)
+        cache_path: directory for cached alignments (None to disable)
+        align_kwargs: extra arguments for align_notes
+
+    Returns:
+        matches: (k, 2) int array, see align_notes
+    """
+    cache_file = None
+    if cache_path is not None:
+        key = "|".join(
+            [
+                file_signature(score_midi_path),
+                file_signature(performance_midi_path),
+                annotation_signature(annotation),
+                str(sorted(align_kwargs.items())),
+            ]
+        )
+        cache_file = Path(cache_path) / (
+            hashlib.sha1(key.encode()).hexdigest() + ".npy"
+        )
+        if cache_file.exists():
+            return np.load(cache_file)
+
+    if score_notes is None:
+        score_notes = load_notes(score_midi_path)
+    if performance_notes is None:
+        performance_notes = load_notes(performance_midi_path)
+
+    score_beats, performance_beats = None, None
+    if annotation is not None:
+        score_beats = annotation["midi_score_beats"]
+        performance_beats = annotation["performance_beats"]
+    matches = align_notes(
+        score_notes, performance_notes, score_beats, performance_beats, **align_kwargs
+    )
+
+    if cache_file is not None:
+        cache_file.parent.mkdir(exist_ok=True, parents=True)
+        # an interrupted run never leaves a partial file
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp.npy")
+        np.save(tmp_file, matches)
+        os.replace(tmp_file, cache_file)
+    return matches
@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import os
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from src.data import ROOT_PATH
+from src.note_array import file_signature
+
+logger = logging.getLogger(__name__)
+
+SOUNDFONT_PATH = ROOT_PATH / "font.sf2"
+SAMPLE_RATE = 16000
+
+
+def content_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def copy_if_changed(source_path, target_path):
+    """
+    Copy a file unless the target already has the same content, so that the
+    target keeps its modification time (and its renders stay up to date)
+
+    Returns:
+        copied: bool
+    """
+    target_path = Path(target_path)
+    if target_path.exists() and content_hash(source_path) == content_hash(target_path):
+        return False
+    tmp_path = target_path.with_suffix(f".{os.getpid()}.tmp")
+    with open(source_path, "rb") as source, open(tmp_path, "wb") as target:
+        target.write(source.read())
+    os.replace(tmp_path, target_path)
+    return True
+
+
+def get_render_stamp(midi_path, soundfont_path, sample_rate):
+    """Identifies a render by the MIDI content, the soundfont and the sample rate"""
+    return f"{content_hash(midi_path)}:{file_signature(soundfont_path)}:{sample_rate}"
+
+
+def is_up_to_date(midi_path, wav_path, stamp):
+    """
+    A WAV is up to date if it is newer than its MIDI or if the MIDI content
+    did not change since the render (MIDI files are rewritten on every run)
+    """
+    wav_path = Path(wav_path)
+    stamp_path = wav_path.with_suffix(".wav.stamp")
+    if not wav_path.exists():
+        return False
+    if stamp_path.exists() and stamp_path.read_text() == stamp:
+        return True
+    return not stamp_path.exists() and (
+        os.stat(wav_path).st_mtime_ns >= os.stat(midi_path).st_mtime_ns
+    )
+
+
+def render_wav(midi_path, wav_path, soundfont_path, sample_rate, stamp):
+    """
+    Render a MIDI file with fluidsynth. The WAV is written to a temporary
+    file first, so an interrupted render is never taken for an up-to-date one.
+    """
+    wav_path = Path(wav_path)
+    tmp_path = wav_path.with_suffix(f".{os.getpid()}.tmp.wav")
+    cmd = [
+        "fluidsynth",
+        "-ni",
+        str(soundfont_path),
+        str(midi_path),
+        "-F",
+        str(tmp_path),
+        "-r",
+        str(sample_rate),
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0 or not tmp_path.exists():
+        tmp_path.unlink(missing_ok=True)
+        raise RuntimeError(
+            f"fluidsynth failed on {midi_path} (exit code {result.returncode}): "
+            f"{result.stderr.strip()}"
+        )
+    os.replace(tmp_path, wav_path)
+    wav_path.with_suffix(".wav.stamp").write_text(stamp)
+
+
+def render_audio(
+    midi_paths,
+    soundfont_path=SOUNDFONT_PATH,
+    sample_rate=SAMPLE_RATE,
+    max_workers=4,
+    force=False,
+):
+    """
+    Render MIDI files to WAV files (next to them) with concurrent fluidsynth
+    processes, skipping the ones that are already up to date
+
+    Args:
+        midi_paths: list of str or Path to MIDI files
+        soundfont_path: path to the .sf2 soundfont
+        sample_rate: int sample rate of the WAV files
+        max_workers: max number of concurrent fluidsynth processes
+        force: re-render even if the WAV files are up to date
+
+    Returns:
+        rendered: list of Path to the WAV files that were (re-)rendered
+    """
+    if not Path(soundfont_path).exists():
+        raise FileNotFoundError(f"Soundfont not found: {soundfont_path}")
+
+    jobs = []
+    for midi_path in midi_paths:
+        wav_path = Path(midi_path).with_suffix(".wav")
+        stamp = get_render_stamp(midi_path, soundfont_path, sample_rate)
+        if not force and is_up_to_date(midi_path, wav_path, stamp):
+            logger.info("%s is up to date", wav_path)
+            continue
+        jobs.append((midi_path, wav_path, stamp))
+
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                render_wav, midi_path, wav_path, soundfont_path, sample_rate, stamp
+            )
+            for midi_path, wav_path, stamp in jobs
+        ]
+        for (_, wav_path, _), future in zip(jobs, futures):
+            try:
+                future.result()
+                logger.info("rendered %s", wav_path)
+            except (OSError, RuntimeError) as e:
+                errors.append(str(e))
+    if errors:
+        raise RuntimeError("Audio rendering failed:\n" + "\n".join(errors))
+
+    return [wav_path for _, wav_path, _ in jobs]
@@ -1,23 +1,22 @@
 import json
 import math
+import os
 import re
 import xml.etree.ElementTree as ET
 from pathlib import Path
 from pprint import pprint
 
-import music21
 import numpy as np
-import pandas as pd
-from tqdm.auto import tqdm
 
-pd.set_option("display.max_rows", None)
-pd.set_option("display.max_columns", None)
-pd.set_option("display.width", 2000)
-pd.set_option("display.float_format", "{:20,.2f}".format)
-pd.set_option("display.max_colwidth", None)
+# music21, pandas and tqdm are slow to import, they are imported by the
+# functions that use them (this module is imported by every CLI)
 
 ROOT_PATH = Path(__file__).absolute().resolve().parent.parent
-DATASET_PATH = ROOT_PATH / "data" / "asap-dataset"
+# ASAP_DATASET_PATH points to another checkout, e.g. a synthetic one (see src/synthetic.py)
+DATASET_PATH = Path(
+    os.environ.get("ASAP_DATASET_PATH", ROOT_PATH / "data" / "asap-dataset")
+).absolute()
+ANNOTATIONS_PATH = DATASET_PATH / "asap_annotations.json"
 
 
 def parse_by_hand(path):
@@ -51,6 +50,60 @@ def parse_by_hand(path):
     pprint(voice_info)
 
 
+# performances whose annotations are broken (wrong midi beats: 1.42 instead of 0.5)
+BROKEN_ANNOTATIONS = ["Bach/Prelude/bwv_885"]
+# max distance (in seconds) between a downbeat and the beat it is annotated at
+DOWNBEAT_TOLERANCE = 1e-6
+
+
+def get_metrical_positions(beats, downbeats):
+    """
+    Position of every beat in its measure, from the annotated downbeats
+
+    Args:
+        beats: list of beat times
+        downbeats: list of downbeat times, a subset of beats
+
+    Returns:
+        positions: int16 array, 0 for downbeats, 1 for the beat after, etc.
+                   Beats of a pickup measure are counted back from the
+                   length of the first full measure.
+    """
+    beats = np.asarray(beats, dtype=np.float64)
+    downbeat_indices = np.searchsorted(
+        beats, np.asarray(downbeats, dtype=np.float64) - DOWNBEAT_TOLERANCE
+    )
+    indices = np.arange(len(beats))
+    if len(downbeat_indices) == 0:
+        return indices.astype(np.int16)
+    measures = np.searchsorted(downbeat_indices, indices, side="right") - 1
+    positions = indices - downbeat_indices[np.maximum(measures, 0)]
+    if len(downbeat_indices) > 1:
+        first_measure_length = downbeat_indices[1] - downbeat_indices[0]
+    else:
+        first_measure_length = len(beats) - downbeat_indices[0]
+    pickup = measures < 0
+    positions[pickup] = np.mod(positions[pickup], first_measure_length)
+    return positions.astype(np.int16)
+
+
+def get_measure_length(beats, downbeats):
+    """
+    Number of beats of the regular measures of a piece: the most common
+    number of beats between consecutive downbeats (all beats if there are
+    less than two downbeats)
+    """
+    beats = np.asarray(beats, dtype=np.float64)
+    downbeat_indices = np.searchsorted(
+        beats, np.asarray(downbeats, dtype=np.float64) - DOWNBEAT_TOLERANCE
+    )
+    lengths = np.diff(downbeat_indices)
+    lengths = lengths[lengths > 0]
+    if len(lengths) == 0:
+        return max(len(beats), 1)
+    return int(np.bincount(lengths).argmax())
+
+
 def get_dataset_metadata(composer):
     """
     Get subcorpus based on composer name
@@ -62,21 +115,80 @@ def get_dataset_metadata(composer):
         df: pd.DataFrame with metainformation for the chosen subcorpus
         json_data: dict with annotations
     """
+    import pandas as pd
+
     df = pd.read_csv(DATASET_PATH / "metadata.csv")
     df = df.loc[df["composer"] == composer]
 
-    with open(DATASET_PATH / "asap_annotations.json") as json_file:
+    with open(ANNOTATIONS_PATH) as json_file:
         json_data = json.load(json_file)
 
     return df, json_data
 
 
+def get_annotations(annotations_path=ANNOTATIONS_PATH):
+    """
+    Load ASAP annotations
+
+    Args:
+        annotations_path: path to asap_annotations.json
+
+    Returns:
+        json_data: dict with annotations, None if the dataset is not available
+    """
+    if not Path(annotations_path).exists():
+        return None
+
+    with open(annotations_path) as json_file:
+        json_data = json.load(json_file)
+
+    return json_data
+
+
+def set_display_options():
+    """Pandas display options used in the notebooks"""
+    import pandas as pd
+
+    pd.set_option("display.max_rows", None)
+    pd.set_option("display.max_columns", None)
+    pd.set_option("display.width", 2000)
+    pd.set_option("display.float_format", "{:20,.2f}".format)
+    pd.set_option("display.max_colwidth", None)
+
+
+def get_piece_paths(midi_root_path):
+    """
+    Paths to the files of an ASAP piece
+
+    Args:
+        midi_root_path: str path of the piece dir, relative to DATASET_PATH
+
+    Returns:
+        xml_path: Path to the MusicXML score
+        midi_path: Path to the score MIDI
+        performed_midi_paths: list of str paths to the performed MIDIs
+    """
+    piece_path = DATASET_PATH / midi_root_path
+    performed_midi_paths = [
+        str(piece_path / name)
+        for name in sorted(os.listdir(piece_path))
+        if name.endswith("mid") and name != "midi_score.mid"
+    ]
+    return (
+        piece_path / "xml_score.musicxml",
+        piece_path / "midi_score.mid",
+        performed_midi_paths,
+    )
+
+
 def get_composer_pieces(composers, df=None):
     """
     composers: list of string
     returns a map between a composer name and a list of performance annotation paths
     TODO (maybe) : remove no-repeat pieces. They shouldn't change the average however
     """
+    import pandas as pd
+
     if df is None:
         df = pd.read_csv(DATASET_PATH / "metadata.csv")
     df = df[["composer", "performance_annotations"]]
@@ -100,6 +212,8 @@ def get_midi_performance_pairs(df, json_data, time_signature, exclude_path):
         midi_beats_list: list(list) of midi beats
         velocity_beats_list: list(list) of velocities for each beat in performance versions
         performance_beats_list: list(list) of corresponding performance versions
+        midi_beat_positions_list: list of int16 arrays with the metrical
+                                  position of every midi beat
     """
     if (ROOT_PATH / "data" / "midi_beats_list.json").exists():
         with open(ROOT_PATH / "data" / "bpm_list.json", "r") as f:
@@ -116,6 +230,18 @@ def get_midi_performance_pairs(df, json_data, time_signature, exclude_path):
             velocity_beats_list = json.load(f)
         with open(ROOT_PATH / "data" / "perf_velocity_beats_list.json", "r") as f:
             perf_velocity_beats_list = json.load(f)
+        positions_path = ROOT_PATH / "data" / "midi_beat_positions_list.json"
+        if positions_path.exists():
+            with open(positions_path, "r") as f:
+                midi_beat_positions_list = [
+                    np.array(positions, dtype=np.int16) for positions in json.load(f)
+                ]
+        else:
+            # saved before the positions were stored
+            midi_beat_positions_list = [
+                get_metrical_positions(beats, downbeats)
+                for beats, downbeats in zip(midi_beats_list, midi_downbeats_list)
+            ]
 
         beats_list_dict = {
             "bpm_list": bpm_list,
@@ -125,6 +251,7 @@ def get_midi_performance_pairs(df, json_data, time_signature, exclude_path):
             "performance_downbeats_list": performance_downbeats_list,
             "velocity_beats_list": velocity_beats_list,
             "perf_velocity_beats_list": perf_velocity_beats_list,
+            "midi_beat_positions_list": midi_beat_positions_list,
         }
 
         return beats_list_dict
@@ -135,7 +262,9 @@ def get_midi_performance_pairs(df, json_data, time_signature, exclude_path):
         )
 
 
-def create_midi_performance_pairs(df, json_data, time_signature, exclude_path):
+def create_midi_performance_pairs(
+    df, json_data, time_signature, exclude_path, save_path=ROOT_PATH / "data"
+):
     """
     Creates pairs of midi beats and its performed version
 
@@ -143,6 +272,7 @@ def create_midi_performance_pairs(df, json_data, time_signature, exclude_path):
         df: pd.DataFrame with metainformation for the chosen subcorpus
         json_data: dict with annotations
         time_signature: str to filter compositions by time signature
+        save_path: dir where the pairs are saved for later use
 
     Returns:
         bpm_list: list(float) of midi bpm of pieces
@@ -152,7 +282,12 @@ def create_midi_performance_pairs(df, json_data, time_signature, exclude_path):
         performance_beats_list: list(list) of corresponding performance versions
         performance_downbeats_list: list(list) of corresponding performance versions
         perf_velocity_beats_list: list(list) of velocities for each beat in performance versions
+        midi_beat_positions_list: list of int16 arrays with the metrical
+                                  position of every midi beat, see get_metrical_positions
     """
+    import music21
+    from tqdm.auto import tqdm
+
     bpm_list = []
     midi_beats_list = []
     midi_downbeats_list = []
@@ -160,11 +295,12 @@ def create_midi_performance_pairs(df, json_data, time_signature, exclude_path):
     performance_beats_list = []
     performance_downbeats_list = []
     perf_velocity_beats_list = []
+    midi_beat_positions_list = []
 
     for i, row in tqdm(df.iterrows(), total=df.shape[0]):
         performance_path = row["midi_performance"]
-        if "Bach/Prelude/bwv_885" in performance_path:
-            continue  # json for this dir is broken (wrong midi beats: 1.42 instead of 0.5)
+        if any(path in performance_path for path in BROKEN_ANNOTATIONS):
+            continue
         ts_dict = json_data[performance_path]["midi_score_time_signatures"]
 
         if len(ts_dict) == 1:  # filter out pieces with more than one time signature
@@ -194,6 +330,9 @@ def create_midi_performance_pairs(df, json_data, time_signature, exclude_path):
                 midi_downbeats_list.append(midi_downbeats)
                 performance_beats_list.append(performance_beats)
                 performance_downbeats_list.append(performance_downbeats)
+                midi_beat_positions_list.append(
+                    get_metrical_positions(midi_beats, midi_downbeats)
+                )
 
                 # Get velocity data
                 full_midi_path = DATASET_PATH / row["midi_score"]
@@ -210,20 +349,22 @@ def create_midi_performance_pairs(df, json_data, time_signature, exclude_path):
                 perf_velocity_beats_list.append(perf_velocity_beats)
 
     # save for later use
-    with open(ROOT_PATH / "data" / "bpm_list.json", "w") as f:
+    with open(save_path / "bpm_list.json", "w") as f:
         json.dump(bpm_list, f)
-    with open(ROOT_PATH / "data" / "midi_beats_list.json", "w") as f:
+    with open(save_path / "midi_beats_list.json", "w") as f:
         json.dump(midi_beats_list, f)
-    with open(ROOT_PATH / "data" / "midi_downbeats_list.json", "w") as f:
+    with open(save_path / "midi_downbeats_list.json", "w") as f:
         json.dump(midi_downbeats_list, f)
-    with open(ROOT_PATH / "data" / "performance_beats_list.json", "w") as f:
+    with open(save_path / "performance_beats_list.json", "w") as f:
         json.dump(performance_beats_list, f)
-    with open(ROOT_PATH / "data" / "performance_downbeats_list.json", "w") as f:
+    with open(save_path / "performance_downbeats_list.json", "w") as f:
         json.dump(performance_downbeats_list, f)
-    with open(ROOT_PATH / "data" / "velocity_beats_list.json", "w") as f:
+    with open(save_path / "velocity_beats_list.json", "w") as f:
         json.dump(velocity_beats_list, f)
-    with open(ROOT_PATH / "data" / "perf_velocity_beats_list.json", "w") as f:
+    with open(save_path / "perf_velocity_beats_list.json", "w") as f:
         json.dump(perf_velocity_beats_list, f)
+    with open(save_path / "midi_beat_positions_list.json", "w") as f:
+        json.dump([positions.tolist() for positions in midi_beat_positions_list], f)
 
     beats_list_dict = {
         "bpm_list": bpm_list,
@@ -233,6 +374,7 @@ def create_midi_performance_pairs(df, json_data, time_signature, exclude_path):
         "performance_downbeats_list": performance_downbeats_list,
         "velocity_beats_list": velocity_beats_list,
         "perf_velocity_beats_list": perf_velocity_beats_list,
+        "midi_beat_positions_list": midi_beat_positions_list,
     }
 
     return beats_list_dict
@@ -240,6 +382,9 @@ def create_midi_performance_pairs(df, json_data, time_signature, exclude_path):
 
 # taken from the exercise session
 def get_events_table_from_score(sample_score):
+    import music21
+    import pandas as pd
+
     rhythm_data_list = []
     for clef in sample_score.parts:
         global_onset = 0
@@ -288,7 +433,10 @@ def get_events_table_from_score(sample_score):
 
 
 # taken from the exercise session
-def get_events_table_from_score_2(sample_score: music21.stream.Score):
+def get_events_table_from_score_2(sample_score: "music21.stream.Score"):
+    import music21
+    import pandas as pd
+
     rhythm_data_list = []
     for i, clef in enumerate(sample_score.parts):
         global_onset = 0
@@ -366,6 +514,12 @@ def train_test_split(beats_list_dict, test_size=0.2):
     performance_beats_list = beats_list_dict["performance_beats_list"]
     performance_downbeats_list = beats_list_dict["performance_downbeats_list"]
     perf_velocity_beats_list = beats_list_dict["perf_velocity_beats_list"]
+    midi_beat_positions_list = beats_list_dict.get("midi_beat_positions_list")
+    if midi_beat_positions_list is None:
+        midi_beat_positions_list = [
+            get_metrical_positions(beats, downbeats)
+            for beats, downbeats in zip(midi_beats_list, midi_downbeats_list)
+        ]
 
     np.random.seed(1)
     test_length = int(len(midi_beats_list) * test_size)
@@ -380,6 +534,7 @@ def train_test_split(beats_list_dict, test_size=0.2):
     train_performance_beats_list = []
     train_performance_downbeats_list = []
     train_perf_velocity_beats_list = []
+    train_midi_beat_positions_list = []
 
     test_bpm_list = []
     test_midi_beats_list = []
@@ -388,6 +543,7 @@ def train_test_split(beats_list_dict, test_size=0.2):
     test_performance_beats_list = []
     test_performance_downbeats_list = []
     test_perf_velocity_beats_list = []
+    test_midi_beat_positions_list = []
 
     for i in range(len(midi_beats_list)):
         if full_index[i]:  # train
@@ -398,6 +554,7 @@ def train_test_split(beats_list_dict, test_size=0.2):
             train_performance_beats_list.append(performance_beats_list[i])
             train_performance_downbeats_list.append(performance_downbeats_list[i])
             train_perf_velocity_beats_list.append(perf_velocity_beats_list[i])
+            train_midi_beat_positions_list.append(midi_beat_positions_list[i])
         else:  # test
             test_bpm_list.append(bpm_list[i])
             test_midi_beats_list.append(midi_beats_list[i])
@@ -406,6 +563,7 @@ def train_test_split(beats_list_dict, test_size=0.2):
             test_performance_beats_list.append(performance_beats_list[i])
             test_performance_downbeats_list.append(performance_downbeats_list[i])
             test_perf_velocity_beats_list.append(perf_velocity_beats_list[i])
+            test_midi_beat_positions_list.append(midi_beat_positions_list[i])
 
     train_beats_list_dict = {
         "bpm_list": train_bpm_list,
@@ -415,6 +573,7 @@ def train_test_split(beats_list_dict, test_size=0.2):
         "performance_downbeats_list": train_performance_downbeats_list,
         "velocity_beats_list": train_velocity_beats_list,
         "perf_velocity_beats_list": train_perf_velocity_beats_list,
+        "midi_beat_positions_list": train_midi_beat_positions_list,
     }
 
     test_beats_list_dict = {
@@ -425,6 +584,7 @@ def train_test_split(beats_list_dict, test_size=0.2):
         "performance_downbeats_list": test_performance_downbeats_list,
         "velocity_beats_list": test_velocity_beats_list,
         "perf_velocity_beats_list": test_perf_velocity_beats_list,
+        "midi_beat_positions_list": test_midi_beat_positions_list,
     }
 
     return train_beats_list_dict, test_beats_list_dict
@@ -0,0 +1,431 @@
+"""
+Incremental re-rendering of edited passages.
+
+An EditablePerformance keeps the generated performance of interpret() as
+per-note arrays, together with everything it depends on: the score position
+of every note, its share of the dynamics curve, and the random draws of the
+seeded passes. Expressive parameters of a passage (the tempo curve of a
+measure range, the level of a dynamic mark) can then be edited. The edits
+only mark measure ranges as dirty, update() recomputes the notes depending
+on them and patches the rest of the performance:
+    - velocities are recomputed for the notes under the changed part of the
+      dynamics curve
+    - timings are recomputed for the notes overlapping the edited tempo
+      slots, the notes after them are shifted by the change of duration
+    - same-pitch overlaps and pedal changes are re-derived from the first
+      moved note on
+"""
+import logging
+from fractions import Fraction
+
+import numpy as np
+
+from src.data import ANNOTATIONS_PATH
+from src.interpret import (
+    build_velocity_table,
+    copy_pretty_midi,
+    get_duration_factors,
+    get_dynamics_curve,
+    get_humanize_rngs,
+    get_noisy_velocities,
+    get_onset_shifts,
+    get_overlap_ends,
+    get_pedal_changes,
+    get_quarter_positions,
+    get_stage_rngs,
+    get_tempo_curve,
+    get_voice_highlighting,
+    merge_hands_pm,
+    set_pedal_changes,
+    shift_note_onsets,
+    stretch_note_durations,
+    warp_to_tempo_curve,
+)
+from src.note_array import notes_from_pretty_midi, set_pretty_midi_notes
+from src.pipeline import PIPELINE_CACHE_PATH, Pipeline
+from src.streaming import STREAM_PASSES
+
+logger = logging.getLogger(__name__)
+
+# passes run before editing, the dynamics timeline is read from the parsed score
+EDIT_PASSES = ["parse_score", "dynamics_timeline"] + STREAM_PASSES[1:]
+
+
+class EditablePerformance:
+    """
+    Performance generated by interpret() from a rendered score, which can be
+    edited and updated incrementally
+
+    Args:
+        midi_data: PrettyMIDI of the score, output of the
+                   "apply_velocity_profile" pass
+        avgs, stds: velocity statistics, outputs of the "idea_13_stats" pass
+        dynamics_timeline: output of the "dynamics_timeline" pass
+        tempo_curves: learned tempo curves, output of the "tempo_curves" pass
+        seed, pedal_mode, rescaling_factor, onset_percentage,
+        duration_percentage, transition_window: see interpret
+    """
+
+    def __init__(
+        self,
+        midi_data,
+        avgs,
+        stds,
+        dynamics_timeline,
+        tempo_curves=None,
+        seed=None,
+        pedal_mode="onset",
+        rescaling_factor=10,
+        onset_percentage=1,
+        duration_percentage=5,
+        transition_window=4.0,
+        slot_length=Fraction(1, 3),
+    ):
+        self.midi_data = midi_data
+        self.pedal_mode = pedal_mode
+        self.rescaling_factor = rescaling_factor
+        self.transition_window = transition_window
+        self.slot_length = float(slot_length)
+        self.velocity_table = build_velocity_table(avgs, stds)
+
+        # the rendered score and the score position of every note
+        self.score_notes = notes_from_pretty_midi(midi_data)
+        self.start_quarters = get_quarter_positions(
+            midi_data, self.score_notes["start"]
+        )
+        self.end_quarters = get_quarter_positions(midi_data, self.score_notes["end"])
+        self.measure_quarters = get_quarter_positions(
+            midi_data, midi_data.get_downbeats()
+        )
+
+        # velocities of the score = voice factor * dynamics curve + residual
+        # (e.g. the offsets of the velocity profile), see overwrite_velocities
+        self.dynamics_timeline = tuple(np.array(x) for x in dynamics_timeline)
+        self.voice_factors = get_voice_highlighting(
+            self.end_quarters - self.start_quarters, True
+        )
+        left_hand = self.score_notes["instrument"] != 0
+        self.voice_factors[left_hand] = get_voice_highlighting(
+            self.end_quarters[left_hand] - self.start_quarters[left_hand], False
+        )
+        dynamics = self.get_dynamics(self.start_quarters)
+        self.velocity_residuals = (
+            self.score_notes["velocity"] - self.voice_factors * dynamics
+        )
+
+        # random draws of the seeded passes, in the order they are made by
+        # apply_idea_13, add_tempo_changes and randomize
+        n_notes = len(self.score_notes)
+        self.velocity_noise = get_stage_rngs(seed)["velocity"].standard_normal(n_notes)
+        n_slots = (
+            int(np.ceil(self.end_quarters.max() / self.slot_length)) + 1
+            if n_notes > 0
+            else 1
+        )
+        self.tempos = get_tempo_curve(
+            n_slots, seed, tempo_curves, self.slot_length
+        ).astype(np.float64)
+        onset_rng, duration_rng = get_humanize_rngs(seed)
+        self.onset_shifts = get_onset_shifts(n_notes, onset_percentage, onset_rng)
+        self.duration_factors = get_duration_factors(
+            n_notes, duration_percentage, duration_rng
+        )
+
+        self.start_slots = self.get_slots(self.start_quarters)
+        self.end_slots = self.get_slots(self.end_quarters)
+        self.dirty_quarters = None
+        self.dirty_slots = None
+        self.recompute()
+
+    def get_slots(self, quarters):
+        slots = (quarters // self.slot_length).astype(np.int64)
+        return np.clip(slots, 0, len(self.tempos) - 1)
+
+    def get_dynamics(self, quarters):
+        """Dynamics curve (base velocity) at score positions"""
+        xp, fp = get_dynamics_curve(self.dynamics_timeline, self.transition_window)
+        return np.interp(quarters, xp, fp)
+
+    def get_measures(self, quarters):
+        """Index of the measures of score positions"""
+        index = np.searchsorted(self.measure_quarters, quarters, side="right") - 1
+        return np.maximum(index, 0)
+
+    def recompute(self):
+        """Compute the whole performance, ignoring the dirty ranges"""
+        everything = np.ones(len(self.score_notes), dtype=bool)
+        self.warped = self.score_notes.copy()
+        self.update_velocities(everything)
+        slot_durations = self.slot_length * 60 / self.tempos
+        self.slot_starts = np.concatenate(([0.0], np.cumsum(slot_durations)[:-1]))
+        self.warp(everything)
+        self.performed = self.warped.copy()
+        self.humanize(everything)
+        self.ends = get_overlap_ends(self.performed)
+        left_hand = self.get_notes()
+        self.pedal_changes = get_pedal_changes(
+            left_hand[left_hand["instrument"] == 1], self.pedal_mode
+        )
+        self.dirty_quarters = None
+        self.dirty_slots = None
+
+    def update_velocities(self, mask):
+        velocities = np.clip(
+            np.rint(
+                self.voice_factors[mask] * self.get_dynamics(self.start_quarters[mask])
+                + self.velocity_residuals[mask]
+            ),
+            0,
+            127,
+        )
+        self.warped["velocity"][mask] = get_noisy_velocities(
+            velocities,
+            self.velocity_table,
+            self.rescaling_factor,
+            self.velocity_noise[mask],
+        )
+
+    def warp(self, mask):
+        for field, quarters in [
+            ("start", self.start_quarters),
+            ("end", self.end_quarters),
+        ]:
+            self.warped[field][mask] = warp_to_tempo_curve(
+                quarters[mask], self.tempos, self.slot_length, self.slot_starts
+            )
+
+    def humanize(self, mask):
+        notes = shift_note_onsets(self.warped[mask], self.onset_shifts[mask])
+        self.performed[mask] = stretch_note_durations(
+            notes, self.duration_factors[mask]
+        )
+
+    # edits
+    def set_dynamic(self, offset, velocity):
+        """
+        Set the base velocity of a dynamic mark at a score position (in
+        quarters), adding the mark if there is none. velocity None removes it.
+        """
+        offsets, velocities, ramps = self.dynamics_timeline
+        index = np.searchsorted(offsets, offset)
+        exists = index < len(offsets) and offsets[index] == offset
+        if velocity is None:
+            if not exists or index == 0:
+                raise ValueError(f"No removable dynamic mark at {offset}")
+            offsets, velocities, ramps = (
+                np.delete(offsets, index),
+                np.delete(velocities, index),
+                np.delete(ramps, index),
+            )
+        elif exists:
+            velocities = velocities.copy()
+            velocities[index] = velocity
+        else:
+            # a new mark is reached over the transition window
+            offsets = np.insert(offsets, index, offset)
+            velocities = np.insert(velocities, index, velocity)
+            ramps = np.insert(ramps, index, np.nan)
+        self.dynamics_timeline = (offsets, velocities, ramps)
+
+        # the curve only changes between the previous and the next marks
+        previous = offsets[index - 1] if index > 0 else 0.0
+        after = index + 1 if velocity is not None else index
+        next_offset = offsets[after] if after < len(offsets) else np.inf
+        self.mark_dirty_quarters(previous, next_offset)
+
+    def set_tempos(self, first_slot, tempos):
+        """Set the tempo (in bpm) of slots of the tempo curve, from first_slot on"""
+        tempos = np.asarray(tempos, dtype=np.float64)
+        first_slot = max(first_slot, 0)
+        last_slot = min(first_slot + len(tempos), len(self.tempos))
+        self.tempos[first_slot:last_slot] = tempos[: last_slot - first_slot]
+        self.mark_dirty_slots(first_slot, last_slot)
+
+    def scale_tempo(self, first_measure, last_measure, factor):
+        """Multiply the tempo of measures first_measure..last_measure by factor"""
+        first_slot, last_slot = self.get_measure_slots(first_measure, last_measure)
+        self.set_tempos(first_slot, self.tempos[first_slot:last_slot] * factor)
+
+    def get_measure_slots(self, first_measure, last_measure):
+        """Range of the tempo slots of measures first_measure..last_measure"""
+        start = self.measure_quarters[first_measure]
+        if last_measure + 1 < len(self.measure_quarters):
+            end = self.measure_quarters[last_measure + 1]
+            last_slot = int(np.ceil(end / self.slot_length - 1e-9))
+        else:
+            last_slot = len(self.tempos)
+        return int(start // self.slot_length), last_slot
+
+    def mark_dirty_quarters(self, start, end):
+        if self.dirty_quarters is not None:
+            start = min(start, self.dirty_quarters[0])
+            end = max(end, self.dirty_quarters[1])
+        self.dirty_quarters = (start, end)
+
+    def mark_dirty_slots(self, first_slot, last_slot):
+        if self.dirty_slots is not None:
+            first_slot = min(first_slot, self.dirty_slots[0])
+            last_slot = max(last_slot, self.dirty_slots[1])
+        self.dirty_slots = (first_slot, last_slot)
+
+    # incremental update
+    def update(self):
+        """
+        Recompute the notes depending on the edits since the last update and
+        patch the rest of the performance
+
+        Returns:
+            dirty: (first, last) measure range of the recomputed notes, the
+                   notes after it were only shifted (None if nothing changed)
+        """
+        dirty = np.zeros(len(self.score_notes), dtype=bool)
+        if self.dirty_quarters is not None:
+            start, end = self.dirty_quarters
+            changed = (self.start_quarters >= start) & (self.start_quarters < end)
+            self.update_velocities(changed)
+            self.performed["velocity"][changed] = self.warped["velocity"][changed]
+            dirty |= changed
+        if self.dirty_slots is not None:
+            dirty |= self.update_timing(*self.dirty_slots)
+        self.dirty_quarters = None
+        self.dirty_slots = None
+
+        if not dirty.any():
+            return None
+        measures = self.get_measures(self.start_quarters[dirty])
+        logger.info(
+            "recomputed %d notes of measures %d-%d",
+            dirty.sum(),
+            measures.min(),
+            measures.max(),
+        )
+        return int(measures.min()), int(measures.max())
+
+    def update_timing(self, first_slot, last_slot):
+        """
+        Re-warp the notes overlapping the slots first_slot..last_slot - 1, and
+        shift the ones after them
+
+        Returns:
+            rewarped: bool mask of the re-warped notes
+        """
+        slot_durations = self.slot_length * 60 / self.tempos[first_slot:last_slot]
+        starts = np.cumsum(
+            np.concatenate(([self.slot_starts[first_slot]], slot_durations))
+        )
+        delta = 0.0
+        if last_slot < len(self.tempos):
+            delta = starts[-1] - self.slot_starts[last_slot]
+        self.slot_starts[first_slot:last_slot] = starts[:-1]
+        self.slot_starts[last_slot:] += delta
+
+        rewarped = (self.end_slots >= first_slot) & (self.start_slots < last_slot)
+        shifted = self.start_slots >= last_slot
+        moved = rewarped | shifted
+        if not moved.any():
+            return rewarped
+        first_start = self.performed["start"][moved].min()
+
+        self.warp(rewarped)
+        self.warped["start"][shifted] += delta
+        self.warped["end"][shifted] += delta
+        self.humanize(moved)
+        # notes starting up to 1ms earlier can be dropped by remove_overlap
+        first_start = min(first_start, self.performed["start"][moved].min()) - 0.001
+        self.update_overlaps(first_start)
+        self.update_pedal(first_start)
+        return rewarped
+
+    def update_overlaps(self, first_start):
+        """Re-derive the same-pitch overlaps of the notes moved from first_start on"""
+        durations = self.performed["end"] - self.performed["start"]
+        # notes starting earlier end before first_start, no moved note can cut them
+        window = self.performed["start"] >= first_start - durations.max()
+        self.ends[window] = get_overlap_ends(self.performed[window])
+
+    def update_pedal(self, first_start):
+        """Re-derive the pedal changes triggered from first_start on"""
+        starts = self.performed["start"]
+        left_hand = (self.performed["instrument"] == 1) & (self.ends > starts)
+        before = starts[left_hand & (starts < first_start)]
+        # the last onset before the window is needed to detect changes
+        window_start = before.max() if len(before) > 0 else -np.inf
+        window = left_hand & (starts >= window_start)
+        changes = get_pedal_changes(self.performed[window], self.pedal_mode)
+        self.pedal_changes = np.concatenate(
+            (
+                self.pedal_changes[self.pedal_changes < first_start],
+                changes[changes >= first_start],
+            )
+        )
+
+    # outputs
+    def get_notes(self):
+        """Note array of the performance, sorted by (start, pitch)"""
+        notes = self.performed.copy()
+        notes["end"] = self.ends
+        notes = notes[notes["end"] > notes["start"]]
+        return notes[np.lexsort((notes["pitch"], notes["start"]))]
+
+    def to_pretty_midi(self, pedal=True):
+        """
+        PrettyMIDI of the performance: generated_midi_with_pedal.mid of
+        interpret() if pedal, generated_midi.mid otherwise
+        """
+        midi_data = copy_pretty_midi(self.midi_data)
+        set_pretty_midi_notes(midi_data, self.get_notes())
+        if pedal:
+            set_pedal_changes(midi_data, self.pedal_changes)
+            merge_hands_pm(midi_data)
+        return midi_data
+
+    def write(self, midi_path, pedal=True):
+        self.to_pretty_midi(pedal).write(str(midi_path))
+
+
+def get_editable_performance(
+    unperformed_midi_path,
+    xml_path,
+    performed_midi_paths,
+    seed=None,
+    pedal_mode="onset",
+    rescaling_factor=10,
+    onset_percentage=1,
+    duration_percentage=5,
+    transition_window=4.0,
+    profile_amplitude=1.0,
+    cache_path=PIPELINE_CACHE_PATH,
+    memory=None,
+):
+    """
+    Same arguments as interpret(), returns the performance as an
+    EditablePerformance instead of writing it. The score passes are
+    memoized (see EDIT_PASSES).
+    """
+    pipeline = Pipeline(EDIT_PASSES, cache_path=cache_path, memory=memory)
+    values = pipeline.run(
+        sources={
+            "unperformed_midi_path": unperformed_midi_path,
+            "xml_path": xml_path,
+            "performed_midi_paths": list(performed_midi_paths),
+            "annotations_path": ANNOTATIONS_PATH,
+        },
+        params={
+            "transition_window": transition_window,
+            "profile_amplitude": profile_amplitude,
+        },
+        outputs=["midi_data", "avgs", "stds", "dynamics_timeline", "tempo_curves"],
+    )
+    return EditablePerformance(
+        values["midi_data"],
+        values["avgs"],
+        values["stds"],
+        values["dynamics_timeline"],
+        values["tempo_curves"],
+        seed=seed,
+        pedal_mode=pedal_mode,
+        rescaling_factor=rescaling_factor,
+        onset_percentage=onset_percentage,
+        duration_percentage=duration_percentage,
+        transition_window=transition_window,
+    )
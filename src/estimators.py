@@ -1,6 +1,6 @@
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.stats as ss
+
+from src.data import get_measure_length, get_metrical_positions
 
 
 class Estimator:
@@ -22,14 +22,18 @@ class Estimator:
         performance_downbeats_list,
         velocity_beats_list,
         perf_velocity_beats_list,
+        midi_beat_positions_list=None,
     ):
         """
-        Train estimator on training data
+        Train estimator on training data. midi_beat_positions_list holds the
+        metrical position of every midi beat (computed from the downbeats
+        if None), see create_midi_performance_pairs
         """
 
         self.bpm_list = bpm_list
         self.midi_beats_list = midi_beats_list
         self.midi_downbeats_list = midi_downbeats_list
+        self.midi_beat_positions_list = midi_beat_positions_list
 
         if self.data_type == "time":
             self.unperformed_beats_list = midi_beats_list
@@ -56,15 +60,23 @@ class Estimator:
         performance_downbeats_list,
         velocity_beats_list,
         perf_velocity_beats_list,
+        midi_beat_positions_list=None,
     ):
         if self.estimator_type == "random":
             if self.data_type == "time":
                 return self.random_estimate(
-                    midi_beats_list, midi_downbeats_list, bpm_list
+                    midi_beats_list,
+                    midi_downbeats_list,
+                    bpm_list,
+                    beat_positions_list=midi_beat_positions_list,
                 )
             else:
                 return self.random_estimate(
-                    midi_beats_list, midi_downbeats_list, bpm_list, velocity_beats_list
+                    midi_beats_list,
+                    midi_downbeats_list,
+                    bpm_list,
+                    velocity_beats_list,
+                    midi_beat_positions_list,
                 )
         if self.estimator_type == "linear":
             return self.linear_estimate(midi_beats_list)
@@ -75,9 +87,10 @@ class Estimator:
         unperformed_downbeats_list,
         bpm_list,
         velocity_beats_list=None,
+        beat_positions_list=None,
     ):
         beat_indices, _ = self.get_beat_indices(
-            unperformed_beats_list, unperformed_downbeats_list, bpm_list
+            unperformed_beats_list, unperformed_downbeats_list, beat_positions_list
         )
         estimated_durations = []
         for piece_number in range(len(bpm_list)):  # run over test pieces
@@ -88,7 +101,9 @@ class Estimator:
             for j in indices:
                 # Compute random durations from a normal distribution with mean
                 # and variance obtained from the train sub-corpus
-                ind = int(j)
+                # positions the training pieces do not have share their
+                # statistics with the positions of the same rank
+                ind = int(j) % len(self.mean)
                 if self.data_type == "time":
                     bias = bpm
                 else:
@@ -146,7 +161,10 @@ class Estimator:
         """
         pop_last = self.data_type == "time"
         beat_indices, beats_per_measure = self.get_beat_indices(
-            self.midi_beats_list, self.midi_downbeats_list, self.bpm_list, pop_last
+            self.midi_beats_list,
+            self.midi_downbeats_list,
+            self.midi_beat_positions_list,
+            pop_last,
         )
         if self.data_type == "time":
             performance_beat = self.get_beat_durations(self.performed_beats_list)
@@ -160,6 +178,23 @@ class Estimator:
         self.mean = mean_performance
         self.var = variance_performance
 
+    def fit_features(self, features):
+        """
+        Fit the random time estimator on a slice of the IOI feature store
+        (see src/features.py) instead of the beat lists
+        """
+        from src.features import get_position_statistics
+
+        if self.estimator_type != "random" or self.data_type != "time":
+            raise ValueError(
+                "Only random time estimators can be fitted on IOI features"
+            )
+        features = dict(
+            features, tempo_difference=features["tempo"] - features["score_tempo"]
+        )
+        self.mean, self.var = get_position_statistics(features, "tempo_difference")
+        return self
+
     def get_mean_variance_performance(
         self, beat_indices, bpm_list, performance_beat, beats_per_measure
     ):
@@ -169,43 +204,68 @@ class Estimator:
         """
         mean_performance = [0] * beats_per_measure
         variance_performance = [0] * beats_per_measure
+        # number of pieces with beats at every position
+        n_pieces = [0] * beats_per_measure
         for indices, bpm, performance in zip(beat_indices, bpm_list, performance_beat):
             if self.data_type == "time":
                 bias = bpm
             else:
                 bias = 0
+            performance = np.asarray(performance, dtype=np.float64)
             for j in range(beats_per_measure):
-                filtered_performance = [
-                    performance[i] - bias
-                    for i in range(len(performance))
-                    if indices[i] == j
-                ]
+                filtered_performance = performance[indices == j] - bias
+                if len(filtered_performance) == 0:
+                    continue
                 mean_performance[j] += np.mean(filtered_performance)
                 variance_performance[j] += np.var(filtered_performance)
+                n_pieces[j] += 1
 
-        mean_performance = [mean / len(beat_indices) for mean in mean_performance]
-        variance_performance = [var / len(beat_indices) for var in variance_performance]
+        mean_performance = [
+            mean / max(n, 1) for mean, n in zip(mean_performance, n_pieces)
+        ]
+        variance_performance = [
+            var / max(n, 1) for var, n in zip(variance_performance, n_pieces)
+        ]
 
         return mean_performance, variance_performance
 
     def get_beat_indices(
-        self, midi_beats_list, midi_downbeats_list, bpm_list, pop_last=True
+        self,
+        midi_beats_list,
+        midi_downbeats_list,
+        beat_positions_list=None,
+        pop_last=True,
     ):
-        """Separarates beats depending on the position in the measure"""
+        """
+        Separarates beats depending on the position in the measure
+
+        Returns:
+            beat_indices: list of int arrays, 0 is the downbeat, 1 is the beat
+                          after, etc. (from beat_positions_list if given),
+                          folded into the regular measures of every piece
+                          (e.g. beats of a measure with a missing downbeat)
+            beats_per_measure: int number of positions
+        """
+        if beat_positions_list is None:
+            beat_positions_list = [
+                get_metrical_positions(beats, downbeats)
+                for beats, downbeats in zip(midi_beats_list, midi_downbeats_list)
+            ]
         beat_indices = []
-        for beats, downbeats, bpm in zip(
-            midi_beats_list, midi_downbeats_list, bpm_list
+        beats_per_measure = 0
+        for beats, downbeats, positions in zip(
+            midi_beats_list, midi_downbeats_list, beat_positions_list
         ):
-            bps = bpm / 60.0  # beats per second
-            nb = bps * (downbeats[1] - downbeats[0])  # beats per measure
-            # indices of beats: 0 is the downbeat, 1 is the beat after, etc.
-            indices = [((j - downbeats[0]) * bps) % nb for j in beats]
-            indices = [round(j) for j in indices]  # round to integers
+            measure_length = get_measure_length(beats, downbeats)
+            indices = np.asarray(positions, dtype=np.int64) % measure_length
+            if len(indices):
+                beats_per_measure = max(beats_per_measure, int(indices.max()) + 1)
             if pop_last:
-                indices.pop()  # remove last beat from each piece (no duration given)
+                # remove last beat from each piece (no duration given)
+                indices = indices[:-1]
             beat_indices.append(indices)
 
-        return beat_indices, int(nb)
+        return beat_indices, beats_per_measure
 
     def get_beat_durations(self, performance_beats_list):
         """Returns performance beat durations"""
@@ -222,11 +282,13 @@ class Estimator:
         """
         Given training data, fit linear predictors
         """
+        import scipy.stats
+
         estimators = []
         for midi_beats, performed_beats in zip(
             self.midi_beats_list, self.performed_beats_list
         ):
-            linreg = ss.linregress(x=midi_beats, y=performed_beats)
+            linreg = scipy.stats.linregress(x=midi_beats, y=performed_beats)
             estimators.append(linreg)
         self.estimators = estimators
 
@@ -0,0 +1,337 @@
+"""
+Metrics comparing a generated performance with the human performances of
+a piece (part C of the assignment, by numbers instead of by ear):
+
+    - tempo: correlation of the beat-level tempo curves
+    - dynamics: distances between the velocity distributions
+    - timing: statistics of the onset deviations from the beat grid
+
+The human side only depends on the piece and is computed once by
+get_reference (alignments and note arrays are cached on disk). evaluate
+then compares a generated note array with all performances at once, in a
+few milliseconds, so that it can be used as the objective of a sweep.
+
+    python -m src.evaluation Schubert/Impromptu_op.90_D.899/3 \
+        --generated results/generated_midi_with_pedal.mid
+"""
+import argparse
+import json
+import logging
+
+import numpy as np
+
+from src.alignment import get_alignment, get_performance_annotation, warp_onsets
+from src.data import ROOT_PATH, get_annotations, get_piece_paths
+from src.instrumentation import setup_logging
+from src.note_array import load_notes, load_notes_parallel
+
+logger = logging.getLogger(__name__)
+
+N_VELOCITIES = 128
+# shortest beat duration (in seconds), guards the tempo of merged beats
+MIN_BEAT_DURATION = 1e-3
+# max distance (in seconds) between the expected and the performed onset of a match
+MAX_DEVIATION = 0.5
+# re-matchings with the estimated beats, more only help very different performances
+N_REFINEMENTS = 3
+# larger than any onset, separates the pitches in the sorted match keys
+PITCH_OFFSET = 1e6
+
+
+def match_nearest(expected_onsets, score_pitches, onsets, pitches, max_deviation):
+    """
+    Pair every score note with the closest performed note of the same pitch
+
+    Returns:
+        matches: (k, 2) int array of (score index, performance index), one-to-one
+    """
+    keys = pitches * PITCH_OFFSET + onsets
+    order = np.argsort(keys)
+    keys = keys[order]
+    expected_keys = score_pitches * PITCH_OFFSET + expected_onsets
+    right = np.clip(np.searchsorted(keys, expected_keys), 1, len(keys) - 1)
+    candidates = np.stack([right - 1, right], axis=1)
+    deviations = np.abs(keys[candidates] - expected_keys[:, None])
+    best = candidates[np.arange(len(candidates)), np.argmin(deviations, axis=1)]
+    deviation = deviations.min(axis=1)
+
+    score_index = np.flatnonzero(deviation <= max_deviation)
+    performance_index = order[best[score_index]]
+    # one-to-one, keeping the closest pairs
+    closest = np.argsort(deviation[score_index], kind="stable")
+    _, first = np.unique(performance_index[closest], return_index=True)
+    keep = np.sort(closest[first])
+    return np.stack([score_index[keep], performance_index[keep]], axis=1)
+
+
+def match_notes(score_notes, notes, score_beats, max_deviation=MAX_DEVIATION):
+    """
+    Fast note matching of a score with a performance of (almost) the same
+    notes, such as a generated one. Unlike align_notes, it needs no beat
+    annotations and no DTW: the score is first mapped to the performance
+    by note counts (the k-th onset of the score to the k-th performed one),
+    which does not drift with the tempo, then by the beats estimated from
+    the previous matches (N_REFINEMENTS times).
+
+    Returns:
+        matches: (k, 2) int array of (score index, performance index)
+    """
+    if len(score_notes) < 2 or len(notes) < 2:
+        return np.empty((0, 2), dtype=np.int64)
+    score_onsets = score_notes["start"].astype(np.float64)
+    score_pitches = score_notes["pitch"].astype(np.float64)
+    onsets = notes["start"].astype(np.float64)
+    pitches = notes["pitch"].astype(np.float64)
+
+    ranks = np.empty(len(score_onsets), dtype=np.int64)
+    ranks[np.argsort(score_onsets, kind="stable")] = np.arange(len(score_onsets))
+    positions = np.round(ranks * (len(onsets) - 1) / (len(score_onsets) - 1))
+    expected_onsets = np.sort(onsets)[positions.astype(np.int64)]
+    matches = match_nearest(
+        expected_onsets, score_pitches, onsets, pitches, max_deviation
+    )
+
+    for _ in range(N_REFINEMENTS):
+        beat_times = get_beat_times(
+            score_onsets[matches[:, 0]], onsets[matches[:, 1]], score_beats
+        )
+        expected_onsets = warp_onsets(score_onsets, score_beats, beat_times)
+        matches = match_nearest(
+            expected_onsets, score_pitches, onsets, pitches, max_deviation
+        )
+    return matches
+
+
+def get_beat_times(score_onsets, performed_onsets, score_beats):
+    """
+    Estimate the performed time of every score beat from matched notes
+
+    Args:
+        score_onsets: onsets of the matched notes in the score
+        performed_onsets: onsets of the same notes in the performance
+        score_beats: beat times in the score
+
+    Returns:
+        beat_times: performed beat times, interpolated between the mean
+                    onsets of the score positions (linearly extrapolated
+                    before the first and after the last matched note)
+    """
+    positions, inverse = np.unique(score_onsets, return_inverse=True)
+    counts = np.bincount(inverse)
+    mean_onsets = np.bincount(inverse, weights=performed_onsets) / counts
+    if len(positions) < 2:
+        raise ValueError("At least two matched score positions are needed")
+    return warp_onsets(
+        np.asarray(score_beats, dtype=np.float64), positions, mean_onsets
+    )
+
+
+def get_log_tempos(beat_times):
+    """Log of the beat-level tempo, along the last axis of beat_times"""
+    return -np.log(np.maximum(np.diff(beat_times, axis=-1), MIN_BEAT_DURATION))
+
+
+def get_onset_deviations(score_onsets, performed_onsets, score_beats, beat_times):
+    """Deviation (in seconds) of performed onsets from the performed beat grid"""
+    return performed_onsets - warp_onsets(score_onsets, score_beats, beat_times)
+
+
+def get_velocity_cdfs(velocities, groups, n_groups):
+    """
+    Cumulative velocity distributions
+
+    Args:
+        velocities: int array of MIDI velocities
+        groups: int array with the group (e.g. performance) of every velocity
+        n_groups: number of groups
+
+    Returns:
+        cdfs: (n_groups, N_VELOCITIES) array
+    """
+    counts = np.bincount(
+        groups * N_VELOCITIES + velocities, minlength=n_groups * N_VELOCITIES
+    ).reshape(n_groups, N_VELOCITIES)
+    cdfs = np.cumsum(counts, axis=1, dtype=np.float64)
+    return cdfs / np.maximum(cdfs[:, -1:], 1)
+
+
+def get_reference(unperformed_midi_path, performed_midi_paths):
+    """
+    Human side of the metrics, computed once per piece
+
+    Args:
+        unperformed_midi_path: str path to the score MIDI
+        performed_midi_paths: list of str paths to the performed MIDIs
+
+    Returns:
+        reference: dict with
+            score_notes: note array of the score MIDI
+            score_beats: beat times in the score
+            log_tempos: (n_performances, n_beats - 1) array
+            velocity_cdfs: (n_performances, N_VELOCITIES) array
+            velocity_means: mean velocity of every performance
+            deviation_means, deviation_stds: onset deviation statistics
+                                             of every performance
+    """
+    score_notes = load_notes(unperformed_midi_path)
+    performed_notes_list = load_notes_parallel(performed_midi_paths)
+    json_data = get_annotations()
+    annotations = [
+        get_performance_annotation(path, json_data) for path in performed_midi_paths
+    ]
+
+    annotated = [a for a in annotations if a is not None]
+    if annotated:
+        score_beats = np.asarray(annotated[0]["midi_score_beats"], dtype=np.float64)
+    else:
+        import pretty_midi
+
+        logger.warning("no beat annotations, using the beats of the score MIDI")
+        score_beats = pretty_midi.PrettyMIDI(str(unperformed_midi_path)).get_beats()
+
+    beat_times = []
+    deviations = []
+    for path, notes, annotation in zip(
+        performed_midi_paths, performed_notes_list, annotations
+    ):
+        matches = get_alignment(
+            unperformed_midi_path, path, score_notes, notes, annotation=annotation
+        )
+        score_onsets = score_notes["start"][matches[:, 0]]
+        performed_onsets = notes["start"][matches[:, 1]]
+        if annotation is None:
+            times = get_beat_times(score_onsets, performed_onsets, score_beats)
+        else:
+            # the annotated beats of every performance, on the common score beats
+            times = np.interp(
+                score_beats,
+                annotation["midi_score_beats"],
+                annotation["performance_beats"],
+            )
+        beat_times.append(times)
+        deviations.append(
+            get_onset_deviations(score_onsets, performed_onsets, score_beats, times)
+        )
+
+    n_performances = len(performed_notes_list)
+    velocities = np.concatenate([notes["velocity"] for notes in performed_notes_list])
+    groups = np.repeat(
+        np.arange(n_performances), [len(notes) for notes in performed_notes_list]
+    )
+    return {
+        "score_notes": score_notes,
+        "score_beats": score_beats,
+        "log_tempos": get_log_tempos(np.array(beat_times)),
+        "velocity_cdfs": get_velocity_cdfs(
+            velocities.astype(np.int64), groups, n_performances
+        ),
+        "velocity_means": np.array(
+            [notes["velocity"].mean() for notes in performed_notes_list]
+        ),
+        "deviation_means": np.array([np.abs(d).mean() for d in deviations]),
+        "deviation_stds": np.array([d.std() for d in deviations]),
+    }
+
+
+def evaluate(notes, reference):
+    """
+    Compare a generated performance with all human performances of a piece
+
+    Args:
+        notes: note array of the generated performance
+        reference: see get_reference
+
+    Returns:
+        metrics: dict with
+            tempo_correlation: mean Pearson correlation of the log tempo
+                               curve with the human ones (higher is better)
+            velocity_wasserstein: mean earth mover's distance (in velocity
+                                  units) between the velocity distributions
+            velocity_ks: mean Kolmogorov-Smirnov statistic of the same
+            velocity_mean_difference: mean velocity minus the human one
+            onset_deviation, human_onset_deviation: mean absolute deviation
+                (in seconds) of the onsets from the performed beat grid
+            onset_deviation_std, human_onset_deviation_std: their std
+            matched_notes: fraction of the score notes found in the
+                           generated performance
+            per_performance: lists of tempo_correlation, velocity_wasserstein
+                             and velocity_ks, in the order of the performances
+    """
+    score_notes = reference["score_notes"]
+    score_beats = reference["score_beats"]
+
+    matches = match_notes(score_notes, notes, score_beats)
+    score_onsets = score_notes["start"][matches[:, 0]]
+    performed_onsets = notes["start"][matches[:, 1]]
+    beat_times = get_beat_times(score_onsets, performed_onsets, score_beats)
+
+    # tempo: correlation with every human curve at once
+    log_tempos = get_log_tempos(beat_times)
+    human = reference["log_tempos"] - reference["log_tempos"].mean(
+        axis=1, keepdims=True
+    )
+    generated = log_tempos - log_tempos.mean()
+    norms = np.linalg.norm(human, axis=1) * np.linalg.norm(generated)
+    tempo_correlations = human @ generated / np.maximum(norms, 1e-12)
+
+    # dynamics: distances between cumulative distributions
+    cdf = get_velocity_cdfs(
+        notes["velocity"].astype(np.int64), np.zeros(len(notes), dtype=np.int64), 1
+    )
+    cdf_differences = np.abs(reference["velocity_cdfs"] - cdf)
+    wasserstein = cdf_differences.sum(axis=1)
+    ks = cdf_differences.max(axis=1)
+
+    deviations = get_onset_deviations(
+        score_onsets, performed_onsets, score_beats, beat_times
+    )
+    return {
+        "tempo_correlation": float(tempo_correlations.mean()),
+        "velocity_wasserstein": float(wasserstein.mean()),
+        "velocity_ks": float(ks.mean()),
+        "velocity_mean_difference": float(
+            notes["velocity"].mean() - reference["velocity_means"].mean()
+        ),
+        "onset_deviation": float(np.abs(deviations).mean()),
+        "human_onset_deviation": float(reference["deviation_means"].mean()),
+        "onset_deviation_std": float(deviations.std()),
+        "human_onset_deviation_std": float(reference["deviation_stds"].mean()),
+        "matched_notes": len(matches) / max(len(score_notes), 1),
+        "per_performance": {
+            "tempo_correlation": tempo_correlations.tolist(),
+            "velocity_wasserstein": wasserstein.tolist(),
+            "velocity_ks": ks.tolist(),
+        },
+    }
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(
+        description="Compare a generated MIDI with the performances of its piece"
+    )
+    args.add_argument(
+        "midi_root_path",
+        type=str,
+        help="Path of the piece, relative to the ASAP dataset",
+    )
+    args.add_argument(
+        "--generated",
+        default=str(ROOT_PATH / "results" / "generated_midi_with_pedal.mid"),
+        type=str,
+        help="Generated MIDI file (default: results/generated_midi_with_pedal.mid)",
+    )
+    args.add_argument(
+        "--log_level",
+        default="WARNING",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        type=str,
+        help="Logging level (default: WARNING)",
+    )
+    args = args.parse_args()
+    setup_logging(args.log_level)
+
+    _, midi_path, performed_midi_paths = get_piece_paths(args.midi_root_path)
+    reference = get_reference(str(midi_path), performed_midi_paths)
+    # the generated file changes between runs, do not cache its notes
+    metrics = evaluate(load_notes(args.generated, cache_path=None), reference)
+    print(json.dumps(metrics, indent=2))
@@ -0,0 +1,274 @@
+"""
+Beat-level features of the annotated ASAP performances, extracted once for
+the whole corpus and stored in a compact columnar file (numpy .npz), so that
+the plots and the estimators read slices of it instead of recomputing them.
+
+Every row is the inter-onset interval (IOI) between two consecutive
+annotated beats of a performance:
+
+    composer, piece, performance: int codes, see the *_names arrays
+    beat: index of the first beat of the IOI in the piece
+    position: metrical position of that beat, see get_metrical_positions
+    deviation: deviation of the performed IOI from the score IOI at the
+               mean tempo of the performance [%]
+    tempo, score_tempo: performed and score tempo of the beat [bpm]
+
+Rows are sorted by composer, piece, performance and beat, piece_starts
+holds the first row of every piece.
+
+    python -m src.features                  # all annotated performances
+    python -m src.features -c Chopin Liszt  # only some composers
+"""
+import argparse
+import logging
+from pathlib import Path
+
+import numpy as np
+
+from src.data import (
+    BROKEN_ANNOTATIONS,
+    ROOT_PATH,
+    get_annotations,
+    get_metrical_positions,
+)
+from src.instrumentation import setup_logging
+
+logger = logging.getLogger(__name__)
+
+FEATURES_PATH = ROOT_PATH / "data" / "features" / "ioi_deviations.npz"
+COLUMNS = {
+    "composer": np.int16,
+    "piece": np.int32,
+    "performance": np.int32,
+    "beat": np.int32,
+    "position": np.int16,
+    "deviation": np.float32,
+    "tempo": np.float32,
+    "score_tempo": np.float32,
+}
+
+
+def get_ioi_deviations(midi_score_beats, performance_beats):
+    """
+    Deviation of the performed IOIs from the score IOIs
+
+    Args:
+        midi_score_beats: list of annotated beats in the score
+        performance_beats: list of corresponding performed beats
+
+    Returns:
+        deviations: array of n_beats - 1 deviations [%], relative to the
+                    score IOIs scaled to the mean tempo of the performance
+        tempos, score_tempos: arrays of n_beats - 1 tempos [bpm]
+    """
+    score_iois = np.diff(np.asarray(midi_score_beats, dtype=np.float64))
+    performed_iois = np.diff(np.asarray(performance_beats, dtype=np.float64))
+    mean_ratio = performed_iois.sum() / score_iois.sum()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        deviations = 100 * (performed_iois / (score_iois * mean_ratio) - 1)
+        return deviations, 60 / performed_iois, 60 / score_iois
+
+
+def extract_ioi_features(json_data, composers=None):
+    """
+    IOI features of every annotated performance
+
+    Args:
+        json_data: dict with ASAP annotations
+        composers: list of composers to keep (None for all)
+
+    Returns:
+        features: dict of columns (see COLUMNS) and of composer_names,
+                  piece_names, performance_names and piece_starts
+    """
+    columns = {name: [] for name in COLUMNS}
+    composer_names, piece_names, performance_names = [], [], []
+    for performance_path in sorted(json_data):
+        composer = performance_path.split("/")[0]
+        piece = performance_path.rsplit("/", 1)[0]
+        if composers is not None and composer not in composers:
+            continue
+        if any(path in performance_path for path in BROKEN_ANNOTATIONS):
+            continue
+        annotation = json_data[performance_path]
+        midi_score_beats = annotation["midi_score_beats"]
+        if len(midi_score_beats) < 2 or len(midi_score_beats) != len(
+            annotation["performance_beats"]
+        ):
+            logger.warning("skipping %s, its beats are not aligned", performance_path)
+            continue
+
+        deviations, tempos, score_tempos = get_ioi_deviations(
+            midi_score_beats, annotation["performance_beats"]
+        )
+        positions = get_metrical_positions(
+            midi_score_beats, annotation["midi_score_downbeats"]
+        )[:-1]
+        # merged or unordered beats have no tempo
+        valid = np.isfinite(tempos) & np.isfinite(score_tempos) & (tempos > 0)
+        valid &= score_tempos > 0
+
+        if not composer_names or composer_names[-1] != composer:
+            composer_names.append(composer)
+        if not piece_names or piece_names[-1] != piece:
+            piece_names.append(piece)
+        performance_names.append(performance_path)
+        n_rows = int(valid.sum())
+        columns["composer"].append(np.full(n_rows, len(composer_names) - 1))
+        columns["piece"].append(np.full(n_rows, len(piece_names) - 1))
+        columns["performance"].append(np.full(n_rows, len(performance_names) - 1))
+        columns["beat"].append(np.flatnonzero(valid))
+        columns["position"].append(positions[valid])
+        columns["deviation"].append(deviations[valid])
+        columns["tempo"].append(tempos[valid])
+        columns["score_tempo"].append(score_tempos[valid])
+
+    features = {
+        name: np.concatenate(values or [[]]).astype(dtype)
+        for (name, values), dtype in zip(columns.items(), COLUMNS.values())
+    }
+    features["composer_names"] = np.array(composer_names, dtype=str)
+    features["piece_names"] = np.array(piece_names, dtype=str)
+    features["performance_names"] = np.array(performance_names, dtype=str)
+    features["piece_starts"] = np.searchsorted(
+        features["piece"], np.arange(len(piece_names) + 1)
+    )
+    return features
+
+
+def build_ioi_features(json_data=None, composers=None, path=FEATURES_PATH):
+    """
+    Extract the IOI features of the corpus and store them in path
+
+    Args:
+        json_data: dict with ASAP annotations (loaded if None)
+        composers: list of composers to keep (None for all)
+        path: output .npz file
+
+    Returns:
+        features: see extract_ioi_features
+    """
+    if json_data is None:
+        json_data = get_annotations()
+        if json_data is None:
+            raise FileNotFoundError("The ASAP annotations are not available")
+    features = extract_ioi_features(json_data, composers)
+    path = Path(path)
+    path.parent.mkdir(exist_ok=True, parents=True)
+    np.savez(path, **features)
+    logger.info(
+        "stored %d IOIs of %d performances in %s",
+        len(features["deviation"]),
+        len(features["performance_names"]),
+        path,
+    )
+    return features
+
+
+def load_ioi_features(composers=None, pieces=None, positions=None, path=FEATURES_PATH):
+    """
+    Read a slice of the IOI feature store, built first if it does not exist
+
+    Args:
+        composers: list of composers to keep (None for all)
+        pieces: list of piece paths (e.g. "Schubert/Impromptu_op.90_D.899/3")
+                to keep (None for all)
+        positions: list of metrical positions to keep (None for all)
+        path: .npz file of the store
+
+    Returns:
+        features: dict of the columns of the selected rows (see COLUMNS),
+                  whose codes index the *_names arrays of the store
+    """
+    path = Path(path)
+    if not path.exists():
+        build_ioi_features(path=path)
+    with np.load(path) as store:
+        features = {name: store[name] for name in store.files}
+
+    piece_starts = features.pop("piece_starts")
+    rows = np.arange(len(features["piece"]))
+    if pieces is not None:
+        codes = np.flatnonzero(np.isin(features["piece_names"], pieces))
+        rows = np.concatenate(
+            [rows[piece_starts[code] : piece_starts[code + 1]] for code in codes]
+            or [rows[:0]]
+        )
+    if composers is not None:
+        codes = np.flatnonzero(np.isin(features["composer_names"], composers))
+        rows = rows[np.isin(features["composer"][rows], codes)]
+    if positions is not None:
+        rows = rows[np.isin(features["position"][rows], positions)]
+    for name in COLUMNS:
+        features[name] = features[name][rows]
+    return features
+
+
+def get_violin_dataframe(features):
+    """DataFrame of the IOI deviations per beat of the measure, see plot_violins"""
+    import pandas as pd
+
+    return pd.DataFrame(
+        {
+            "Beat": features["position"].astype(np.int64) + 1,
+            "Deviation": features["deviation"],
+        }
+    )
+
+
+def get_position_statistics(features, column="deviation"):
+    """
+    Mean and variance of a column at every metrical position, computed per
+    performance and averaged over the performances (as Estimator.fit does)
+
+    Returns:
+        means, variances: arrays indexed by metrical position, NaN for
+                          positions without any beat
+    """
+    performances, performance_index = np.unique(
+        features["performance"], return_inverse=True
+    )
+    n_positions = int(features["position"].max()) + 1 if len(performances) else 0
+    groups = performance_index * n_positions + features["position"]
+    size = len(performances) * n_positions
+    values = features[column].astype(np.float64)
+    counts = np.bincount(groups, minlength=size)
+    sums = np.bincount(groups, weights=values, minlength=size)
+    squares = np.bincount(groups, weights=values**2, minlength=size)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+        variances = squares / counts - means**2
+    means = means.reshape(len(performances), n_positions)
+    variances = variances.reshape(len(performances), n_positions)
+    with np.errstate(invalid="ignore"):
+        return np.nanmean(means, axis=0), np.nanmean(variances, axis=0)
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(
+        description="Extract the IOI deviations of all annotated performances"
+    )
+    args.add_argument(
+        "-c",
+        "--composer",
+        default=None,
+        nargs="+",
+        type=str,
+        help="Only extract the performances of these composers (default: all)",
+    )
+    args.add_argument(
+        "--output",
+        default=str(FEATURES_PATH),
+        type=str,
+        help="Output .npz file (default: data/features/ioi_deviations.npz)",
+    )
+    args.add_argument(
+        "--log_level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        type=str,
+        help="Logging level (default: INFO)",
+    )
+    args = args.parse_args()
+    setup_logging(args.log_level)
+    build_ioi_features(composers=args.composer, path=args.output)
@@ -0,0 +1,132 @@
+import json
+import logging
+import resource
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# active profiler, None when profiling is disabled
+_profiler = None
+
+
+class Profiler:
+    """
+    Records wall time, note counts and peak memory of the generation stages.
+    The report is written in the Chrome trace event format (readable by
+    chrome://tracing, Perfetto or speedscope), with a per-stage summary.
+    """
+
+    def __init__(self):
+        self.records = []
+        self.origin = time.perf_counter()
+        self.peaks = []  # running peak memory of the open (nested) stages
+        tracemalloc.start()
+
+    @contextmanager
+    def stage(self, name):
+        record = {"name": name, "depth": len(self.peaks), "notes": None}
+        if self.peaks:
+            self.peaks[-1] = max(self.peaks[-1], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        self.peaks.append(0)
+        start = time.perf_counter()
+        try:
+            yield record
+        finally:
+            end = time.perf_counter()
+            peak = max(self.peaks.pop(), tracemalloc.get_traced_memory()[1])
+            if self.peaks:
+                self.peaks[-1] = max(self.peaks[-1], peak)
+            record["start"] = start - self.origin
+            record["wall_time"] = end - start
+            record["peak_memory"] = peak
+            self.records.append(record)
+            notes = "" if record["notes"] is None else f", {record['notes']} notes"
+            logger.info(
+                "stage %s: %.3fs%s, peak memory %.1f MB",
+                name,
+                record["wall_time"],
+                notes,
+                record["peak_memory"] / 2**20,
+            )
+
+    def report(self):
+        trace_events = [
+            {
+                "name": record["name"],
+                "ph": "X",
+                "ts": record["start"] * 1e6,
+                "dur": record["wall_time"] * 1e6,
+                "pid": 0,
+                "tid": 0,
+                "args": {
+                    "notes": record["notes"],
+                    "peak_memory": record["peak_memory"],
+                },
+            }
+            for record in self.records
+        ]
+        stages = sorted(self.records, key=lambda record: record["start"])
+        return {
+            "traceEvents": trace_events,
+            "displayTimeUnit": "ms",
+            "stages": stages,
+            "peak_rss": get_peak_rss(),
+        }
+
+    def write(self, path):
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+        logger.info("profile written to %s", path)
+
+
+def get_peak_rss():
+    """Peak resident memory of the process so far, in bytes"""
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def enable_profiling():
+    global _profiler
+    _profiler = Profiler()
+    return _profiler
+
+
+def get_profiler():
+    return _profiler
+
+
+@contextmanager
+def stage(name):
+    """
+    Profile a stage if profiling is enabled, does nothing otherwise.
+    Yields a record dict (or None) in which the note count can be stored.
+    """
+    if _profiler is None:
+        yield None
+        return
+    with _profiler.stage(name) as record:
+        yield record
+
+
+def count_notes(value):
+    """Number of notes in a note array, PrettyMIDI object or music21 stream"""
+    if hasattr(value, "dtype") and value.dtype.names and "pitch" in value.dtype.names:
+        return len(value)
+    if hasattr(value, "instruments"):
+        return sum(len(instrument.notes) for instrument in value.instruments)
+    # music21 is only imported by the passes using it, see pipeline.is_stream
+    music21 = sys.modules.get("music21")
+    if music21 is not None and isinstance(value, music21.stream.Stream):
+        return len(value.flatten().notes)
+    return None
+
+
+def setup_logging(level="INFO"):
+    logging.basicConfig(
+        level=getattr(logging, level.upper()),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
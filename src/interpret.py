@@ -1,20 +1,49 @@
-import random
+import copy
+import io
+import logging
 from collections import defaultdict
 from fractions import Fraction
+from pathlib import Path
 
 import music21
 import numpy as np
 import pretty_midi
 
-from src.data import ROOT_PATH
+from src.alignment import get_alignment, get_performance_annotation
+from src.data import ANNOTATIONS_PATH, ROOT_PATH, get_annotations
+from src.instrumentation import get_peak_rss
+from src.note_array import (
+    get_quarter_positions,
+    load_notes,
+    load_notes_parallel,
+    notes_from_pretty_midi,
+    set_pretty_midi_notes,
+)
+from src.pipeline import PIPELINE_CACHE_PATH, Pipeline, register_pass
+from src.tempo_curves import get_tempo_curves
+from src.velocity_profiles import apply_velocity_profile, get_velocity_profile
+
+logger = logging.getLogger(__name__)
 
 # taken from music21
 DEFAULT_VELOCITY = 30
+# base velocity before the first dynamic mark
+DEFAULT_DYNAMIC_VELOCITY = 127 * 0.25
+# base velocity change at the end of a crescendo/diminuendo
+WEDGE_VELOCITY_CHANGE = 127 * 0.1
+# tempo of the beats whose fractions are the onset deviations of humanize_notes
+HUMANIZE_BPM = 125
+# lowest tempo sampled from learned tempo curves [quarters per minute]
+MIN_TEMPO = 10
+# bound of the tempo level of a performance drawn from the learned curves [stds]
+MAX_TEMPO_LEVEL = 2
+# seeded stages, each drawing from its own stream of the seed (see get_stage_rngs)
+SEEDED_STAGES = ("onset", "duration", "velocity", "tempo")
 
 
 def is_left_hand(element):
     for i in range(6):
-        print(element)
+        logger.debug("%s", element)
         element = element.activeSite
         if element is None:
             return
@@ -42,7 +71,7 @@ def bell_curve_loop_6(i):
     return -(pos_in_motif**2) + 5 * pos_in_motif
 
 
-def bell_curve_velocity(element, offset):
+def bell_curve_velocity(element, offset, amplitude=0.8):
     bell_curve = bell_curve_loop_6(offset * 3)
 
     # velocity manipulation
@@ -53,21 +82,25 @@ def bell_curve_velocity(element, offset):
         # I do this because the accompaniment seems to loud on the unperformed midi
         # v -= 10  # think if we need this
         # the 6 8th note motif's velocities form a clear bell curve in many recordings
-        velocity_increase = 0.8 * bell_curve
+        velocity_increase = amplitude * bell_curve
         element.volume.velocity = v + velocity_increase
 
 
-def idea_4(score: music21.stream.Score):
+def idea_4(score: music21.stream.Score, bell_amplitude=0.8):
     """
     Add an ascending bell curve shape to velocity
     and speed for accompaniment right-hand 8th notes
+
+    Args:
+        bell_amplitude: velocity increase per unit of the bell curve
+                        (the top of the curve is 6 units)
     """
-    print("start idea4")
+    logger.debug("start idea4")
     for element in score.recurse():
         if is_rh_accompaniement_xml(element):
             # offset = flat_notes.elementOffset(element)
             offset = element.offset
-            bell_curve_velocity(element, offset)
+            bell_curve_velocity(element, offset, bell_amplitude)
 
     # for part in score.parts:
     #     for measure in part.getElementsByClass("Measure"):
@@ -76,38 +109,149 @@ def idea_4(score: music21.stream.Score):
     #                 offset = element.offset # Offset in measure => we insert the tempo mark in measure
     #                 bell_curve_velocity(element, offset)
 
-    print("end idea4")
+    logger.debug("end idea4")
+
+
+def draw_beat_tempos(tempo_curves, rng):
+    """
+    Tempo curve of one performance, drawn from learned tempo curves: the
+    mean curve shifted by a random number of standard deviations (the
+    first draw of rng), so that the whole performance is faster or slower
+
+    Args:
+        tempo_curves: learned curves, see src/tempo_curves.py
+        rng: np.random.Generator of the tempo noise
+
+    Returns:
+        beat_tempos: (quarters, tempos, jitters) of the beats, see sample_tempo_slots
+    """
+    level = np.clip(rng.standard_normal(), -MAX_TEMPO_LEVEL, MAX_TEMPO_LEVEL)
+    tempos = tempo_curves["means"] + level * tempo_curves["stds"]
+    return tempo_curves["quarters"], tempos, tempo_curves["jitters"]
 
 
-def add_tempo_changes(score: music21.stream.Score):
-    measure_count = len(score.parts[0].getElementsByClass("Measure"))
-    # iterate through all 8th note emplacements (24 per measure)
+def sample_tempo_slots(i, rng, beat_tempos=None, slot_length=Fraction(1, 3)):
+    """
+    Tempo (in bpm) of the 8th note emplacements (1/3 of a quarter) of indices i.
+    The noise is drawn from rng in the order of i, so sampling consecutive
+    ranges of emplacements gives the same curve as sampling them at once.
+
+    Args:
+        i: np.ndarray of int emplacement indices
+        rng: np.random.Generator of the tempo noise
+        beat_tempos: tempo curve drawn by draw_beat_tempos, which gives the
+                     tempo of the beat of every emplacement, with a noise of
+                     the jitter of the beat (None for the hand-coded curve)
+        slot_length: length of the emplacements (in quarters)
+
+    Returns:
+        tempos: np.ndarray of shape i.shape
+    """
+    if beat_tempos is not None:
+        quarters, tempos, jitters = beat_tempos
+        slot_length = float(slot_length)
+        index = np.searchsorted(quarters, (i + 0.5) * slot_length, side="right") - 1
+        index = np.clip(index, 0, len(tempos) - 1)
+        # the noise of the emplacements of a beat averages out over the beat,
+        # scale it so that the beat keeps the jitter of the performers
+        n_slots = np.maximum(np.diff(quarters)[index] / slot_length, 1)
+        noise = jitters[index] * np.sqrt(n_slots) * rng.standard_normal(len(i))
+        return np.maximum(tempos[index] + noise, MIN_TEMPO)
+
     # idea: add some smoothing to the tempo, some momentum (using previous tempos, lerp or smtg)
-    for i in range(measure_count * 24):
-        offset = Fraction(i, 3)
-        base_tempo = 120
-        t2 = base_tempo + 3 * bell_curve_loop_6(i)
-        t2 += np.random.normal(0, 5)  # maybe delete
-
-        if i % 48 == 46:
-            t2 -= 5
-        if i % 48 == 27:
-            t2 -= 40
-        # if i == 84 * 24:
-        #     t2 -= 40
-
-        # if (offset * 3) % 24 == 23:  # if we're in the beat just before
-        #    # I do this to delay each beat after the last of th 6 8th note,
-        #    # as can be clearly heard in Kociuban's performance
-        #    # But actually, it's not each beat, it's just before the melody.
-        #    # If we can detect the melody, we can do it automatically
-        #    t2 = base_tempo - 15
-
-        # setting the new tempo at that offset
-        m = music21.tempo.MetronomeMark(number=t2)
-        m.offset = offset
-        # print(f"inserting tempo change {m} ({t2}) at offset {m.offset}")
-        score.insert(offset, m)
+    base_tempo = 120
+    tempos = base_tempo + 3 * bell_curve_loop_6(i)
+    tempos = tempos + rng.normal(0, 5, len(i))  # maybe delete
+
+    tempos[i % 48 == 46] -= 5
+    tempos[i % 48 == 27] -= 40
+    # if i == 84 * 24:
+    #     t2 -= 40
+
+    # if (offset * 3) % 24 == 23:  # if we're in the beat just before
+    #    # I do this to delay each beat after the last of th 6 8th note,
+    #    # as can be clearly heard in Kociuban's performance
+    #    # But actually, it's not each beat, it's just before the melody.
+    #    # If we can detect the melody, we can do it automatically
+    #    t2 = base_tempo - 15
+    return tempos
+
+
+def get_stage_rngs(seed=None):
+    """
+    Independent random generators of the SEEDED_STAGES, by stage, so that the
+    velocity noise, the tempo curve and the humanization of a seed do not
+    share their draws. Streaming and editing take their draws from here too.
+    """
+    stage_seeds = np.random.SeedSequence(seed).spawn(len(SEEDED_STAGES))
+    return {
+        stage: np.random.default_rng(stage_seed)
+        for stage, stage_seed in zip(SEEDED_STAGES, stage_seeds)
+    }
+
+
+def get_tempo_curve(n_slots, seed=None, tempo_curves=None, slot_length=Fraction(1, 3)):
+    """
+    Tempo (in bpm) of every 8th note emplacement (1/3 of a quarter)
+
+    Args:
+        n_slots: int number of emplacements
+        seed: int seed of the tempo noise
+        tempo_curves: learned curves to sample from, see src/tempo_curves.py
+                      (None for the hand-coded curve)
+        slot_length: length of the emplacements (in quarters)
+
+    Returns:
+        tempos: np.ndarray of shape (n_slots,)
+    """
+    rng = get_stage_rngs(seed)["tempo"]
+    beat_tempos = None
+    if tempo_curves is not None:
+        beat_tempos = draw_beat_tempos(tempo_curves, rng)
+    return sample_tempo_slots(np.arange(n_slots), rng, beat_tempos, slot_length)
+
+
+def warp_to_tempo_curve(
+    quarters, tempos, slot_length=Fraction(1, 3), slot_starts=None, first_slot=0
+):
+    """
+    Performance time of score positions (in quarters), playing every slot
+    of slot_length quarters at its tempo (the last one continues after the end)
+
+    A window of the curve can be given instead of the whole curve: tempos and
+    slot_starts (performance times) of the slots from first_slot on.
+    """
+    slot_length = float(slot_length)
+    if slot_starts is None:
+        slot_durations = slot_length * 60 / tempos
+        slot_starts = np.concatenate(([0.0], np.cumsum(slot_durations)[:-1]))
+    slot = np.clip(
+        (quarters // slot_length).astype(np.int64),
+        first_slot,
+        first_slot + len(tempos) - 1,
+    )
+    index = slot - first_slot
+    return slot_starts[index] + (quarters - slot * slot_length) * 60 / tempos[index]
+
+
+def add_tempo_changes(midi_data, seed=None, tempo_curves=None):
+    """
+    Play the rendered score with the tempo curve of get_tempo_curve, sampled
+    from tempo_curves if given (see src/tempo_curves.py).
+    Note times are converted to score positions with the tempo map of the
+    rendering, then warped (in place).
+    """
+    notes = notes_from_pretty_midi(midi_data)
+    if len(notes) == 0:
+        return
+    start_quarters = get_quarter_positions(midi_data, notes["start"])
+    end_quarters = get_quarter_positions(midi_data, notes["end"])
+    # iterate through all 8th note emplacements
+    n_slots = int(np.ceil(end_quarters.max() * 3)) + 1
+    tempos = get_tempo_curve(n_slots, seed, tempo_curves)
+    notes["start"] = warp_to_tempo_curve(start_quarters, tempos)
+    notes["end"] = warp_to_tempo_curve(end_quarters, tempos)
+    set_pretty_midi_notes(midi_data, notes)
 
 
 def set_tempis(score):
@@ -128,258 +272,286 @@ def get_tempo_at_offset(score, offset):
 
 def iterate_over_dynamics(score):
     for event in score.flat.getElementsByClass(music21.dynamics.Dynamic):
-        print("event", event, event.offset)
+        logger.debug("event %s %s", event, event.offset)
+
+
+def get_dynamics_curve(dynamics_timeline: tuple, transition_window=4.0):
+    """
+    Continuous piecewise-linear dynamics curve: constant at the level of each
+    dynamic mark, then ramping linearly to the next one over the last
+    transition_window quarter notes before it (over the span of the wedge
+    for the changes of wedges)
+
+    Returns:
+        xp, fp: curve points to be evaluated with np.interp
+    """
+    offsets, velocities, ramps = dynamics_timeline
+    ramps = np.where(np.isnan(ramps[1:]), transition_window, ramps[1:])
+    ramp_starts = np.maximum(offsets[1:] - ramps, offsets[:-1])
+    xp = np.stack([ramp_starts, offsets[1:]], axis=1).ravel()
+    fp = np.stack([velocities[:-1], velocities[1:]], axis=1).ravel()
+    return np.concatenate(([offsets[0]], xp)), np.concatenate(([velocities[0]], fp))
 
 
-def idea_12(score):
+def idea_12(score, dynamics_timeline: tuple, transition_window=4.0):
     """
     Add smooth transition between volume marks (ex. p and pp)
 
-    Function finds all dynamic marks. Then in linearly descreases/
-    increases velocity, so the REAL output volume transition is smooth.
-    Change happens if distance to transition is less or equal half of a
-    measure
+    Notes closer than transition_window (in quarter notes, half of a
+    4/2 measure by default) to the next dynamic mark are crossfaded
+    towards it, so the REAL output volume transition is smooth.
+    This is done by rescaling each velocity by the ratio between the
+    continuous dynamics curve and the base velocity at the note offset.
+    """
+    timeline_offsets, timeline_velocities, _ = dynamics_timeline
+    xp, fp = get_dynamics_curve(dynamics_timeline, transition_window)
+
+    for part in score.parts:
+        notes, offsets, _ = get_part_notes(part)
+        base = timeline_velocities[
+            np.searchsorted(timeline_offsets, offsets, side="right") - 1
+        ]
+        # notes at a zero base velocity keep their velocity
+        with np.errstate(invalid="ignore", divide="ignore"):
+            ratio = np.where(base > 0, np.interp(offsets, xp, fp) / base, 1.0)
+        for element, r in zip(notes, ratio):
+            element.volume.velocity = element.volume.velocity * r
+
+
+def idea_13(unperformed_notes, performed_notes, matches):
     """
-    offsets_in_measure = 8  # time_signature = 4/2
+    Velocity statistics of the performed notes, grouped by the velocity
+    of the score note they are aligned to (this is to divide notes
+    according to dynamics information in the score: pp, p, f, etc.)
+
+    Args:
+        unperformed_notes: note array of the unperformed MIDI
+        performed_notes: note array of the performed MIDI
+        matches: (k, 2) array of aligned (unperformed, performed) note indices
+
+    Returns:
+        avg_vel: dict unperformed velocity -> mean performed velocity
+        std_vel: dict unperformed velocity -> std of performed velocity
+    """
+    unperf_vel = unperformed_notes["velocity"][matches[:, 0]].astype(np.int64)
+    perf_vel = performed_notes["velocity"][matches[:, 1]].astype(np.float64)
 
-    # get all dynamics in piece
-    dynamics_offsets = []
-    dynamics = []
-    for element in score.recurse():
-        if isinstance(element, music21.dynamics.Dynamic):
-            measure = element.activeSite
-            global_offset = element.offset + measure.offset
-            dynamics_offsets.append(global_offset)
-            dynamics.append(element)
+    counts = np.bincount(unperf_vel, minlength=128)
+    sums = np.bincount(unperf_vel, weights=perf_vel, minlength=128)
+    squares = np.bincount(unperf_vel, weights=perf_vel**2, minlength=128)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+        stds = np.sqrt(np.maximum(squares / counts - means**2, 0))
 
-    # if dynamics_offset - note_offset <= offsets_in_measure / 2
-    # decay/increase velocity
+    # velocities without any aligned note get nan statistics
+    velocities = np.unique(unperformed_notes["velocity"])
+    avg_vel = {int(vel): means[vel] for vel in velocities}
+    std_vel = {int(vel): stds[vel] for vel in velocities}
 
-    dynamics_index = 0
-    out_of_range = False
-    for element in score.recurse():
-        if out_of_range:
-            break
-        if isinstance(element, music21.note.Note):
-            measure = element.activeSite
-            if isinstance(measure, music21.stream.Voice):
-                measure = measure.activeSite
-            global_offset = element.offset + measure.offset
+    return avg_vel, std_vel
 
-            dynamic_offset = dynamics_offsets[dynamics_index]
-            dynamic = dynamics[dynamics_index]
 
-            # look at next dynamic if note is after current dynamic
+def build_velocity_table(avgs, stds):
+    """
+    Dense velocity -> (mean, std) lookup table built from idea_13 statistics
 
-            while global_offset >= dynamic_offset:
-                dynamics_index += 1
-                if dynamics_index >= len(dynamics_offsets):
-                    out_of_range = True
-                    break
-                dynamic_offset = dynamics_offsets[dynamics_index]
-                dynamic = dynamics[dynamics_index]
+    Velocities without usable statistics are linearly interpolated from the
+    closest known ones (and take the value of the closest one outside their
+    range). If no velocity has usable statistics, the mean falls back to the
+    velocity itself and the std to 0 (no noise).
 
-            if out_of_range:
-                break
+    Returns:
+        table: (128, 2) array, table[v] = (mean, std) for velocity v
+    """
+    all_velocities = np.arange(128)
+    table = np.stack([all_velocities, np.zeros(128)], axis=1).astype(np.float64)
+    for column, stats in enumerate([avgs, stds]):
+        known = sorted((k, v) for k, v in stats.items() if not np.isnan(v))
+        if len(known) == 0:
+            continue
+        velocities, values = zip(*known)
+        table[:, column] = np.interp(all_velocities, velocities, values)
+    return table
 
-            if dynamic_offset - global_offset <= offsets_in_measure / 2:
-                note_context = element.volume.getDynamicContext()
-                old_velocity = element.volume.velocity
 
-                dynamic_ratio = dynamic.volumeScalar / note_context.volumeScalar
+def get_noisy_velocities(velocities, table, rescaling_factor, noise):
+    """
+    Velocities with gaussian noise
 
-                new_velocity = dynamic_ratio * old_velocity
+    Args:
+        velocities: np.ndarray of velocities in 0..127
+        table: velocity -> (mean, std) table, see build_velocity_table
+        rescaling_factor: the std of the noise is divided by it
+        noise: np.ndarray of standard normal draws, one per velocity
 
-                offset_ratio = (dynamic_offset - global_offset) / (
-                    offsets_in_measure / 2
-                )
+    Returns:
+        velocities: np.ndarray of int velocities in 1..127
+    """
+    std = table[np.clip(velocities, 0, 127).astype(np.int64), 1]
+    new_velocities = velocities.astype(np.float64) + std / rescaling_factor * noise
+    # velocity 0 would be a note off
+    return np.clip(np.rint(new_velocities), 1, 127)
 
-                new_velocity = (
-                    offset_ratio * old_velocity + (1 - offset_ratio) * new_velocity
-                )
 
-                element.volume.velocity = new_velocity
+def add_velocity_noise(notes, table, rescaling_factor, rng):
+    """
+    Velocities of a note array with the noise of apply_idea_13, drawn from
+    rng in the order of the notes (see get_noisy_velocities)
+    """
+    noise = rng.standard_normal(len(notes))
+    return get_noisy_velocities(notes["velocity"], table, rescaling_factor, noise)
+
+
+def apply_idea_13(midi_data, avgs, stds, rescaling_factor=10, seed=None):
+    """
+    Add gaussian noise to the velocities of the rendered score (in place),
+    with a std depending on the velocity as observed in the performances
+    (see idea_13)
+    """
+    table = build_velocity_table(avgs, stds)
+    notes = notes_from_pretty_midi(midi_data)
+    rng = get_stage_rngs(seed)["velocity"]
+    notes["velocity"] = add_velocity_noise(notes, table, rescaling_factor, rng)
+    set_pretty_midi_notes(midi_data, notes)
+
 
+def add_velocity_profile(midi_data, profile, amplitude=1.0):
+    """
+    Add the velocity offsets of a learned profile (see
+    src/velocity_profiles.py) to the notes of the rendered score (in place).
+    It replaces the hand-coded bell curve of idea_4.
 
-def idea_13(unperformed_midi, performed_midi):
-    # Extract notes from MIDI
-    unperf_notes = (
-        unperformed_midi.instruments[0].notes + unperformed_midi.instruments[1].notes
+    Args:
+        profile: velocity offsets per voice and metrical sub-position
+        amplitude: factor of the offsets
+    """
+    notes = notes_from_pretty_midi(midi_data)
+    notes["velocity"] = apply_velocity_profile(
+        notes, profile, midi_data.get_beats(), midi_data.get_downbeats(), amplitude
     )
-    perf_notes = performed_midi.instruments[0].notes
-
-    # Obtain list of pitches and of (unperformed) velocities
-    pitches = set([note.pitch for note in unperf_notes])
-    velocities = list(set([note.velocity for note in unperf_notes]))
-
-    # Construct dictionaries of performed and unperformed notes divided according to pitch
-    perf_dict = dict()
-    unperf_dict = dict()
-    for pitch in pitches:
-        perf_dict[pitch] = sorted(
-            [note for note in perf_notes if note.pitch == pitch], key=lambda x: x.start
-        )
-        unperf_dict[pitch] = sorted(
-            [note for note in unperf_notes if note.pitch == pitch],
-            key=lambda x: x.start,
+    set_pretty_midi_notes(midi_data, notes)
+
+
+def get_dynamics_timeline(score: music21.stream.Score, part: music21.stream.Part):
+    """
+    Base velocity timeline given by the dynamic marks of a part
+
+    Dynamic marks set the base velocity from their offset on. Wedges change
+    it by WEDGE_VELOCITY_CHANGE at the end of their span (up for a crescendo,
+    down for a diminuendo), unless a dynamic mark comes at the same time.
+    The dynamics curve reaches the changes of wedges along their whole span,
+    see get_dynamics_curve.
+
+    Returns:
+        offsets: sorted np.ndarray of offsets (in quarter notes) where the
+                 base velocity changes, starting at 0
+        velocities: np.ndarray, velocities[k] is the base velocity from
+                    offsets[k] until offsets[k + 1]
+        ramps: np.ndarray, ramps[k] is the span (in quarter notes) of the
+               wedge ending at offsets[k], nan if there is none
+    """
+    events = []  # (offset, priority, value, span), wedges first when simultaneous
+    for element in part.recurse().getElementsByClass(music21.dynamics.Dynamic):
+        events.append(
+            (
+                float(element.getOffsetInHierarchy(score)),
+                1,
+                127 * element.volumeScalar,
+                np.nan,
+            )
         )
+    for wedge in score.recurse().getElementsByClass(music21.dynamics.DynamicWedge):
+        first, last = wedge.getFirst(), wedge.getLast()
+        if first is None or first.getContextByClass(music21.stream.Part) is not part:
+            continue
+        start = float(first.getOffsetInHierarchy(score))
+        end = float(last.getOffsetInHierarchy(score) + last.duration.quarterLength)
+        if isinstance(wedge, music21.dynamics.Crescendo):
+            events.append((end, 0, WEDGE_VELOCITY_CHANGE, end - start))
+        elif isinstance(wedge, music21.dynamics.Diminuendo):
+            events.append((end, 0, -WEDGE_VELOCITY_CHANGE, end - start))
+    events.sort(key=lambda event: event[:2])
+
+    offsets = [0.0]
+    velocities = [DEFAULT_DYNAMIC_VELOCITY]
+    ramps = [np.nan]
+    for offset, priority, value, span in events:
+        if priority == 1:  # dynamic mark: absolute velocity
+            velocity = value
+        else:  # wedge: relative to the current velocity
+            # velocity 0 would be a note off
+            velocity = min(127, max(1, velocities[-1] + value))
+        if offset == offsets[-1]:
+            velocities[-1] = velocity
+            # a mark at the end of a wedge is reached along the wedge
+            if priority == 0:
+                ramps[-1] = span
+        else:
+            offsets.append(offset)
+            velocities.append(velocity)
+            ramps.append(span)
 
-    # Construct dictionary of performed notes divided according to their unperformed velocity
-    # (this is to divide notes according to dynamics information in the score: pp, p, f, etc.)
-    notes = {k: [] for k in velocities}
-    for vel in velocities:
-        for pitch in pitches:
-            if len(perf_dict[pitch]) > len(unperf_dict[pitch]):
-                notes[vel].extend(
-                    [
-                        unperf_dict[pitch][i]
-                        for i in range(len(unperf_dict[pitch]))
-                        if perf_dict[pitch][i].velocity == vel
-                    ]
-                )
-            else:
-                notes[vel].extend(
-                    [
-                        unperf_dict[pitch][i]
-                        for i in range(len(perf_dict[pitch]))
-                        if perf_dict[pitch][i].velocity == vel
-                    ]
-                )
+    return np.array(offsets), np.array(velocities), np.array(ramps)
 
-    # Compute mean and standard deviation of notes depending on their unperformed velocity
-    avg_vel = {
-        vel: np.mean([note.velocity for note in notes[vel]]) for vel in velocities
-    }
-    std_vel = {
-        vel: np.std([note.velocity for note in notes[vel]]) for vel in velocities
-    }
 
-    return avg_vel, std_vel
+def get_part_notes(part: music21.stream.Part):
+    """
+    Returns:
+        notes: list of notes and chords of the part, in offset order
+        offsets: np.ndarray of their offsets in the part
+        durations: np.ndarray of their durations (in quarter notes)
+    """
+    flat = part.flatten()
+    notes = list(flat.notes)
+    offsets = np.array([float(flat.elementOffset(n)) for n in notes])
+    durations = np.array([float(n.duration.quarterLength) for n in notes])
+    return notes, offsets, durations
 
 
-def apply_idea_13(score, avgs, stds, rescaling_factor=10):
-    for note in score.recurse().notes:
-        print("new note")
-        try:
-            std = stds[note.volume.velocity]
-        except:
-            # can't find the velocity: search around the velocity
-            i = 1
-            while True:
-                if note.volume.velocity + i in stds and not np.isnan(
-                    stds[note.volume.velocity + i]
-                ):
-                    std = stds[note.volume.velocity + i]
-                    break
-                if note.volume.velocity - i in stds and not np.isnan(
-                    stds[note.volume.velocity - i]
-                ):
-                    std = stds[note.volume.velocity - i]
-                    break
-                i += 1
-                print(i)
-        new_vel = note.volume.velocity + np.random.normal(0, std / rescaling_factor)
-        note.volume.velocity = min(127, max(0, new_vel))
-    print("returning")
+def get_voice_highlighting(durations, is_melody_part):
+    """
+    Factor of the base velocity of notes, given their durations (in quarter
+    notes): right hand accompaniment < left hand chords < right hand melody
+    """
+    return np.where(np.isclose(durations, 1 / 3), 0.4, 0.9 if is_melody_part else 0.6)
 
 
 def overwrite_part_velocities(
-    score: music21.stream.Score, right_hand_dynamics: list[tuple], part: str
+    part: music21.stream.Part, dynamics_timeline: tuple, is_melody_part: bool
 ):
-    current_dynamic_index = 0
-    for element in score.recurse():
-        if isinstance(element, music21.note.Note) or isinstance(
-            element, music21.chord.Chord
-        ):
-            element_offset = element.getOffsetInHierarchy(score)
-
-            # do for one part, then repeat for another
-            if (
-                element.activeSite.activeSite.activeSite == score.parts[1]
-                and part != "1"
-            ):
-                continue  # skip this element
-
-            # update the current_dynamic_index
-            element_offset = element.getOffsetInHierarchy(score)
-            try:
-                if element_offset >= right_hand_dynamics[current_dynamic_index + 1][1]:
-                    print("incr index")
-                    current_dynamic_index += 1
-            except:
-                # nothing
-                print("nothing")
-            element.articulations.clear()
-
-            if element.duration.quarterLength == Fraction(1, 3):
-                # if it's the right hand accompaniment
-                voice_highlighting = 0.4
-            elif (
-                element.activeSite.activeSite.activeSite == score.parts[0]
-            ):  # if it's the right hand melody, highlight
-                voice_highlighting = 0.9
-            else:  # it's the left hand chords
-                voice_highlighting = 0.6
-            try:
-                element.volume.velocity = (
-                    right_hand_dynamics[current_dynamic_index][0] * voice_highlighting
-                )
-            except:
-                # print("l o r r : ", element.activeSite.activeSite == score.parts[0])
-                # print("index:", current_dynamic_index, " rhds:", len(right_hand_dynamics))
-                element.volume.velocity = (
-                    element.volume.getDynamicContext().volumeScalar * voice_highlighting
-                )
-                print("set at ", element.volume.velocity)
-            # if isinstance(element.activeSite.activeSite, music21.stream.Measure) and element.activeSite.activeSite.measureNumber in [6,7]:
-            # print("note:", element.duration, element.volume.velocity, element.volume.getRealized())
+    """
+    Set the velocity of every note of a part to the base velocity of the
+    dynamics timeline at its offset, scaled by its voice highlighting
+    """
+    notes, offsets, durations = get_part_notes(part)
+    timeline_offsets, timeline_velocities, _ = dynamics_timeline
 
+    # index of the last dynamic at or before each note
+    dynamic_index = np.searchsorted(timeline_offsets, offsets, side="right") - 1
 
-def overwrite_velocities(score: music21.stream.Score):
-    to_remove = []
-    right_hand_dynamics = [(127 * 0.25, 0)]
-    current_dynamic_index = -1
-    for element in score.recurse():
-        # print("elem", element)
-        if isinstance(element, music21.dynamics.Dynamic) or isinstance(
-            element, music21.dynamics.DynamicWedge
-        ):
-            to_remove.append(element)
-            print("removing")
-            if (
-                isinstance(element, music21.dynamics.Dynamic)
-                and element.activeSite.activeSite == score.parts[0]
-            ):
-                # if element.value != 'ppp':
-                print("appending!!!!!!!!!!!!!!!")
-                right_hand_dynamics.append(
-                    (127 * element.volumeScalar, element.getOffsetInHierarchy(score))
-                )
+    voice_highlighting = get_voice_highlighting(durations, is_melody_part)
+    velocities = timeline_velocities[dynamic_index] * voice_highlighting
 
-                print(
-                    "encountered at rh ",
-                    element.value,
-                    element.volumeScalar,
-                    "dynamic becomes",
-                    right_hand_dynamics[current_dynamic_index][0],
-                    right_hand_dynamics[current_dynamic_index][-1],
-                )
-                # else:
-                #    print("removed ppp at ", element.offset)
-            else:
-                print("element", element)
-                print("active site", element.activeSite.activeSite)
-    # note that score.recurse does not look on dynamics before the notes
-    # (some notes may be in loop before the dynamics in the same measure)
-    # so we use two for-loops instead of one
-    # the same problem occurs for parts, so we do them separately
-    overwrite_part_velocities(score, right_hand_dynamics, part="0")
-    overwrite_part_velocities(score, right_hand_dynamics, part="1")
-
-    print("smoothing via idea 12")
-    idea_12(score)
-
-    print("removing dynamics marks from score")
+    for element, velocity in zip(notes, velocities):
+        element.articulations.clear()
+        element.volume.velocity = velocity
+
+
+def overwrite_velocities(score: music21.stream.Score, transition_window=4.0):
+    # the right hand dynamics are used for both hands
+    dynamics_timeline = get_dynamics_timeline(score, score.parts[0])
+    for i, part in enumerate(score.parts):
+        overwrite_part_velocities(part, dynamics_timeline, is_melody_part=i == 0)
+
+    logger.info("smoothing via idea 12")
+    idea_12(score, dynamics_timeline, transition_window)
+
+    logger.info("removing dynamics marks from score")
+    to_remove = list(
+        score.recurse().getElementsByClass(
+            [music21.dynamics.Dynamic, music21.dynamics.DynamicWedge]
+        )
+    )
     for e in to_remove:
         e.activeSite.remove(e)
 
@@ -390,12 +562,16 @@ def set_default_velocity(score):
         if isinstance(element, music21.note.Note):
             is_left_hand(element)
             if element.volume.velocity is None:
-                print(f"found none note: duration={element.duration.quarterLength}")
+                logger.debug(
+                    "found none note: duration=%s", element.duration.quarterLength
+                )
                 # default volume from music21
                 element.volume.velocity = DEFAULT_VELOCITY
             else:
-                print(
-                    f"not none: {element.volume.velocity}, duration = {element.duration.quarterLength}"
+                logger.debug(
+                    "not none: %s, duration = %s",
+                    element.volume.velocity,
+                    element.duration.quarterLength,
                 )
 
 
@@ -417,42 +593,110 @@ def merge_hands(score: music21.stream.Score):
     return score
 
 
-def merge_hands_pm(midi_path):
-    midi_data = pretty_midi.PrettyMIDI(midi_path)
+def merge_hands_pm(midi_data):
+    """Merge the left hand instrument into the right hand one, in place"""
     left_hand = midi_data.instruments[1]
     right_hand = midi_data.instruments[0]
     right_hand.notes.extend(left_hand.notes)
     right_hand.control_changes.extend(left_hand.control_changes)
     midi_data.instruments.remove(left_hand)
-    midi_data.write(midi_path)
-    print("wrote at ", midi_path)
 
 
-def add_pedal(midi_path, save_path):
-    midi_data = pretty_midi.PrettyMIDI(midi_path)
-    left_hand = midi_data.instruments[1]
+def get_onset_features(notes, mode="onset"):
+    """
+    Onset times of the left hand and the feature compared by get_pedal_changes
+    at each of them (None in "onset" mode, every onset is a change)
+
+    Returns:
+        onset_times: sorted np.ndarray of unique onset times (in seconds)
+        features: np.ndarray of shape onset_times.shape or None
+    """
+    notes = notes[np.argsort(notes["start"], kind="stable")]
+    onset_times, first = np.unique(notes["start"], return_index=True)
+    if mode == "onset" or len(onset_times) == 0:
+        return onset_times, None
+
+    if mode == "bass":
+        features = np.minimum.reduceat(notes["pitch"], first)
+    elif mode == "harmony":
+        pitch_classes = np.left_shift(1, notes["pitch"].astype(np.int64) % 12)
+        features = np.bitwise_or.reduceat(pitch_classes, first)
+    else:
+        raise ValueError(f"Unknown pedal mode: {mode}")
+    return onset_times, features
+
+
+def get_pedal_changes(notes, mode="onset"):
+    """
+    Times at which the sustain pedal is changed
+
+    Args:
+        notes: note array of the left hand
+        mode: "onset" to re-pedal at every left hand onset, "bass" only when
+              the lowest pitch changes, "harmony" only when the set of
+              pitch classes changes
+
+    Returns:
+        change_times: sorted np.ndarray of unique change times (in seconds)
+    """
+    onset_times, features = get_onset_features(notes, mode)
+    if features is None:
+        return onset_times
+    changed = np.concatenate(([True], features[1:] != features[:-1]))
+    return onset_times[changed]
+
+
+def get_pedal_events(change_times, release_delay=0.01, press_delay=0.02):
+    """
+    CC-64 (time, value) pairs releasing and pressing the pedal again shortly
+    after each change time, unsorted
+
+    Returns:
+        times: np.ndarray of times (in seconds)
+        values: np.ndarray of CC values
+    """
+    times = np.concatenate((change_times + release_delay, change_times + press_delay))
+    values = np.concatenate(
+        (np.zeros(len(change_times)), np.full(len(change_times), 100))
+    )
+    return times, values
+
+
+def get_pedal_control_changes(change_times, release_delay=0.01, press_delay=0.02):
+    """
+    Sorted and deduplicated CC-64 stream: pedal down from the start, then
+    released and pressed again shortly after each change time
+
+    Returns:
+        control_changes: list of pretty_midi.ControlChange
+    """
+    times, values = get_pedal_events(change_times, release_delay, press_delay)
+    times = np.concatenate(([0.0], times))
+    values = np.concatenate(([100], values))
+    events = np.unique(np.stack([times, values], axis=1), axis=0)  # sorts by time
+    return [
+        pretty_midi.ControlChange(number=64, value=int(value), time=time)
+        for time, value in events.tolist()
+    ]
+
+
+def add_pedal(midi_data, mode="onset"):
+    """
+    Add sustain pedal changes driven by the left hand, in place.
+    A single CC-64 stream is added to the first (right hand) instrument.
+    """
+    notes = notes_from_pretty_midi(midi_data)
+    change_times = get_pedal_changes(notes[notes["instrument"] == 1], mode)
+    set_pedal_changes(midi_data, change_times)
+
+
+def set_pedal_changes(midi_data, change_times):
+    """Replace the CC-64 stream of the first instrument, in place"""
     right_hand = midi_data.instruments[0]
-    pedal_changes = []
-    for note in left_hand.notes:
-        if note.start in pedal_changes:
-            continue
-        pedal_changes.append(note.start)
-
-    sustain_pedal_start = pretty_midi.ControlChange(
-        number=64, value=100, time=0
-    )  # start with pedal
-    left_hand.control_changes.append(sustain_pedal_start)
-    for t in pedal_changes:
-        add_at(0, t + 0.01, left_hand, right_hand)
-        add_at(100, t + 0.02, left_hand, right_hand)
-    midi_data.write(save_path)
-
-
-def add_at(value, time, inst1, inst2):
-    for inst in [inst1, inst2]:
-        inst.control_changes.append(
-            pretty_midi.ControlChange(number=64, value=value, time=time)
-        )
+    right_hand.control_changes = [
+        cc for cc in right_hand.control_changes if cc.number != 64
+    ] + get_pedal_control_changes(change_times)
+    right_hand.control_changes.sort(key=lambda cc: cc.time)
 
 
 def offset_all_velocities(score, offset):
@@ -471,62 +715,406 @@ def remove_dynamics(score: music21.stream.Score):
         e.activeSite.remove(e)
 
 
-def randomize_note_duration(midi_data, percentage=0.5):
-    for instrument in midi_data.instruments:
-        for note in instrument.notes:
-            # Calculate random adjustment factor
-            random_percent = random.uniform(1 - percentage / 50, 1 + percentage / 200)
-            note_end_time = note.start + (note.end - note.start) * random_percent
-            note.end = note_end_time
+def get_duration_factors(n_notes, percentage, rng):
+    """Random duration factors of randomize_note_duration"""
+    return rng.uniform(1 - percentage / 50, 1 + percentage / 200, n_notes)
+
+
+def stretch_note_durations(notes, factors):
+    """Multiply every note duration by a factor, returns a new note array"""
+    notes = notes.copy()
+    notes["end"] = notes["start"] + (notes["end"] - notes["start"]) * factors
+    return notes
+
+
+def randomize_note_duration(notes, percentage, rng):
+    """Stretch every note duration by a random factor, returns a new note array"""
+    factors = get_duration_factors(len(notes), percentage, rng)
+    return stretch_note_durations(notes, factors)
 
 
-def randomize_note_onsets(midi_data, percentage=0.5):
-    bpm = 125
+def get_onset_shifts(n_notes, percentage, rng, bpm=HUMANIZE_BPM):
+    """Random onset shifts (in seconds) of randomize_note_onsets"""
     beat_duration = 60 / bpm
-    for instrument in midi_data.instruments:
-        for note in instrument.notes:
-            # Calculate the random adjustment factor
-            adjustment_factor = random.uniform(-percentage / 100, percentage / 100)
-            adjustment = beat_duration * adjustment_factor
-            # Adjust the note's onset
-            note.start = max(0, note.start + adjustment)
-            note.end = note.end + adjustment
-
-
-def find_same_pitch_notes(data):
-    notes = {}
-    for note in data.notes:
-        if note.pitch in notes:
-            notes[note.pitch].append(note)
-        else:
-            notes[note.pitch] = [note]
+    adjustment_factor = rng.uniform(-percentage / 100, percentage / 100, n_notes)
+    return beat_duration * adjustment_factor
+
+
+def shift_note_onsets(notes, shifts):
+    """Shift every note by some seconds (not before 0), returns a new note array"""
+    notes = notes.copy()
+    notes["start"] = np.maximum(0, notes["start"] + shifts)
+    notes["end"] = notes["end"] + shifts
     return notes
 
 
+def randomize_note_onsets(notes, percentage, rng, bpm=HUMANIZE_BPM):
+    """Shift every note by a random fraction of a beat, returns a new note array"""
+    shifts = get_onset_shifts(len(notes), percentage, rng, bpm)
+    return shift_note_onsets(notes, shifts)
+
+
+def get_overlap_ends(notes):
+    """
+    Ends of the notes once each one ends just before the next note of the
+    same pitch (and instrument) starts
+
+    Returns:
+        ends: np.ndarray, in the order of notes
+    """
+    order = np.lexsort((notes["start"], notes["pitch"], notes["instrument"]))
+    sorted_notes = notes[order]
+    same_pitch = (sorted_notes["pitch"][1:] == sorted_notes["pitch"][:-1]) & (
+        sorted_notes["instrument"][1:] == sorted_notes["instrument"][:-1]
+    )
+    next_start = sorted_notes["start"][1:]
+    overlap = same_pitch & (next_start < sorted_notes["end"][:-1])
+    sorted_ends = sorted_notes["end"]
+    sorted_ends[:-1][overlap] = next_start[overlap] - 0.001
+    ends = np.empty(len(notes))
+    ends[order] = sorted_ends
+    return ends
+
+
 def remove_overlap(notes):
-    notes = sorted(notes, key=lambda x: x.start)
-    for i in range(1, len(notes)):
-        if notes[i].start < notes[i - 1].end:
-            notes[i - 1].end = notes[i].start - 0.001
+    """
+    End each note just before the next note of the same pitch (and instrument)
+    starts, returns a new note array. Notes left without any duration (same
+    pitch played twice at the same time) are dropped.
+    """
+    notes = notes.copy()
+    notes["end"] = get_overlap_ends(notes)
+    return notes[notes["end"] > notes["start"]]
 
 
-def randomize_score(midi_path, onset_percentage=2, duration_percentage=5):
-    midi_data = pretty_midi.PrettyMIDI(midi_path)
-    randomize_note_onsets(midi_data, onset_percentage)
-    randomize_note_duration(midi_data, duration_percentage)
+def get_humanize_rngs(seed=None):
+    """
+    Independent random generators of the onset and duration deviations, so
+    that both can be drawn note by note (see src/streaming.py)
+    """
+    rngs = get_stage_rngs(seed)
+    return rngs["onset"], rngs["duration"]
+
+
+def humanize_notes(notes, onset_percentage=2, duration_percentage=5, seed=None):
+    """
+    Humanization stage: random onset and duration deviations, then cleanup
+    of the resulting same-pitch overlaps. Reproducible given the seed.
+    """
+    onset_rng, duration_rng = get_humanize_rngs(seed)
+    notes = randomize_note_onsets(notes, onset_percentage, onset_rng)
+    notes = randomize_note_duration(notes, duration_percentage, duration_rng)
+    return remove_overlap(notes)
+
 
-    # cleanup
+def randomize_score(midi_data, onset_percentage=2, duration_percentage=5, seed=None):
+    """Randomize note onsets and durations, in place"""
+    notes = notes_from_pretty_midi(midi_data)
+    notes = humanize_notes(notes, onset_percentage, duration_percentage, seed)
+    set_pretty_midi_notes(midi_data, notes)
+
+
+def copy_pretty_midi(midi_data):
+    """
+    Copy of a PrettyMIDI object with its own instrument, note and control
+    change lists, sharing the notes. The array passes replace these lists
+    and never modify the notes, so they can run on such a copy.
+    """
+    midi_data = copy.copy(midi_data)
+    midi_data.instruments = [copy.copy(i) for i in midi_data.instruments]
     for instrument in midi_data.instruments:
-        same_pitch = find_same_pitch_notes(instrument)
-        for pitch, notes in same_pitch.items():
-            remove_overlap(notes)
+        instrument.notes = list(instrument.notes)
+        instrument.control_changes = list(instrument.control_changes)
+    return midi_data
+
+
+def score_to_midi_bytes(score: music21.stream.Score):
+    """Content of the MIDI file of a music21 score, without going through disk"""
+    return music21.midi.translate.music21ObjectToMidiFile(score).writestr()
+
 
-    midi_data.write(midi_path)
+class ExtrapolatedTickToTime:
+    """
+    Tick to time table of PrettyMIDI, only stored up to the last tempo
+    change and extrapolated after it with the last tempo (which gives the
+    same times as the full table)
+    """
+
+    def __init__(self, table, tick_scale):
+        self.table = table
+        self.tick_scale = tick_scale
+
+    def __getitem__(self, tick):
+        last_tick = len(self.table) - 1
+        if tick <= last_tick:
+            return self.table[tick]
+        return self.table[last_tick] + self.tick_scale * (tick - last_tick)
+
+
+class CompactPrettyMIDI(pretty_midi.PrettyMIDI):
+    """
+    PrettyMIDI without its dense tick to time table. The table has one
+    entry per tick of the file, i.e. tens of MB for a music21 score (10080
+    ticks per quarter), while time_to_tick (used by write) extrapolates
+    after the last tempo change anyway.
+
+    The table is only stored up to the last tempo change while loading the
+    file, it is a plain array again afterwards (adjust_times grows it).
+    """
+
+    _loading = False
+
+    def __init__(self, midi_file):
+        self._loading = True
+        super().__init__(midi_file)
+        self._loading = False
+        self._PrettyMIDI__tick_to_time = self._PrettyMIDI__tick_to_time.table
+
+    def _update_tick_to_time(self, max_tick):
+        if not self._loading:
+            super()._update_tick_to_time(max_tick)
+            return
+        # the loaders index the table with the ticks of every event
+        super()._update_tick_to_time(0)
+        self._PrettyMIDI__tick_to_time = ExtrapolatedTickToTime(
+            self._PrettyMIDI__tick_to_time, self._tick_scales[-1][1]
+        )
+
+    def tick_to_time(self, tick):
+        # ticks after the table are extrapolated instead of growing it (see
+        # PrettyMIDI.tick_to_time)
+        if tick >= pretty_midi.MAX_TICK:
+            raise IndexError("Supplied tick is too large.")
+        table = self._PrettyMIDI__tick_to_time
+        return ExtrapolatedTickToTime(table, self._tick_scales[-1][1])[int(tick)]
+
+
+def score_to_pretty_midi(score: music21.stream.Score):
+    """Convert a music21 score to a PrettyMIDI object without going through disk"""
+    return CompactPrettyMIDI(io.BytesIO(score_to_midi_bytes(score)))
+
+
+# Expression passes of interpret(), see src/pipeline.py
+@register_pass("parse_score", inputs=["xml_path"], outputs=["score"])
+def parse_score_pass(xml_path):
+    return music21.converter.parse(xml_path)
+
+
+@register_pass("render_score", inputs=["score"], outputs=["score_midi"])
+def render_score_pass(score):
+    # MIDI of the score as written (before any expression pass modifies it)
+    return score_to_midi_bytes(score)
+
+
+@register_pass(
+    "dynamics_timeline", inputs=["score"], outputs=["dynamics_timeline"], version=2
+)
+def dynamics_timeline_pass(score):
+    # the right hand dynamics are used for both hands, see overwrite_velocities
+    return get_dynamics_timeline(score, score.parts[0])
+
+
+@register_pass(
+    "overwrite_velocities",
+    inputs=["score"],
+    outputs=["score"],
+    params=["transition_window"],
+    version=2,
+)
+def overwrite_velocities_pass(score, transition_window=4.0):
+    logger.info("Overwriting velocities...")
+    overwrite_velocities(score, transition_window)
+    return score
+
+
+@register_pass("idea_4", inputs=["score"], outputs=["score"], params=["bell_amplitude"])
+def idea_4_pass(score, bell_amplitude=0.8):
+    idea_4(score, bell_amplitude)
+    return score
+
+
+@register_pass(
+    "idea_13_stats",
+    inputs=["unperformed_midi_path", "performed_midi_paths", "annotations_path"],
+    outputs=["avgs", "stds"],
+)
+def idea_13_stats_pass(unperformed_midi_path, performed_midi_paths, annotations_path):
+    # decoded note arrays are cached on disk, so repeated runs skip MIDI parsing
+    unperformed_notes = load_notes(unperformed_midi_path)
+    performed_notes_list = load_notes_parallel(performed_midi_paths)
+
+    # align every performance with the score (cached per file pair)
+    json_data = get_annotations(annotations_path)
+
+    avgs = defaultdict(float)
+    stds = defaultdict(float)
+    for i in range(len(performed_notes_list)):
+        performed_notes = performed_notes_list[i]
+        matches = get_alignment(
+            unperformed_midi_path,
+            performed_midi_paths[i],
+            unperformed_notes,
+            performed_notes,
+            annotation=get_performance_annotation(performed_midi_paths[i], json_data),
+        )
+        avg_vel, std_vel = idea_13(unperformed_notes, performed_notes, matches)
+        for k, v in avg_vel.items():
+            avgs[k] += v
+        for k, v in std_vel.items():
+            stds[k] += v
+        logger.debug("avg vel %s", avg_vel)
+        logger.debug("stdvel %s", std_vel)
+    for k, v in avgs.items():
+        avgs[k] = v / len(performed_notes_list)
+    for k, v in stds.items():
+        stds[k] = v / len(performed_notes_list)
+    logger.debug("full avg vel %s", avgs)
+    logger.debug("full std vel %s", stds)
+    return dict(avgs), dict(stds)
+
+
+@register_pass(
+    "tempo_curves",
+    inputs=["unperformed_midi_path", "performed_midi_paths", "annotations_path"],
+    outputs=["tempo_curves"],
+)
+def tempo_curves_pass(unperformed_midi_path, performed_midi_paths, annotations_path):
+    # cached per piece, None without annotations (hand-coded tempo curve)
+    tempo_curves = get_tempo_curves(
+        unperformed_midi_path,
+        performed_midi_paths,
+        json_data=get_annotations(annotations_path),
+    )
+    if tempo_curves is None:
+        logger.info("no annotated performances, using the hand-coded tempo curve")
+    return tempo_curves
+
+
+@register_pass(
+    "velocity_profile",
+    inputs=["unperformed_midi_path", "performed_midi_paths", "annotations_path"],
+    outputs=["velocity_profile"],
+)
+def velocity_profile_pass(
+    unperformed_midi_path, performed_midi_paths, annotations_path
+):
+    return get_velocity_profile(
+        unperformed_midi_path,
+        performed_midi_paths,
+        json_data=get_annotations(annotations_path),
+    )
+
+
+@register_pass("render", inputs=["score"], outputs=["midi_data"])
+def render_pass(score):
+    return score_to_pretty_midi(score)
+
+
+@register_pass(
+    "apply_velocity_profile",
+    inputs=["midi_data", "velocity_profile"],
+    outputs=["midi_data"],
+    params=["profile_amplitude"],
+    version=2,
+)
+def apply_velocity_profile_pass(midi_data, velocity_profile, profile_amplitude=1.0):
+    add_velocity_profile(midi_data, velocity_profile, profile_amplitude)
+    return midi_data
+
+
+@register_pass(
+    "apply_idea_13",
+    inputs=["midi_data", "avgs", "stds"],
+    outputs=["midi_data"],
+    params=["rescaling_factor", "seed"],
+    version=2,
+)
+def apply_idea_13_pass(midi_data, avgs, stds, rescaling_factor=10, seed=None):
+    apply_idea_13(midi_data, avgs, stds, rescaling_factor, seed)
+    return midi_data
+
+
+@register_pass(
+    "add_tempo_changes",
+    inputs=["midi_data", "tempo_curves"],
+    outputs=["midi_data"],
+    params=["seed"],
+    version=3,
+)
+def add_tempo_changes_pass(midi_data, tempo_curves, seed=None):
+    add_tempo_changes(midi_data, seed, tempo_curves)
+    return midi_data
+
+
+@register_pass(
+    "randomize",
+    inputs=["midi_data"],
+    outputs=["midi_data"],
+    params=["onset_percentage", "duration_percentage", "seed"],
+    version=2,
+)
+def randomize_pass(midi_data, onset_percentage=1, duration_percentage=5, seed=None):
+    logger.info("Adding randomization")
+    randomize_score(midi_data, onset_percentage, duration_percentage, seed)
+    return midi_data
+
+
+@register_pass(
+    "add_pedal",
+    inputs=["midi_data"],
+    outputs=["pedal_midi_data"],
+    params=["pedal_mode"],
+)
+def add_pedal_pass(midi_data, pedal_mode="onset"):
+    # the midi without pedal is an output as well, work on a copy
+    midi_data = copy_pretty_midi(midi_data)
+    logger.info("Adding pedal...")
+    add_pedal(midi_data, pedal_mode)
+    logger.info("Merging hands")
+    merge_hands_pm(midi_data)
+    return midi_data
+
+
+INTERPRET_PASSES = [
+    "parse_score",
+    "render_score",
+    "overwrite_velocities",
+    "idea_13_stats",
+    "tempo_curves",
+    "velocity_profile",
+    "render",
+    "apply_velocity_profile",
+    # the seeded passes work on the rendered MIDI, so that a new seed only
+    # re-executes cheap array operations
+    "apply_idea_13",
+    "add_tempo_changes",
+    "randomize",
+    "add_pedal",
+]
+# passes which do not depend on the seed, up to the final velocities of the
+# rendered score (see src/streaming.py, src/editing.py and src/sweep.py)
+SCORE_PASSES = INTERPRET_PASSES[: INTERPRET_PASSES.index("apply_velocity_profile") + 1]
 
 
 # Main function of the assignment, takes an unperformed MIDI or
 #  XML path and outputs a performed midi
-def interpret(unperformed_midi_path, xml_path, performed_midi_paths):
+def interpret(
+    unperformed_midi_path,
+    xml_path,
+    performed_midi_paths,
+    seed=None,
+    pedal_mode="onset",
+    rescaling_factor=10,
+    onset_percentage=1,
+    duration_percentage=5,
+    transition_window=4.0,
+    profile_amplitude=1.0,
+    cache_path=PIPELINE_CACHE_PATH,
+    save_path=ROOT_PATH / "results",
+    pipeline=None,
+    return_score=True,
+    low_memory=False,
+):
     """
     Main idea:
         Velocity changes can be done "in-place".
@@ -544,16 +1132,26 @@ def interpret(unperformed_midi_path, xml_path, performed_midi_paths):
         We can have 2 concepts, an expressive timing could be:
             local: for example, the 8th note being rushed a bit or coming too late, without affecting the rest
             global: for example, slowing down at the end of a phrase. This should affect all the score (displace everything by a bit)
+
+    The generation itself runs the INTERPRET_PASSES pipeline. Pass outputs are
+    memoized in cache_path (None to disable), so changing a late-stage
+    parameter (e.g. rescaling_factor) only re-executes the passes after it.
+    Pass a seed to make the generation reproducible (and memoizable).
+    profile_amplitude scales the velocity profile learned from the performed
+    MIDIs (see src/velocity_profiles.py), which replaces the bell curve of
+    idea_4 (1 plays the learned offsets as they are).
+    The generated MIDI files, and the MIDI of the score as written
+    (xml_midi.mid), are written to save_path.
+
+    A long-running process can pass its own pipeline (e.g. with an in-memory
+    memo) and return_score=False, so that the score does not have to be
+    loaded when only the seeded (array) passes re-execute.
+    Returns the score after the music21 passes (None if not return_score).
+
+    With low_memory, the score is not returned and the music21 passes are
+    not memoized, so that the score is released as soon as it is rendered
+    and never copied, see Pipeline. The peak resident memory is logged.
     """
-    unperformed_midi_score: music21.stream.Score = music21.converter.parse(
-        unperformed_midi_path
-    )
-    xml_score: music21.stream.Score = music21.converter.parse(xml_path)
-    unperformed_pm = pretty_midi.PrettyMIDI(unperformed_midi_path)
-    performed_pms = [
-        pretty_midi.PrettyMIDI(performed_midi_path)
-        for performed_midi_path in performed_midi_paths
-    ]
 
     # Let's say I have a note n of onset o, duration d.
     # If I want to make it f times as long (in other words, stretch the time by f between o and o+d):
@@ -567,56 +1165,43 @@ def interpret(unperformed_midi_path, xml_path, performed_midi_paths):
     # for all notes (o', d') that start after o:
     #     -> just add d * f to their onset
 
-    timing_modifier = []
-
-    # set_default_velocity(xml_score)
-    print("Overwriting velocities...")
-    overwrite_velocities(xml_score)
-
-    # idea_12(xml_score)
-
-    idea_4(xml_score)
-
-    # remove_dynamics(xml_score)
-
-    avgs = defaultdict(float)
-    stds = defaultdict(float)
-    for i in range(len(performed_pms)):
-        avg_vel, std_vel = idea_13(unperformed_pm, performed_pms[i])
-        for k, v in avg_vel.items():
-            avgs[k] += v
-        for k, v in std_vel.items():
-            stds[k] += v
-        print("avg vel", avg_vel)
-        print("stdvel ", std_vel)
-    for k, v in avgs.items():
-        avgs[k] = v / len(performed_pms)
-    for k, v in stds.items():
-        stds[k] = v / len(performed_pms)
-    print("full avg vel", avgs)
-    print("full std vel", stds)
-    apply_idea_13(xml_score, avgs, stds)
-
-    add_tempo_changes(xml_score)
-
-    # offset_all_velocities(xml_score, -20)
-    # xml_score = merge_hands(xml_score)
-
-    performed_score = xml_score
+    if pipeline is None:
+        pipeline = Pipeline(
+            INTERPRET_PASSES, cache_path=cache_path, low_memory=low_memory
+        )
+    outputs = ["score_midi", "midi_data", "pedal_midi_data"]
+    if return_score and not low_memory:
+        outputs.append("score")
+    values = pipeline.run(
+        sources={
+            "unperformed_midi_path": unperformed_midi_path,
+            "xml_path": xml_path,
+            "performed_midi_paths": list(performed_midi_paths),
+            "annotations_path": ANNOTATIONS_PATH,
+        },
+        params={
+            "seed": seed,
+            "pedal_mode": pedal_mode,
+            "rescaling_factor": rescaling_factor,
+            "onset_percentage": onset_percentage,
+            "duration_percentage": duration_percentage,
+            "transition_window": transition_window,
+            "profile_amplitude": profile_amplitude,
+        },
+        outputs=outputs,
+    )
 
-    # save midi
-    save_path = ROOT_PATH / "results"
+    # save midi, each output is written once
+    save_path = Path(save_path)
     save_path.mkdir(exist_ok=True, parents=True)
     save_midi = str(save_path / "generated_midi.mid")
     pedal_path = str(save_path / "generated_midi_with_pedal.mid")
-    performed_score.write("midi", save_midi)
-
-    print("Adding randomization")
-    randomize_score(save_midi, onset_percentage=1, duration_percentage=5)
 
-    print("Adding pedal...")
-    add_pedal(save_midi, pedal_path)
-    print("Merging hands")
-    merge_hands_pm(pedal_path)
+    with open(save_path / "xml_midi.mid", "wb") as f:
+        f.write(values["score_midi"])
+    values["midi_data"].write(save_midi)
+    values["pedal_midi_data"].write(pedal_path)
+    logger.info("wrote at %s", pedal_path)
+    logger.info("peak RSS %.1f MB", get_peak_rss() / 2**20)
 
-    return performed_score
+    return values.get("score")
@@ -0,0 +1,159 @@
+import hashlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from src.data import ROOT_PATH
+
+NOTES_CACHE_PATH = ROOT_PATH / "data" / "cache" / "notes"
+
+# compact representation of MIDI notes used by the array-based passes
+NOTE_DTYPE = np.dtype(
+    [
+        ("start", np.float64),
+        ("end", np.float64),
+        ("pitch", np.int16),
+        ("velocity", np.int16),
+        ("instrument", np.int16),
+    ]
+)
+
+
+def notes_from_pretty_midi(midi_data):
+    """
+    Flatten all instruments of a PrettyMIDI object into one note array
+
+    Args:
+        midi_data: pretty_midi.PrettyMIDI object
+
+    Returns:
+        notes: structured np.ndarray with NOTE_DTYPE, sorted by (start, pitch)
+    """
+    n_notes = sum(len(instrument.notes) for instrument in midi_data.instruments)
+    notes = np.empty(n_notes, dtype=NOTE_DTYPE)
+    i = 0
+    for instrument_index, instrument in enumerate(midi_data.instruments):
+        for note in instrument.notes:
+            notes[i] = (
+                note.start,
+                note.end,
+                note.pitch,
+                note.velocity,
+                instrument_index,
+            )
+            i += 1
+    return notes[np.lexsort((notes["pitch"], notes["start"]))]
+
+
+def set_pretty_midi_notes(midi_data, notes):
+    """
+    Replace the notes of every instrument of a PrettyMIDI object (in place)
+    by the ones of a note array. Control changes and other events are kept.
+    """
+    import pretty_midi
+
+    notes = notes[np.lexsort((notes["pitch"], notes["start"]))]
+    for instrument_index, instrument in enumerate(midi_data.instruments):
+        instrument_notes = notes[notes["instrument"] == instrument_index]
+        instrument.notes = [
+            pretty_midi.Note(
+                velocity=int(velocity), pitch=int(pitch), start=start, end=end
+            )
+            for start, end, pitch, velocity in zip(
+                instrument_notes["start"].tolist(),
+                instrument_notes["end"].tolist(),
+                instrument_notes["pitch"].tolist(),
+                instrument_notes["velocity"].tolist(),
+            )
+        ]
+
+
+def get_quarter_positions(midi_data, times):
+    """Score position (in quarters) of times of a MIDI file, using its tempo map"""
+    change_times, tempi = midi_data.get_tempo_changes()
+    change_quarters = np.concatenate(
+        ([0.0], np.cumsum(np.diff(change_times) * tempi[:-1] / 60))
+    )
+    index = np.searchsorted(change_times, times, side="right") - 1
+    index = np.maximum(index, 0)
+    return change_quarters[index] + (times - change_times[index]) * tempi[index] / 60
+
+
+def file_signature(path):
+    """Identifies a file version by its path, size and modification time"""
+    stat = os.stat(path)
+    return f"{Path(path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def _get_cache_file(midi_path, cache_path):
+    key = hashlib.sha1(file_signature(midi_path).encode()).hexdigest()
+    return Path(cache_path) / (key + ".npy")
+
+
+def load_notes(midi_path, cache_path=NOTES_CACHE_PATH):
+    """
+    Load the note array of a MIDI file, using the on-disk cache if possible
+
+    Args:
+        midi_path: str path to the MIDI file
+        cache_path: directory for cached note arrays (None to disable)
+
+    Returns:
+        notes: note array, see notes_from_pretty_midi
+    """
+    # pretty_midi is slow to import, this module is used by light CLIs as well
+    import pretty_midi
+
+    if cache_path is None:
+        return notes_from_pretty_midi(pretty_midi.PrettyMIDI(str(midi_path)))
+
+    cache_file = _get_cache_file(midi_path, cache_path)
+    if cache_file.exists():
+        return np.load(cache_file)
+
+    notes = notes_from_pretty_midi(pretty_midi.PrettyMIDI(str(midi_path)))
+    cache_file.parent.mkdir(exist_ok=True, parents=True)
+    # write to a temporary file first so parallel loaders never see partial files
+    tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp.npy")
+    np.save(tmp_file, notes)
+    os.replace(tmp_file, cache_file)
+    return notes
+
+
+def load_notes_parallel(midi_paths, max_workers=None, cache_path=NOTES_CACHE_PATH):
+    """
+    Load the note arrays of many MIDI files.
+    Cached files are read directly, the others are decoded in a process pool.
+
+    Args:
+        midi_paths: list of str paths to MIDI files
+        max_workers: size of the process pool (None for the number of CPUs)
+        cache_path: directory for cached note arrays (None to disable)
+
+    Returns:
+        notes_list: list of note arrays, in the order of midi_paths
+    """
+    notes_list = [None] * len(midi_paths)
+    missing = []
+    for i, midi_path in enumerate(midi_paths):
+        if cache_path is not None and _get_cache_file(midi_path, cache_path).exists():
+            notes_list[i] = load_notes(midi_path, cache_path)
+        else:
+            missing.append(i)
+
+    if len(missing) == 1 or max_workers == 1:
+        for i in missing:
+            notes_list[i] = load_notes(midi_paths[i], cache_path)
+    elif len(missing) > 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = executor.map(
+                load_notes,
+                [midi_paths[i] for i in missing],
+                [cache_path] * len(missing),
+            )
+            for i, notes in zip(missing, results):
+                notes_list[i] = notes
+
+    return notes_list
@@ -0,0 +1,284 @@
+import gc
+import hashlib
+import logging
+import os
+import pickle
+import sys
+from pathlib import Path
+
+from src.data import ROOT_PATH
+from src.instrumentation import count_notes, stage
+from src.note_array import file_signature
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_CACHE_PATH = ROOT_PATH / "data" / "cache" / "pipeline"
+
+# registry of all expression passes, see register_pass
+PASSES = {}
+
+
+class Pass:
+    """
+    Named stage of the generation pipeline
+
+    Args:
+        name: str unique name of the pass
+        function: callable taking the inputs and params as keyword
+                  arguments and returning the outputs (a tuple if
+                  there are several of them)
+        inputs: list of names of the values read by the pass
+        outputs: list of names of the values produced by the pass
+        params: list of names of the parameters used by the pass
+        version: int to increase when the outputs of the pass change for
+                 the same inputs and params, invalidates its memoized outputs
+    """
+
+    def __init__(self, name, function, inputs, outputs, params, version=1):
+        self.name = name
+        self.function = function
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = list(params)
+        self.version = version
+
+    def __call__(self, values, params):
+        kwargs = {name: values[name] for name in self.inputs}
+        kwargs.update({name: params[name] for name in self.params if name in params})
+        outputs = self.function(**kwargs)
+        if len(self.outputs) == 1:
+            outputs = (outputs,)
+        return dict(zip(self.outputs, outputs))
+
+
+def register_pass(name, inputs, outputs, params=(), version=1):
+    """Decorator adding a function to the pass registry"""
+
+    def decorator(function):
+        PASSES[name] = Pass(name, function, inputs, outputs, params, version)
+        return function
+
+    return decorator
+
+
+def fingerprint_source(value):
+    """Identifies a source value: files by their signature, the rest by repr"""
+    if isinstance(value, (list, tuple)):
+        return "[" + ",".join(fingerprint_source(v) for v in value) + "]"
+    if isinstance(value, (str, Path)) and Path(value).is_file():
+        return file_signature(value)
+    return repr(value)
+
+
+def dump_values(values):
+    """Serialize pass outputs, music21 streams go through freezeThaw to keep their sites"""
+    import music21
+
+    serialized = {}
+    for name, value in values.items():
+        if isinstance(value, music21.stream.Stream):
+            frozen = music21.freezeThaw.StreamFreezer(value).writeStr(fmt="pickle")
+            serialized[name] = ("stream", frozen)
+        else:
+            serialized[name] = ("pickle", value)
+    return pickle.dumps(serialized, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def is_stream(value):
+    # music21 is only imported by the passes using it
+    music21 = sys.modules.get("music21")
+    return music21 is not None and isinstance(value, music21.stream.Stream)
+
+
+def load_values(data):
+    import music21
+
+    values = {}
+    for name, (kind, value) in pickle.loads(data).items():
+        if kind == "stream":
+            thawer = music21.freezeThaw.StreamThawer()
+            thawer.openStr(value)
+            value = thawer.stream
+        values[name] = value
+    return values
+
+
+class Pipeline:
+    """
+    Ordered list of registered passes whose outputs are memoized on disk.
+
+    The cache key of a pass is a hash of its name and version, of the keys of
+    its inputs and of its params. Keys of source values are their fingerprint,
+    keys of pass outputs are derived from the key of the pass producing them.
+    Hence, changing one parameter re-executes only the passes using it and
+    the ones after them. Passes with a "seed" param (and the ones after them)
+    are not memoized when the seed is None, since their output is not
+    reproducible. With a seed, they are only memoized in memory: there is
+    one output per seed, which would fill the disk cache without bound.
+
+    If memory is a dict, serialized pass outputs are also kept in it (and
+    read from it first), for long-running processes. Values are stored
+    serialized since passes modify their inputs in place.
+
+    Values are released as soon as no later pass reads them, so that the
+    music21 score is freed once it is rendered (unless it is requested).
+    With low_memory, music21 streams are not memoized either: serializing
+    them goes through a full copy of the score, which is the peak memory of
+    a generation. Their passes re-execute on every run instead.
+    """
+
+    def __init__(
+        self,
+        pass_names,
+        cache_path=PIPELINE_CACHE_PATH,
+        memory=None,
+        low_memory=False,
+    ):
+        self.passes = [PASSES[name] for name in pass_names]
+        self.cache_path = None if cache_path is None else Path(cache_path)
+        self.memory = memory
+        self.low_memory = low_memory
+        self.seeded = self.get_seeded()
+
+    def get_seeded(self):
+        """Names of the passes with a "seed" param or reading outputs of such passes"""
+        seeded, seeded_values = set(), set()
+        for p in self.passes:
+            if "seed" in p.params or not seeded_values.isdisjoint(p.inputs):
+                seeded.add(p.name)
+                seeded_values.update(p.outputs)
+            else:
+                seeded_values.difference_update(p.outputs)
+        return seeded
+
+    def get_keys(self, sources, params):
+        """
+        Cache key of every pass, computed without running anything.
+        The key is None if the pass output is not reproducible.
+        """
+        versions = {name: fingerprint_source(value) for name, value in sources.items()}
+        keys = []
+        for p in self.passes:
+            input_versions = [versions[name] for name in p.inputs]
+            if None in input_versions or (
+                "seed" in p.params and params.get("seed") is None
+            ):
+                key = None
+            else:
+                pass_params = sorted(
+                    (name, repr(params[name])) for name in p.params if name in params
+                )
+                key = repr((p.name, p.version, input_versions, pass_params))
+                key = hashlib.sha1(key.encode()).hexdigest()
+            keys.append(key)
+            for name in p.outputs:
+                versions[name] = None if key is None else f"{key}:{name}"
+        return keys
+
+    def get_cache_file(self, p, key):
+        if self.cache_path is None or key is None or p.name in self.seeded:
+            return None
+        return self.cache_path / f"{p.name}-{key}.pkl"
+
+    def run(self, sources, params, outputs):
+        """
+        Run the pipeline, reusing memoized pass outputs where possible
+
+        Args:
+            sources: dict of initial values (paths to scores and performances)
+            params: dict of parameters, each pass only sees the ones it declares
+            outputs: list of names of the values to return
+
+        Returns:
+            values: dict with the requested outputs
+        """
+        keys = self.get_keys(sources, params)
+
+        # walk backwards to find the passes that have to be loaded or run
+        needed = set(outputs)
+        plan = [None] * len(self.passes)
+        for i in reversed(range(len(self.passes))):
+            p = self.passes[i]
+            if needed.isdisjoint(p.outputs):
+                continue
+            needed.difference_update(p.outputs)
+            cache_file = self.get_cache_file(p, keys[i])
+            if self.memory is not None and keys[i] in self.memory:
+                plan[i] = "memory"
+            elif cache_file is not None and cache_file.exists():
+                plan[i] = "load"
+            else:
+                plan[i] = "run"
+                needed.update(p.inputs)
+        missing = needed.difference(sources)
+        if missing:
+            raise ValueError(f"Missing pipeline sources: {sorted(missing)}")
+
+        # index of the last pass reading every value
+        last_reads = {}
+        for i, (p, action) in enumerate(zip(self.passes, plan)):
+            if action == "run":
+                last_reads.update((name, i) for name in p.inputs)
+
+        values = dict(sources)
+        for i, (p, key, action) in enumerate(zip(self.passes, keys, plan)):
+            if action is None:
+                continue
+            self.release(values, outputs, last_reads, i)
+            cache_file = self.get_cache_file(p, key)
+            if action == "memory":
+                logger.info("pass %s: loaded from memory", p.name)
+                with stage(f"{p.name} (memory)"):
+                    values.update(load_values(self.memory[key]))
+                continue
+            if action == "load":
+                logger.info("pass %s: loaded from cache", p.name)
+                with stage(f"{p.name} (cached)"):
+                    with open(cache_file, "rb") as f:
+                        data = f.read()
+                    values.update(load_values(data))
+                if self.memory is not None:
+                    self.memory[key] = data
+                continue
+
+            logger.info("pass %s: running", p.name)
+            with stage(p.name) as record:
+                pass_outputs = p(values, params)
+                if record is not None:
+                    record["notes"] = count_notes(pass_outputs[p.outputs[0]])
+            memoize = key is not None and (
+                cache_file is not None or self.memory is not None
+            )
+            if memoize and self.low_memory:
+                memoize = not any(is_stream(value) for value in pass_outputs.values())
+            if memoize:
+                with stage(f"{p.name} (memoize)"):
+                    data = dump_values(pass_outputs)
+                    if self.memory is not None:
+                        self.memory[key] = data
+                    if cache_file is not None:
+                        cache_file.parent.mkdir(exist_ok=True, parents=True)
+                        # an interrupted run never leaves a partial file
+                        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+                        with open(tmp_file, "wb") as f:
+                            f.write(data)
+                        os.replace(tmp_file, cache_file)
+            values.update(pass_outputs)
+
+        self.release(values, outputs, last_reads, len(self.passes))
+        return {name: values[name] for name in outputs}
+
+    @staticmethod
+    def release(values, outputs, last_reads, i):
+        """Drop the values that are not requested nor read by the passes from i on"""
+        dead = [
+            name
+            for name in values
+            if name not in outputs and last_reads.get(name, -1) < i
+        ]
+        released_stream = False
+        for name in dead:
+            released_stream |= is_stream(values.pop(name))
+        if released_stream:
+            # music21 object graphs are full of reference cycles
+            gc.collect()
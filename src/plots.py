@@ -1,10 +1,20 @@
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 import numpy as np
-import pandas as pd
-import seaborn as sns
 
-sns.set_style("whitegrid")
+# matplotlib and seaborn are slow to import, they are imported when plotting
+_seaborn = None
+# seaborn style the plots are drawn in
+PLOT_STYLE = "whitegrid"
+
+
+def get_seaborn():
+    """Import seaborn and set the plots style, once"""
+    global _seaborn
+    if _seaborn is None:
+        import seaborn as sns
+
+        sns.set_style(PLOT_STYLE)
+        _seaborn = sns
+    return _seaborn
 
 
 def plot_transfer_function(
@@ -19,42 +29,47 @@ def plot_transfer_function(
     Chart for performance time/velocity vs beats position
     """
 
-    colors = ["#2c7bb6", "#fdae61", "#d7191c", "#abd9e9"]
-
-    # pop the last element from midi beats because we use differences
+    with get_seaborn().axes_style(PLOT_STYLE):
+        colors = ["#2c7bb6", "#fdae61", "#d7191c", "#abd9e9"]
 
-    if performance_type == "time":
-        midi_beats = midi_beats[:-1]
-        performance_beats = performance_beats[:-1]
-        unperformed_beats = unperformed_beats[:-1]
+        # pop the last element from midi beats because we use differences
 
-    # plot unperformed
-    axes.plot(
-        midi_beats,
-        unperformed_beats,
-        label="unperformed",
-        color=colors[-1],
-        linestyle="--",
-        linewidth=2,
-    )
+        if performance_type == "time":
+            midi_beats = midi_beats[:-1]
+            performance_beats = performance_beats[:-1]
+            unperformed_beats = unperformed_beats[:-1]
+
+        # plot unperformed
+        axes.plot(
+            midi_beats,
+            unperformed_beats,
+            label="unperformed",
+            color=colors[-1],
+            linestyle="--",
+            linewidth=2,
+        )
 
-    # plot performance
+        # plot performance
 
-    axes.plot(
-        midi_beats, performance_beats, label="performed", color=colors[0], linewidth=2
-    )
+        axes.plot(
+            midi_beats,
+            performance_beats,
+            label="performed",
+            color=colors[0],
+            linewidth=2,
+        )
 
-    # plot each estimator
-    for i, (k, v) in enumerate(performance_beats_estimated_dict.items()):
+        # plot each estimator
+        for i, (k, v) in enumerate(performance_beats_estimated_dict.items()):
+            if performance_type == "time":
+                v = v[:-1]  # one element is redundant
+            axes.plot(midi_beats, v, label=k, color=colors[i + 1], linewidth=2)
+        axes.set_xlabel("MIDI Beat Number")
         if performance_type == "time":
-            v = v[:-1]  # one element is redundant
-        axes.plot(midi_beats, v, label=k, color=colors[i + 1], linewidth=2)
-    axes.set_xlabel("MIDI Beat Number")
-    if performance_type == "time":
-        axes.set_ylabel("Beats Time (in BPM)")
-    else:
-        axes.set_ylabel("Beats Velocity")
-    axes.legend()
+            axes.set_ylabel("Beats Time (in BPM)")
+        else:
+            axes.set_ylabel("Beats Velocity")
+        axes.legend()
     return axes
 
 
@@ -171,34 +186,53 @@ def average_over_subcorpus(
 
 
 def plot_beat_frequencies(results, figsize=(15, 4)):
-    fig, axes = plt.subplots(1, 3, figsize=figsize)
-    for ax, res in zip(axes, results):
-        beats, sig = res
-        beat_locations, beat_frequencies = beats
-        ax.plot(beat_locations, beat_frequencies, color="blue")
-        ax.set_xlabel("Onset in Measure (in quarter notes)")
-        ax.set_ylabel("Average relative frequency")
-        ax.set_title(f"Time signature: {sig}")
-        ax.set_xlim(0, 4 * sig[0] / sig[1])
-        ax.set_ylim(0, beat_frequencies.max() * 1.25)
-        ax.xaxis.set_major_locator(ticker.MultipleLocator(0.5))
-    fig.tight_layout()
+    import matplotlib.pyplot as plt
+    import matplotlib.ticker as ticker
+
+    with get_seaborn().axes_style(PLOT_STYLE):
+        fig, axes = plt.subplots(1, 3, figsize=figsize)
+        for ax, res in zip(axes, results):
+            beats, sig = res
+            beat_locations, beat_frequencies = beats
+            ax.plot(beat_locations, beat_frequencies, color="blue")
+            ax.set_xlabel("Onset in Measure (in quarter notes)")
+            ax.set_ylabel("Average relative frequency")
+            ax.set_title(f"Time signature: {sig}")
+            ax.set_xlim(0, 4 * sig[0] / sig[1])
+            ax.set_ylim(0, beat_frequencies.max() * 1.25)
+            ax.xaxis.set_major_locator(ticker.MultipleLocator(0.5))
+        fig.tight_layout()
 
 
 def plot_composer_and_style(composers, styles, expr_by_composer, expr_by_style):
-    fig, (ax_comp, ax_style) = plt.subplots(1, 2, figsize=(15, 5))
-    ax_comp.barh(composers, expr_by_composer)
-    ax_style.barh(styles, expr_by_style)
-    ax_comp.invert_yaxis()
-    ax_style.invert_yaxis()
-    fig.tight_layout()
-    plt.savefig("plots/composer_and_styles.pdf", dpi=600)
-
-
-def plot_violins(dataframe: pd.DataFrame, title: str, limits: tuple = None, axes=None):
-    sns.violinplot(data=dataframe, x="Beat", y="Deviation", ax=axes)
-    axes.set_title(f"{title}")
-    axes.set_xlabel("Beat Number")
-    if limits:
-        axes.set_ylim(limits)
-    axes.set_ylabel("Deviation from IOI-Duration [%]")
+    import matplotlib.pyplot as plt
+
+    with get_seaborn().axes_style(PLOT_STYLE):
+        fig, (ax_comp, ax_style) = plt.subplots(1, 2, figsize=(15, 5))
+        ax_comp.barh(composers, expr_by_composer)
+        ax_style.barh(styles, expr_by_style)
+        ax_comp.invert_yaxis()
+        ax_style.invert_yaxis()
+        fig.tight_layout()
+        plt.savefig("plots/composer_and_styles.pdf", dpi=600)
+
+
+def plot_violins(
+    dataframe: "pd.DataFrame", title: str, limits: tuple = None, axes=None
+):
+    sns = get_seaborn()
+    with sns.axes_style(PLOT_STYLE):
+        axes = sns.violinplot(data=dataframe, x="Beat", y="Deviation", ax=axes)
+        axes.set_title(f"{title}")
+        axes.set_xlabel("Beat Number")
+        if limits:
+            axes.set_ylim(limits)
+        axes.set_ylabel("Deviation from IOI-Duration [%]")
+
+
+def plot_ioi_violins(title, composers=None, pieces=None, limits=None, axes=None):
+    """plot_violins of a slice of the IOI feature store, see src/features.py"""
+    from src.features import get_violin_dataframe, load_ioi_features
+
+    features = load_ioi_features(composers=composers, pieces=pieces)
+    plot_violins(get_violin_dataframe(features), title, limits, axes)
@@ -0,0 +1,258 @@
+"""
+Long-running generation service.
+
+Imports, parsed scores, performance statistics and rendered MIDI stay in
+memory between requests, so repeated generations of a piece with other
+seeds or parameters only re-execute the cheap passes (see src/pipeline.py).
+
+Requests and responses are JSON objects, one per line, read from stdin
+(responses on stdout) or from the connections to a unix socket:
+    {"id": 1, "midi_root_path": "Schubert/Impromptu_op.90_D.899/3", "seed": 0}
+    {"id": 1, "status": "ok", "outputs": {...}, "wall_time": 0.4}
+Optional request fields are the interpret() params (seed, pedal_mode,
+rescaling_factor, onset_percentage, duration_percentage, transition_window,
+profile_amplitude),
+save_path (default: results/service/<midi_root_path>/<hash of the params>,
+see get_default_save_path) and save_audio.
+{"op": "ping"} checks that the service is alive and {"op": "shutdown"}
+stops it once the pending requests are answered.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import sys
+import time
+import traceback
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from src.audio import render_audio
+from src.data import ROOT_PATH, get_piece_paths
+from src.interpret import INTERPRET_PASSES, interpret
+from src.pipeline import PIPELINE_CACHE_PATH, Pipeline
+
+logger = logging.getLogger(__name__)
+
+SERVICE_SAVE_PATH = ROOT_PATH / "results" / "service"
+PARAMS = [
+    "seed",
+    "pedal_mode",
+    "rescaling_factor",
+    "onset_percentage",
+    "duration_percentage",
+    "transition_window",
+    "profile_amplitude",
+]
+# max number of memoized pass outputs kept in memory by every worker
+MEMORY_SIZE = 256
+
+# pipeline of the worker process, see init_worker
+_pipeline = None
+
+
+class BoundedMemory(OrderedDict):
+    """Dict dropping its least recently used entries above max_size"""
+
+    def __init__(self, max_size):
+        super().__init__()
+        self.max_size = max_size
+
+    def __getitem__(self, key):
+        self.move_to_end(key)
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.move_to_end(key)
+        while len(self) > self.max_size:
+            self.popitem(last=False)
+
+
+def init_worker(cache_path):
+    global _pipeline
+    _pipeline = Pipeline(
+        INTERPRET_PASSES, cache_path=cache_path, memory=BoundedMemory(MEMORY_SIZE)
+    )
+
+
+def get_default_save_path(midi_root_path, params):
+    """
+    Output dir of a request without save_path, one per piece and params so
+    that requests with other seeds or params do not overwrite each other
+    """
+    params_hash = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    return SERVICE_SAVE_PATH / midi_root_path / params_hash.hexdigest()[:12]
+
+
+def generate(request):
+    """
+    Worker: handle one generation request
+
+    Returns:
+        outputs: dict mapping output names to paths
+    """
+    unknown = set(request).difference(
+        PARAMS + ["id", "op", "midi_root_path", "save_path", "save_audio"]
+    )
+    if unknown:
+        raise ValueError(f"Unknown request fields: {sorted(unknown)}")
+    midi_root_path = request["midi_root_path"]
+    params = {name: request[name] for name in PARAMS if name in request}
+    if "save_path" in request:
+        save_path = Path(request["save_path"])
+    else:
+        save_path = get_default_save_path(midi_root_path, params)
+    xml_path, midi_path, performed_midi_paths = get_piece_paths(midi_root_path)
+
+    interpret(
+        str(midi_path),
+        str(xml_path),
+        performed_midi_paths,
+        save_path=save_path,
+        pipeline=_pipeline,
+        return_score=False,
+        **params,
+    )
+    outputs = {
+        "xml_midi": str(save_path / "xml_midi.mid"),
+        "generated_midi": str(save_path / "generated_midi.mid"),
+        "generated_midi_with_pedal": str(save_path / "generated_midi_with_pedal.mid"),
+    }
+    if request.get("save_audio", False):
+        render_audio(list(outputs.values()))
+    return outputs
+
+
+class GenerationService:
+    """
+    Dispatches requests to worker processes. Every piece always goes to the
+    same worker, so that its memoized pass outputs are reused.
+
+    Args:
+        max_workers: number of worker processes
+        cache_path: dir of the on-disk pipeline cache, shared by the workers
+    """
+
+    def __init__(self, max_workers=1, cache_path=PIPELINE_CACHE_PATH):
+        self.workers = [
+            ProcessPoolExecutor(
+                max_workers=1, initializer=init_worker, initargs=(cache_path,)
+            )
+            for _ in range(max_workers)
+        ]
+        self.stopped = asyncio.Event()
+
+    def get_worker(self, midi_root_path):
+        return self.workers[zlib.crc32(midi_root_path.encode()) % len(self.workers)]
+
+    async def handle(self, line):
+        """Answer one request line, never raises"""
+        request_id = None
+        start = time.perf_counter()
+        try:
+            request = json.loads(line)
+            request_id = request.get("id")
+            op = request.get("op", "generate")
+            if op == "ping":
+                return {"id": request_id, "status": "ok"}
+            if op == "shutdown":
+                self.stopped.set()
+                return {"id": request_id, "status": "ok"}
+            if op != "generate":
+                raise ValueError(f"Unknown op: {op}")
+
+            worker = self.get_worker(request["midi_root_path"])
+            loop = asyncio.get_running_loop()
+            outputs = await loop.run_in_executor(worker, generate, request)
+            response = {"id": request_id, "status": "ok", "outputs": outputs}
+        except Exception as e:
+            logger.error("request %s failed:\n%s", request_id, traceback.format_exc())
+            response = {"id": request_id, "status": "error", "error": repr(e)}
+        response["wall_time"] = time.perf_counter() - start
+        logger.info("request %s answered in %.3fs", request_id, response["wall_time"])
+        return response
+
+    async def serve_lines(self, reader, write_line):
+        """
+        Answer the requests of a stream concurrently, responses are written
+        as soon as they are ready (use the "id" field to match them)
+        """
+        pending = set()
+
+        async def answer(line):
+            write_line(json.dumps(await self.handle(line)))
+
+        while not self.stopped.is_set():
+            read = asyncio.ensure_future(reader.readline())
+            stopped = asyncio.ensure_future(self.stopped.wait())
+            await asyncio.wait([read, stopped], return_when=asyncio.FIRST_COMPLETED)
+            stopped.cancel()
+            if not read.done():
+                read.cancel()
+                break
+            line = read.result()
+            if not line:
+                break  # end of the stream
+            if line.strip():
+                task = asyncio.ensure_future(answer(line))
+                pending.add(task)
+                task.add_done_callback(pending.discard)
+        if pending:
+            await asyncio.wait(pending)
+
+    async def serve_stdio(self):
+        loop = asyncio.get_running_loop()
+        reader = asyncio.StreamReader()
+        await loop.connect_read_pipe(
+            lambda: asyncio.StreamReaderProtocol(reader), sys.stdin
+        )
+
+        def write_line(line):
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
+
+        await self.serve_lines(reader, write_line)
+
+    async def serve_socket(self, socket_path):
+        async def serve_connection(reader, writer):
+            await self.serve_lines(
+                reader, lambda line: writer.write(line.encode() + b"\n")
+            )
+            await writer.drain()
+            writer.close()
+
+        server = await asyncio.start_unix_server(serve_connection, path=socket_path)
+        logger.info("listening on %s", socket_path)
+        async with server:
+            await self.stopped.wait()
+
+    def close(self):
+        for worker in self.workers:
+            worker.shutdown()
+
+
+def serve(socket_path=None, max_workers=1, cache_path=PIPELINE_CACHE_PATH):
+    """
+    Run the generation service until the input ends (stdin) or a shutdown
+    request is received
+
+    Args:
+        socket_path: path of the unix socket to listen on (None for stdin/stdout)
+        max_workers: number of worker processes
+        cache_path: dir of the on-disk pipeline cache (None to disable)
+    """
+
+    async def main():
+        service = GenerationService(max_workers, cache_path)
+        try:
+            if socket_path is None:
+                await service.serve_stdio()
+            else:
+                await service.serve_socket(socket_path)
+        finally:
+            service.close()
+
+    asyncio.run(main())
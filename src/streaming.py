@@ -0,0 +1,435 @@
+"""
+Streaming, measure-by-measure generation.
+
+stream_performance yields the same performance as interpret() (for the same
+seed and params), as timed MIDI events, one measure of the score at a time.
+The score passes (music21 passes, rendering and velocity profile) run first
+(and are memoized, see src/pipeline.py). The seeded passes (velocity noise, tempo
+curve, humanization and pedal) then run on one measure at a time, with a
+state bounded by the lookahead they need:
+    - the tempo curve is sampled up to the end of the notes of the measure
+    - a note is only emitted once the notes starting later cannot shorten
+      or drop it anymore (see remove_overlap), which is at most a fraction
+      of a beat after its start for the onset deviations
+    - pedal changes are emitted once the left hand onsets that trigger them
+      are final
+Events of a measure are yielded as soon as no later measure can add events
+before them, so the stream is sorted by time.
+"""
+import logging
+from fractions import Fraction
+
+import numpy as np
+
+from src.data import ANNOTATIONS_PATH
+from src.interpret import (
+    HUMANIZE_BPM,
+    SCORE_PASSES,
+    add_velocity_noise,
+    build_velocity_table,
+    draw_beat_tempos,
+    get_humanize_rngs,
+    get_onset_features,
+    get_pedal_events,
+    get_quarter_positions,
+    get_stage_rngs,
+    randomize_note_duration,
+    randomize_note_onsets,
+    sample_tempo_slots,
+    warp_to_tempo_curve,
+)
+from src.note_array import NOTE_DTYPE, notes_from_pretty_midi, set_pretty_midi_notes
+from src.pipeline import PIPELINE_CACHE_PATH, Pipeline
+
+logger = logging.getLogger(__name__)
+
+# passes run before streaming, up to the velocity profile of the rendered score
+STREAM_PASSES = SCORE_PASSES
+
+# event types, in the order of simultaneous events
+NOTE_OFF = 0
+CONTROL_CHANGE = 1
+NOTE_ON = 2
+
+# timed MIDI events: number and value are pitch and velocity for notes,
+# controller number and value for control changes
+EVENT_DTYPE = np.dtype(
+    [
+        ("time", np.float64),
+        ("type", np.int8),
+        ("number", np.int16),
+        ("value", np.int16),
+        ("instrument", np.int16),
+    ]
+)
+
+# margin for rounding errors on the earliest time of the next measure
+TIME_EPSILON = 1e-6
+
+
+class TempoCurveWindow:
+    """
+    Tempo curve of add_tempo_changes, sampled lazily. Only the slots from
+    first_slot on are kept, see forget_before.
+    """
+
+    def __init__(self, seed=None, slot_length=Fraction(1, 3), tempo_curves=None):
+        self.rng = get_stage_rngs(seed)["tempo"]
+        self.slot_length = slot_length
+        # same draws as get_tempo_curve
+        self.beat_tempos = None
+        if tempo_curves is not None:
+            self.beat_tempos = draw_beat_tempos(tempo_curves, self.rng)
+        self.first_slot = 0
+        self.tempos = np.empty(0)
+        self.slot_starts = np.empty(0)
+        # performance time of the first slot that is not sampled yet
+        self.next_start = 0.0
+
+    def get_slots(self, quarters):
+        return (quarters // float(self.slot_length)).astype(np.int64)
+
+    def sample_until(self, last_slot):
+        n_sampled = self.first_slot + len(self.tempos)
+        if last_slot < n_sampled:
+            return
+        tempos = sample_tempo_slots(
+            np.arange(n_sampled, last_slot + 1),
+            self.rng,
+            self.beat_tempos,
+            self.slot_length,
+        )
+        slot_durations = float(self.slot_length) * 60 / tempos
+        # same summation order as warp_to_tempo_curve on the whole curve
+        starts = np.cumsum(np.concatenate(([self.next_start], slot_durations)))
+        self.tempos = np.concatenate((self.tempos, tempos))
+        self.slot_starts = np.concatenate((self.slot_starts, starts[:-1]))
+        self.next_start = starts[-1]
+
+    def warp(self, quarters):
+        """Performance time of score positions (in quarters)"""
+        if len(quarters) == 0:
+            return np.empty(0)
+        self.sample_until(int(self.get_slots(quarters).max()))
+        return warp_to_tempo_curve(
+            quarters, self.tempos, self.slot_length, self.slot_starts, self.first_slot
+        )
+
+    def forget_before(self, quarter):
+        """Drop the slots before a score position, which will not be warped again"""
+        n_dropped = int(self.get_slots(np.array([quarter]))[0]) - self.first_slot
+        n_dropped = min(max(n_dropped, 0), len(self.tempos))
+        self.tempos = self.tempos[n_dropped:]
+        self.slot_starts = self.slot_starts[n_dropped:]
+        self.first_slot += n_dropped
+
+
+class PendingNotes:
+    """
+    Humanized notes whose events are not all emitted yet. Same-pitch overlaps
+    are resolved as by remove_overlap, once the notes they depend on are known.
+    """
+
+    def __init__(self):
+        self.notes = np.empty(0, dtype=NOTE_DTYPE)
+        # the end of the note is final
+        self.resolved = np.empty(0, dtype=bool)
+        # the note on event was emitted
+        self.started = np.empty(0, dtype=bool)
+
+    def __len__(self):
+        return len(self.notes)
+
+    def add(self, notes):
+        self.notes = np.concatenate((self.notes, notes))
+        self.resolved = np.concatenate((self.resolved, np.zeros(len(notes), bool)))
+        self.started = np.concatenate((self.started, np.zeros(len(notes), bool)))
+
+    def resolve(self, horizon):
+        """Fix the ends that notes starting at or after horizon cannot change"""
+        notes = self.notes
+        # stable sort, same tie order as remove_overlap
+        order = np.lexsort((notes["start"], notes["pitch"], notes["instrument"]))
+        sorted_notes = notes[order]
+        next_start = sorted_notes["start"][1:]
+        has_next = (
+            (sorted_notes["pitch"][1:] == sorted_notes["pitch"][:-1])
+            & (sorted_notes["instrument"][1:] == sorted_notes["instrument"][:-1])
+            & (next_start < horizon)
+        )
+        to_resolve = has_next & ~self.resolved[order[:-1]]
+        index = order[:-1][to_resolve]
+        next_start = next_start[to_resolve]
+        overlap = next_start < notes["end"][index]
+        notes["end"][index[overlap]] = next_start[overlap] - 0.001
+        self.resolved[index] = True
+        # no note starting after horizon can end these ones earlier
+        self.resolved |= notes["end"] <= horizon
+
+    def pop_events(self, horizon):
+        """
+        Final note events before horizon - 0.001, given that the notes added
+        later start at or after horizon
+
+        Returns:
+            note_ons: note array of the notes starting before that time
+            note_offs: note array of the notes ending before that time
+        """
+        self.resolve(horizon)
+        notes = self.notes
+        safe_time = horizon - 0.001
+        ready = notes["start"] < safe_time
+        # notes left without any duration are dropped, as by remove_overlap
+        dropped = ready & ~(notes["end"] > notes["start"])
+        on = ready & ~self.started & ~dropped
+        off = ready & ~dropped & (notes["end"] < safe_time)
+        note_ons, note_offs = notes[on], notes[off]
+
+        self.started |= on
+        keep = ~(dropped | off)
+        self.notes = notes[keep]
+        self.resolved = self.resolved[keep]
+        self.started = self.started[keep]
+        return note_ons, note_offs
+
+
+class PedalStream:
+    """Sustain pedal changes of add_pedal, driven by the streamed left hand onsets"""
+
+    def __init__(self, mode="onset"):
+        self.mode = mode
+        self.previous_feature = None
+        # pedal down from the start
+        self.times = np.array([0.0])
+        self.values = np.array([100.0])
+
+    def add_onsets(self, notes):
+        """Add the left hand notes starting in a time range, all of them at once"""
+        onset_times, features = get_onset_features(notes, self.mode)
+        if len(onset_times) == 0:
+            return
+        if features is None:
+            change_times = onset_times
+        else:
+            changed = np.concatenate(
+                ([features[0] != self.previous_feature], features[1:] != features[:-1])
+            )
+            change_times = onset_times[changed]
+            self.previous_feature = features[-1]
+        times, values = get_pedal_events(change_times)
+        self.times = np.concatenate((self.times, times))
+        self.values = np.concatenate((self.values, values))
+
+    def pop_events(self, safe_time):
+        """Pedal changes before safe_time, as a pair of arrays (times, values)"""
+        emitted = self.times < safe_time
+        times, values = self.times[emitted], self.values[emitted]
+        self.times, self.values = self.times[~emitted], self.values[~emitted]
+        return times, values
+
+
+def make_events(note_ons, note_offs, pedal_times, pedal_values):
+    """Event array sorted by time, then type and value"""
+    events = np.empty(len(note_ons) + len(note_offs) + len(pedal_times), EVENT_DTYPE)
+    parts = [
+        (note_offs["end"], NOTE_OFF, note_offs["pitch"], 0, note_offs["instrument"]),
+        (pedal_times, CONTROL_CHANGE, 64, pedal_values, 0),
+        (
+            note_ons["start"],
+            NOTE_ON,
+            note_ons["pitch"],
+            note_ons["velocity"],
+            note_ons["instrument"],
+        ),
+    ]
+    i = 0
+    for time, event_type, number, value, instrument in parts:
+        part = events[i : i + len(time)]
+        part["time"] = time
+        part["type"] = event_type
+        part["number"] = number
+        part["value"] = value
+        part["instrument"] = instrument
+        i += len(time)
+    order = np.lexsort(
+        (
+            events["instrument"],
+            events["number"],
+            events["value"],
+            events["type"],
+            events["time"],
+        )
+    )
+    return events[order]
+
+
+def stream_rendered_score(
+    midi_data,
+    avgs,
+    stds,
+    tempo_curves=None,
+    seed=None,
+    pedal_mode="onset",
+    rescaling_factor=10,
+    onset_percentage=1,
+    duration_percentage=5,
+):
+    """
+    Run the seeded passes of interpret() on a rendered score, measure by measure
+
+    Args:
+        midi_data: PrettyMIDI of the score, output of the
+                   "apply_velocity_profile" pass
+        avgs, stds: velocity statistics, outputs of the "idea_13_stats" pass
+        tempo_curves: learned tempo curves, output of the "tempo_curves" pass
+        seed, pedal_mode, rescaling_factor, onset_percentage,
+        duration_percentage: see interpret
+
+    Yields:
+        measure: int index of the measure (in the downbeats of midi_data)
+        events: EVENT_DTYPE array of the events that are final once the
+                measure is generated, sorted by time
+    """
+    notes = notes_from_pretty_midi(midi_data)
+    downbeats = midi_data.get_downbeats()
+    # notes of measure k are notes[bounds[k]:bounds[k + 1]]
+    bounds = np.concatenate(
+        ([0], np.searchsorted(notes["start"], downbeats[1:]), [len(notes)])
+    )
+    downbeat_quarters = get_quarter_positions(midi_data, downbeats[1:])
+    # earliest onset deviation of randomize_note_onsets
+    max_shift = 60 / HUMANIZE_BPM * onset_percentage / 100 + TIME_EPSILON
+
+    table = build_velocity_table(avgs, stds)
+    velocity_rng = get_stage_rngs(seed)["velocity"]
+    tempo_curve = TempoCurveWindow(seed, tempo_curves=tempo_curves)
+    onset_rng, duration_rng = get_humanize_rngs(seed)
+    pending = PendingNotes()
+    pedal = PedalStream(pedal_mode)
+
+    n_measures = len(bounds) - 1
+    for measure in range(n_measures):
+        chunk = notes[bounds[measure] : bounds[measure + 1]].copy()
+        # same stages as the apply_idea_13, add_tempo_changes and randomize passes
+        chunk["velocity"] = add_velocity_noise(
+            chunk, table, rescaling_factor, velocity_rng
+        )
+        chunk["end"] = tempo_curve.warp(get_quarter_positions(midi_data, chunk["end"]))
+        chunk["start"] = tempo_curve.warp(
+            get_quarter_positions(midi_data, chunk["start"])
+        )
+        chunk = randomize_note_onsets(chunk, onset_percentage, onset_rng)
+        chunk = randomize_note_duration(chunk, duration_percentage, duration_rng)
+        pending.add(chunk)
+
+        if measure == n_measures - 1:
+            horizon = np.inf
+        else:
+            # notes of the next measures cannot start earlier
+            next_downbeat = downbeat_quarters[measure : measure + 1]
+            horizon = tempo_curve.warp(next_downbeat)[0] - max_shift
+            tempo_curve.forget_before(next_downbeat[0])
+
+        note_ons, note_offs = pending.pop_events(horizon)
+        pedal.add_onsets(note_ons[note_ons["instrument"] == 1])
+        pedal_times, pedal_values = pedal.pop_events(horizon - 0.001)
+        yield measure, make_events(note_ons, note_offs, pedal_times, pedal_values)
+
+
+def stream_performance(
+    unperformed_midi_path,
+    xml_path,
+    performed_midi_paths,
+    seed=None,
+    pedal_mode="onset",
+    rescaling_factor=10,
+    onset_percentage=1,
+    duration_percentage=5,
+    transition_window=4.0,
+    profile_amplitude=1.0,
+    cache_path=PIPELINE_CACHE_PATH,
+    memory=None,
+):
+    """
+    Generator version of interpret(): same arguments and same performance
+    (the one with pedal, hands in separate instruments), yielded measure by
+    measure as timed MIDI events instead of written to files.
+
+    The score passes run (or are loaded from the cache) before the first
+    measure, see STREAM_PASSES. memory is an optional in-memory memo of
+    their outputs, see Pipeline.
+
+    Yields:
+        measure, events: see stream_rendered_score
+    """
+    pipeline = Pipeline(STREAM_PASSES, cache_path=cache_path, memory=memory)
+    values = pipeline.run(
+        sources={
+            "unperformed_midi_path": unperformed_midi_path,
+            "xml_path": xml_path,
+            "performed_midi_paths": list(performed_midi_paths),
+            "annotations_path": ANNOTATIONS_PATH,
+        },
+        params={
+            "transition_window": transition_window,
+            "profile_amplitude": profile_amplitude,
+        },
+        outputs=["midi_data", "avgs", "stds", "tempo_curves"],
+    )
+    yield from stream_rendered_score(
+        values.pop("midi_data"),
+        values["avgs"],
+        values["stds"],
+        values["tempo_curves"],
+        seed=seed,
+        pedal_mode=pedal_mode,
+        rescaling_factor=rescaling_factor,
+        onset_percentage=onset_percentage,
+        duration_percentage=duration_percentage,
+    )
+
+
+def events_to_pretty_midi(events, merge_hands=True):
+    """
+    Collect streamed events into a PrettyMIDI object
+
+    Args:
+        events: EVENT_DTYPE array (e.g. the concatenation of the stream)
+        merge_hands: put all notes in the first instrument, as in the
+                     generated_midi_with_pedal.mid of interpret()
+
+    Returns:
+        midi_data: pretty_midi.PrettyMIDI
+    """
+    import pretty_midi
+
+    # the notes of a pitch do not overlap, so the k-th note off of a pitch
+    # (and instrument) ends its k-th note on
+    paired = []
+    for event_type in [NOTE_ON, NOTE_OFF]:
+        typed = events[events["type"] == event_type]
+        paired.append(
+            typed[np.lexsort((typed["time"], typed["number"], typed["instrument"]))]
+        )
+    note_ons, note_offs = paired
+    if len(note_ons) != len(note_offs):
+        raise ValueError("Unmatched note on and note off events")
+    notes = np.empty(len(note_ons), dtype=NOTE_DTYPE)
+    notes["start"] = note_ons["time"]
+    notes["end"] = note_offs["time"]
+    notes["pitch"] = note_ons["number"]
+    notes["velocity"] = note_ons["value"]
+    notes["instrument"] = 0 if merge_hands else note_ons["instrument"]
+
+    midi_data = pretty_midi.PrettyMIDI()
+    n_instruments = 1 if len(notes) == 0 else int(notes["instrument"].max()) + 1
+    midi_data.instruments = [pretty_midi.Instrument(0) for _ in range(n_instruments)]
+    set_pretty_midi_notes(midi_data, notes)
+    control_changes = events[events["type"] == CONTROL_CHANGE]
+    for cc in control_changes:
+        midi_data.instruments[cc["instrument"]].control_changes.append(
+            pretty_midi.ControlChange(
+                number=int(cc["number"]), value=int(cc["value"]), time=float(cc["time"])
+            )
+        )
+    return midi_data
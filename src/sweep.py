@@ -0,0 +1,280 @@
+"""
+Parameter sweeps of interpret() over a grid of parameter combinations.
+
+The score is parsed and analysed once: the score passes (SCORE_PASSES) run
+once per combination of the score params (SCORE_PARAMS), and only re-execute
+the passes that use them (the idea_13 statistics, tempo curves and velocity
+profile are computed once in total). The seeded array passes of every
+combination then run in a process pool. Workers are forked after the
+analyses, so they share the analysed state copy-on-write instead of
+receiving a copy of it.
+
+    python -m src.sweep Schubert/Impromptu_op.90_D.899/3 --rescaling_factor 5 10 20 \
+        --onset_percentage 1 2 --profile_amplitude 0.5 1 1.5
+
+The outputs of the k-th combination are written to <save_path>/<k:04d> and
+<save_path>/manifest.json maps every parameter set to its MIDI files (and
+to its metrics against the human performances with --evaluate, see
+src/evaluation.py).
+"""
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from src.data import ANNOTATIONS_PATH, ROOT_PATH, get_piece_paths
+from src.evaluation import evaluate, get_reference
+from src.instrumentation import setup_logging
+from src.interpret import INTERPRET_PASSES, SCORE_PASSES, copy_pretty_midi
+from src.note_array import notes_from_pretty_midi
+from src.pipeline import PASSES, PIPELINE_CACHE_PATH, Pipeline
+
+logger = logging.getLogger(__name__)
+
+SWEEP_SAVE_PATH = ROOT_PATH / "results" / "sweep"
+# params of the score passes, every value needs a new analysis of the score
+SCORE_PARAMS = ["transition_window", "profile_amplitude"]
+DEFAULT_PARAMS = {
+    "transition_window": 4.0,
+    "profile_amplitude": 1.0,
+    # same seed for all combinations, so that they only differ by the swept params
+    "seed": 0,
+    "pedal_mode": "onset",
+    "rescaling_factor": 10,
+    "onset_percentage": 1,
+    "duration_percentage": 5,
+}
+ANALYSIS_PASSES = SCORE_PASSES
+PERFORMANCE_PASSES = INTERPRET_PASSES[len(SCORE_PASSES) :]
+
+# analysed state of every combination of score params and human side of
+# the metrics (None if not evaluated), inherited by the forked workers, see sweep
+_analyses = {}
+_reference = None
+
+
+def get_combinations(grid):
+    """
+    All combinations of a grid of params
+
+    Args:
+        grid: dict mapping param names to lists of values, the other
+              params take their DEFAULT_PARAMS value
+
+    Returns:
+        combinations: list of dicts with every param of DEFAULT_PARAMS
+    """
+    unknown = set(grid).difference(DEFAULT_PARAMS)
+    if unknown:
+        raise ValueError(f"Unknown sweep params: {sorted(unknown)}")
+    names = list(grid)
+    return [
+        {**DEFAULT_PARAMS, **dict(zip(names, values))}
+        for values in itertools.product(*(grid[name] for name in names))
+    ]
+
+
+def get_score_key(params):
+    return tuple(params[name] for name in SCORE_PARAMS)
+
+
+def init_worker(analyses, reference):
+    global _reference
+    _analyses.update(analyses)
+    _reference = reference
+
+
+def render_combination(params, save_path):
+    """
+    Worker: run the performance passes of one combination on the shared
+    analysed state and write its MIDI files
+
+    Returns:
+        outputs: dict mapping output names to paths
+        metrics: dict of metrics (None if not evaluated), see evaluate
+        wall_time: float
+    """
+    start = time.perf_counter()
+    analysis = _analyses[get_score_key(params)]
+    values = {
+        # the passes replace the note lists, the shared notes are not modified
+        "midi_data": copy_pretty_midi(analysis["midi_data"]),
+        "avgs": analysis["avgs"],
+        "stds": analysis["stds"],
+        "tempo_curves": analysis["tempo_curves"],
+    }
+    for name in PERFORMANCE_PASSES:
+        values.update(PASSES[name](values, params))
+
+    save_path = Path(save_path)
+    save_path.mkdir(exist_ok=True, parents=True)
+    outputs = {
+        "generated_midi": str(save_path / "generated_midi.mid"),
+        "generated_midi_with_pedal": str(save_path / "generated_midi_with_pedal.mid"),
+    }
+    values["midi_data"].write(outputs["generated_midi"])
+    values["pedal_midi_data"].write(outputs["generated_midi_with_pedal"])
+    metrics = None
+    if _reference is not None:
+        metrics = evaluate(
+            notes_from_pretty_midi(values["pedal_midi_data"]), _reference
+        )
+    return outputs, metrics, time.perf_counter() - start
+
+
+def sweep(
+    unperformed_midi_path,
+    xml_path,
+    performed_midi_paths,
+    grid,
+    save_path=SWEEP_SAVE_PATH,
+    max_workers=None,
+    cache_path=PIPELINE_CACHE_PATH,
+    compute_metrics=False,
+):
+    """
+    Generate a performance for every combination of a grid of params
+
+    Args:
+        unperformed_midi_path, xml_path, performed_midi_paths: see interpret
+        grid: dict mapping param names (keys of DEFAULT_PARAMS) to lists of values
+        save_path: dir of the outputs and of manifest.json
+        max_workers: size of the process pool (None for the number of CPUs)
+        cache_path: dir of the on-disk pipeline cache (None to disable)
+        compute_metrics: if True, every performance is compared with the
+                  performed_midi_paths, see src/evaluation.py
+
+    Returns:
+        manifest: list of {"params", "outputs", "metrics", "wall_time"}
+                  dicts, in the order of the combinations
+    """
+    global _reference
+    save_path = Path(save_path)
+    combinations = get_combinations(grid)
+    sources = {
+        "unperformed_midi_path": unperformed_midi_path,
+        "xml_path": xml_path,
+        "performed_midi_paths": list(performed_midi_paths),
+        "annotations_path": ANNOTATIONS_PATH,
+    }
+
+    # the parsed score and the statistics are memoized in memory, so every
+    # combination of score params only re-runs the passes that use them
+    pipeline = Pipeline(ANALYSIS_PASSES, cache_path=cache_path, memory={})
+    _analyses.clear()
+    for params in combinations:
+        score_key = get_score_key(params)
+        if score_key in _analyses:
+            continue
+        logger.info("analysing the score with %s", dict(zip(SCORE_PARAMS, score_key)))
+        _analyses[score_key] = pipeline.run(
+            sources=sources,
+            params={name: params[name] for name in SCORE_PARAMS},
+            outputs=["score_midi", "midi_data", "avgs", "stds", "tempo_curves"],
+        )
+
+    _reference = None
+    if compute_metrics:
+        logger.info("computing the metrics of the performances")
+        _reference = get_reference(unperformed_midi_path, performed_midi_paths)
+
+    # the score as written does not depend on the params
+    save_path.mkdir(exist_ok=True, parents=True)
+    with open(save_path / "xml_midi.mid", "wb") as f:
+        f.write(_analyses[get_score_key(combinations[0])]["score_midi"])
+
+    if "fork" in multiprocessing.get_all_start_methods():
+        pool_options = {"mp_context": multiprocessing.get_context("fork")}
+    else:
+        logger.warning("fork is not available, the analyses are copied to every worker")
+        pool_options = {
+            "initializer": init_worker,
+            "initargs": (dict(_analyses), _reference),
+        }
+    logger.info("rendering %d combinations", len(combinations))
+    with ProcessPoolExecutor(max_workers=max_workers, **pool_options) as executor:
+        futures = [
+            executor.submit(render_combination, params, save_path / f"{i:04d}")
+            for i, params in enumerate(combinations)
+        ]
+        manifest = []
+        for params, future in zip(combinations, futures):
+            outputs, metrics, wall_time = future.result()
+            manifest.append(
+                {
+                    "params": params,
+                    "outputs": outputs,
+                    "metrics": metrics,
+                    "wall_time": wall_time,
+                }
+            )
+
+    with open(save_path / "manifest.json", "w") as f:
+        json.dump(
+            {"xml_midi": str(save_path / "xml_midi.mid"), "runs": manifest},
+            f,
+            indent=2,
+        )
+    logger.info("wrote %s", save_path / "manifest.json")
+    return manifest
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(
+        description="Generate performances over a grid of interpret() params"
+    )
+    args.add_argument(
+        "midi_root_path",
+        type=str,
+        help="Path of the piece, relative to the ASAP dataset",
+    )
+    for name, default in DEFAULT_PARAMS.items():
+        args.add_argument(
+            f"--{name}",
+            default=[default],
+            nargs="+",
+            type={"seed": int, "pedal_mode": str}.get(name, float),
+            help=f"Values of {name} (default: {default})",
+        )
+    args.add_argument(
+        "--save_path",
+        default=None,
+        type=str,
+        help="Output dir (default: results/sweep/<midi_root_path>)",
+    )
+    args.add_argument(
+        "--workers",
+        default=None,
+        type=int,
+        help="Number of worker processes (default: number of CPUs)",
+    )
+    args.add_argument(
+        "--evaluate",
+        action="store_true",
+        help="Compare every generated performance with the human ones and "
+        "store the metrics in the manifest (default: False)",
+    )
+    args.add_argument(
+        "--log_level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        type=str,
+        help="Logging level (default: INFO)",
+    )
+    args = args.parse_args()
+    setup_logging(args.log_level)
+
+    xml_path, midi_path, performed_midi_paths = get_piece_paths(args.midi_root_path)
+    sweep(
+        str(midi_path),
+        str(xml_path),
+        performed_midi_paths,
+        grid={name: getattr(args, name) for name in DEFAULT_PARAMS},
+        save_path=args.save_path or SWEEP_SAVE_PATH / args.midi_root_path,
+        max_workers=args.workers,
+        compute_metrics=args.evaluate,
+    )
@@ -0,0 +1,555 @@
+"""
+Generator of synthetic ASAP-shaped corpora, used to load-test ingestion,
+fitting and generation on corpora much larger than the real one.
+
+Usage (from the repository root):
+    python -m src.synthetic data/synthetic-asap --composers 10 --pieces 20 --performances 5
+    ASAP_DATASET_PATH=data/synthetic-asap python run_transfer.py -m Composer00/Piece000
+"""
+import argparse
+import csv
+import json
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pretty_midi
+
+from src.note_array import NOTE_DTYPE
+
+TIME_SIGNATURES = [2, 3, 4]  # beats per measure, the beat is always a quarter
+DIVISIONS = 6  # MusicXML divisions per quarter, allows triplet eighths
+SCORE_VELOCITY = 64
+# velocity of the dynamic marks in the generated performances
+DYNAMICS_VELOCITY = {"pp": 30, "p": 45, "mp": 55, "mf": 65, "f": 80, "ff": 95}
+# velocity change at the end of a crescendo/diminuendo
+WEDGE_VELOCITY_CHANGE = 12
+MELODY_VELOCITY_INCREASE = 10
+
+MAJOR_SCALE = np.array([0, 2, 4, 5, 7, 9, 11])
+SHARP_SPELLING = [
+    ("C", 0),
+    ("C", 1),
+    ("D", 0),
+    ("D", 1),
+    ("E", 0),
+    ("F", 0),
+    ("F", 1),
+    ("G", 0),
+    ("G", 1),
+    ("A", 0),
+    ("A", 1),
+    ("B", 0),
+]
+FLAT_SPELLING = [
+    ("C", 0),
+    ("D", -1),
+    ("D", 0),
+    ("E", -1),
+    ("E", 0),
+    ("F", 0),
+    ("G", -1),
+    ("G", 0),
+    ("A", -1),
+    ("A", 0),
+    ("B", -1),
+    ("B", 0),
+]
+
+METADATA_COLUMNS = [
+    "composer",
+    "title",
+    "folder",
+    "xml_score",
+    "midi_score",
+    "midi_performance",
+    "performance_annotations",
+    "midi_score_annotations",
+    "maestro_midi_performance",
+    "maestro_audio_performance",
+    "start",
+    "end",
+    "audio_performance",
+]
+
+
+def scale_pitches(fifths, low, high):
+    """Pitches in [low, high) of the major key with the given key signature"""
+    tonic = (7 * fifths) % 12
+    pitches = np.arange(low, high)
+    return pitches[np.isin((pitches - tonic) % 12, MAJOR_SCALE)]
+
+
+def note_to_xml(pitch, fifths, voice, triplet=False):
+    step, alter = (SHARP_SPELLING if fifths >= 0 else FLAT_SPELLING)[pitch % 12]
+    alter = f"<alter>{alter}</alter>" if alter else ""
+    if triplet:
+        duration, note_type = DIVISIONS // 3, "eighth"
+        time_modification = (
+            "<time-modification><actual-notes>3</actual-notes>"
+            "<normal-notes>2</normal-notes></time-modification>"
+        )
+    else:
+        duration, note_type, time_modification = DIVISIONS, "quarter", ""
+    return (
+        f"<note><pitch><step>{step}</step>{alter}<octave>{pitch // 12 - 1}</octave>"
+        f"</pitch><duration>{duration}</duration><voice>{voice}</voice>"
+        f"<type>{note_type}</type>{time_modification}</note>"
+    )
+
+
+def direction_to_xml(content, placement="below", sound=""):
+    return (
+        f'<direction placement="{placement}"><direction-type>{content}'
+        f"</direction-type>{sound}</direction>"
+    )
+
+
+def generate_score(rng, n_measures):
+    """
+    Random two-hand piece: a quarter-note melody (voice 1) over triplet eighth
+    arpeggios (voice 2) in the right hand and a quarter-note bass in the left
+    hand, with a dynamic mark every 4 measures and a few 2-measure wedges.
+
+    Args:
+        rng: np.random.Generator
+        n_measures: int number of measures
+
+    Returns:
+        score: dict with the MusicXML string ("xml"), the note array ("notes",
+               times in quarters, instrument 0 for the right hand and 1 for
+               the left hand), a melody mask ("melody"), the target velocity
+               of every beat ("beat_velocities"), "beats_per_measure",
+               "fifths" and "bpm"
+    """
+    beats_per_measure = int(rng.choice(TIME_SIGNATURES))
+    fifths = int(rng.integers(-6, 7))
+    bpm = int(rng.integers(60, 140))
+    tonic = (7 * fifths) % 12
+    melody_pitches = scale_pitches(fifths, 67, 84)
+    melody_index = len(melody_pitches) // 2
+
+    parts_xml = [[], []]
+    notes = []  # (onset, offset, pitch, hand, is melody)
+    beat_velocities = []
+    dynamic = "mf"
+    wedge, wedge_start = 0, None
+    for m in range(n_measures):
+        measure_xml = [[], []]
+        if m == 0:
+            for hand, clef in enumerate(["G", "F"]):
+                line = 2 if clef == "G" else 4
+                measure_xml[hand].append(
+                    f"<attributes><divisions>{DIVISIONS}</divisions>"
+                    f"<key><fifths>{fifths}</fifths></key>"
+                    f"<time><beats>{beats_per_measure}</beats><beat-type>4</beat-type></time>"
+                    f"<clef><sign>{clef}</sign><line>{line}</line></clef></attributes>"
+                )
+            measure_xml[0].append(
+                direction_to_xml(
+                    "<metronome><beat-unit>quarter</beat-unit>"
+                    f"<per-minute>{bpm}</per-minute></metronome>",
+                    placement="above",
+                    sound=f'<sound tempo="{bpm}"/>',
+                )
+            )
+
+        # dynamics: a mark every 4 measures, wedges span 2 measures in between
+        if m % 4 == 0:
+            dynamic = str(rng.choice(list(DYNAMICS_VELOCITY)))
+            measure_xml[0].append(
+                direction_to_xml(f"<dynamics><{dynamic}/></dynamics>")
+            )
+        elif wedge_start is None and m % 4 < 3 and rng.random() < 0.3:
+            wedge, wedge_start = int(rng.choice([-1, 1])), m
+            wedge_type = "crescendo" if wedge > 0 else "diminuendo"
+            measure_xml[0].append(direction_to_xml(f'<wedge type="{wedge_type}"/>'))
+        velocities = np.full(beats_per_measure, float(DYNAMICS_VELOCITY[dynamic]))
+        if wedge_start is not None:
+            position = (m - wedge_start) * beats_per_measure + np.arange(
+                beats_per_measure
+            )
+            velocities += (
+                wedge * WEDGE_VELOCITY_CHANGE * position / (2 * beats_per_measure)
+            )
+        beat_velocities.extend(velocities)
+
+        # harmony: I, IV, V or vi for the whole measure
+        degree = int(rng.choice([0, 3, 4, 5]))
+        root = tonic + MAJOR_SCALE[degree]
+        third = 3 if degree == 5 else 4
+        accompaniment = 55 + (root + np.array([0, third, 7]) - 55) % 12
+        bass = 36 + (root - 36) % 12
+
+        for beat in range(beats_per_measure):
+            onset = m * beats_per_measure + beat
+            melody_index = int(
+                np.clip(melody_index + rng.integers(-2, 3), 0, len(melody_pitches) - 1)
+            )
+            melody = int(melody_pitches[melody_index])
+            measure_xml[0].append(note_to_xml(melody, fifths, voice=1))
+            notes.append((onset, onset + 1, melody, 0, True))
+
+            bass_pitch = int(bass if beat % 2 == 0 else bass + 7)
+            measure_xml[1].append(note_to_xml(bass_pitch, fifths, voice=1))
+            notes.append((onset, onset + 1, bass_pitch, 1, False))
+
+        if wedge_start is not None and m == wedge_start + 1:
+            measure_xml[0].append(direction_to_xml('<wedge type="stop"/>'))
+            wedge_start = None
+        measure_xml[0].append(
+            f"<backup><duration>{beats_per_measure * DIVISIONS}</duration></backup>"
+        )
+        for beat in range(beats_per_measure):
+            for k in range(3):
+                onset = m * beats_per_measure + beat + k / 3
+                pitch = int(accompaniment[k])
+                measure_xml[0].append(note_to_xml(pitch, fifths, voice=2, triplet=True))
+                notes.append((onset, onset + 1 / 3, pitch, 0, False))
+
+        for hand in range(2):
+            parts_xml[hand].append(
+                f'<measure number="{m + 1}">{"".join(measure_xml[hand])}</measure>'
+            )
+
+    xml = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<!DOCTYPE score-partwise PUBLIC "-//Recordare//DTD MusicXML 3.1 Partwise//EN" '
+        '"http://www.musicxml.org/dtds/partwise.dtd">\n'
+        '<score-partwise version="3.1"><part-list>'
+        '<score-part id="P1"><part-name>Right Hand</part-name></score-part>'
+        '<score-part id="P2"><part-name>Left Hand</part-name></score-part>'
+        "</part-list>"
+        f'<part id="P1">{"".join(parts_xml[0])}</part>'
+        f'<part id="P2">{"".join(parts_xml[1])}</part>'
+        "</score-partwise>\n"
+    )
+
+    start, end, pitch, hand, melody = (np.array(column) for column in zip(*notes))
+    note_array = np.zeros(len(notes), dtype=NOTE_DTYPE)
+    note_array["start"] = start
+    note_array["end"] = end
+    note_array["pitch"] = pitch
+    note_array["velocity"] = SCORE_VELOCITY
+    note_array["instrument"] = hand
+    order = np.lexsort((note_array["pitch"], note_array["start"]))
+
+    return {
+        "xml": xml,
+        "notes": note_array[order],
+        "melody": melody[order],
+        "beat_velocities": np.array(beat_velocities),
+        "beats_per_measure": beats_per_measure,
+        "fifths": fifths,
+        "bpm": bpm,
+    }
+
+
+def generate_performance(
+    rng, score_notes, melody, score_beats, beat_velocities, beats_per_measure
+):
+    """
+    Expressive version of a score: smooth tempo deviations with phrase-final
+    ritardandi, onset jitter, articulation, dynamics and a few missed notes.
+
+    Args:
+        rng: np.random.Generator
+        score_notes: note array of the score MIDI (times in seconds)
+        melody: bool np.ndarray, True for the melody notes
+        score_beats: np.ndarray with the times of the score beats
+        beat_velocities: np.ndarray with the target velocity of every beat
+        beats_per_measure: int
+
+    Returns:
+        notes: note array of the performance (on a single instrument)
+        performance_beats: np.ndarray with the performed times of the beats
+    """
+    n_beats = len(score_beats)
+    beat_duration = score_beats[1] - score_beats[0]
+
+    # per-beat tempo: mean-reverting random walk, ritardando every 4 measures
+    log_tempo = np.zeros(n_beats)
+    steps = rng.normal(0, 0.03, n_beats)
+    for i in range(1, n_beats):
+        log_tempo[i] = 0.9 * log_tempo[i - 1] + steps[i]
+    phrase_length = 4 * beats_per_measure
+    log_tempo[np.arange(n_beats) % phrase_length == phrase_length - 1] += 0.25
+    durations = beat_duration * rng.uniform(0.85, 1.2) * np.exp(log_tempo)
+    # one extra beat to warp the notes after the last annotated beat
+    beats = rng.uniform(0.5, 1.5) + np.concatenate(([0], np.cumsum(durations)))
+    extended_score_beats = np.append(score_beats, score_beats[-1] + beat_duration)
+
+    keep = rng.random(len(score_notes)) > 0.01
+    notes = score_notes[keep].copy()
+    onsets = np.interp(notes["start"], extended_score_beats, beats)
+    ends = np.interp(notes["end"], extended_score_beats, beats)
+    articulation = rng.uniform(0.7, 1.05, len(notes))
+    notes["start"] = np.maximum(onsets + rng.normal(0, 0.01, len(notes)), 0)
+    notes["end"] = notes["start"] + np.maximum((ends - onsets) * articulation, 0.02)
+
+    beat_index = np.searchsorted(score_beats, score_notes["start"][keep], side="right")
+    velocity = beat_velocities[np.clip(beat_index - 1, 0, n_beats - 1)]
+    velocity += MELODY_VELOCITY_INCREASE * melody[keep]
+    velocity += rng.normal(0, 6, len(notes))
+    notes["velocity"] = np.clip(np.round(velocity), 1, 127)
+    notes["instrument"] = 0
+    return notes, beats[:n_beats]
+
+
+def write_midi(path, notes, n_instruments, bpm=120.0):
+    midi_data = pretty_midi.PrettyMIDI(initial_tempo=bpm)
+    midi_data.instruments = [pretty_midi.Instrument(0) for _ in range(n_instruments)]
+    for start, end, pitch, velocity, instrument in notes.tolist():
+        midi_data.instruments[instrument].notes.append(
+            pretty_midi.Note(velocity=velocity, pitch=pitch, start=start, end=end)
+        )
+    midi_data.write(str(path))
+
+
+def write_beat_annotations(path, beats, beats_per_measure, fifths):
+    """Beat annotations in the ASAP text format (time, time, type)"""
+    with open(path, "w") as f:
+        for i, beat in enumerate(beats):
+            if i == 0:
+                beat_type = f"db,{beats_per_measure}/4,{fifths}"
+            elif i % beats_per_measure == 0:
+                beat_type = "db"
+            else:
+                beat_type = "b"
+            f.write(f"{beat:.6f}\t{beat:.6f}\t{beat_type}\n")
+
+
+def write_synthetic_piece(
+    dataset_path, composer, title, n_performances, n_measures, seed
+):
+    """
+    Write the files of one piece and return its metadata rows and annotations
+
+    Args:
+        dataset_path: Path to the root of the synthetic dataset
+        composer: str composer name (first level of the tree)
+        title: str piece name (second level of the tree)
+        n_performances: int number of performances of the piece
+        n_measures: int number of measures of the piece
+        seed: list of int seeding the piece generator
+
+    Returns:
+        rows: list of metadata.csv rows (dicts), one per performance
+        annotations: dict mapping performance paths to their annotations
+    """
+    rng = np.random.default_rng(seed)
+    folder = f"{composer}/{title}"
+    (dataset_path / folder).mkdir(parents=True, exist_ok=True)
+
+    score = generate_score(rng, n_measures)
+    with open(dataset_path / folder / "xml_score.musicxml", "w") as f:
+        f.write(score["xml"])
+
+    # score MIDI at the score tempo
+    seconds_per_beat = 60 / score["bpm"]
+    score_notes = score["notes"].copy()
+    score_notes["start"] *= seconds_per_beat
+    score_notes["end"] *= seconds_per_beat
+    write_midi(dataset_path / folder / "midi_score.mid", score_notes, 2, score["bpm"])
+
+    beats_per_measure = score["beats_per_measure"]
+    score_beats = seconds_per_beat * np.arange(n_measures * beats_per_measure)
+    downbeats = np.arange(0, len(score_beats), beats_per_measure)
+    beats_type = [
+        "db" if i % beats_per_measure == 0 else "b" for i in range(len(score_beats))
+    ]
+    time_signature = [f"{beats_per_measure}/4", beats_per_measure]
+    key_signature = [int((7 * score["fifths"]) % 12), abs(score["fifths"])]
+    write_beat_annotations(
+        dataset_path / folder / "midi_score_annotations.txt",
+        score_beats,
+        beats_per_measure,
+        score["fifths"],
+    )
+
+    rows = []
+    annotations = {}
+    for k in range(n_performances):
+        performance_notes, performance_beats = generate_performance(
+            rng,
+            score_notes,
+            score["melody"],
+            score_beats,
+            score["beat_velocities"],
+            beats_per_measure,
+        )
+        performance_name = f"Performer{k:02d}"
+        write_midi(
+            dataset_path / folder / f"{performance_name}.mid", performance_notes, 1
+        )
+        write_beat_annotations(
+            dataset_path / folder / f"{performance_name}_annotations.txt",
+            performance_beats,
+            beats_per_measure,
+            score["fifths"],
+        )
+
+        performance_path = f"{folder}/{performance_name}.mid"
+        rows.append(
+            {
+                "composer": composer,
+                "title": title,
+                "folder": folder,
+                "xml_score": f"{folder}/xml_score.musicxml",
+                "midi_score": f"{folder}/midi_score.mid",
+                "midi_performance": performance_path,
+                "performance_annotations": f"{folder}/{performance_name}_annotations.txt",
+                "midi_score_annotations": f"{folder}/midi_score_annotations.txt",
+                "maestro_midi_performance": "",
+                "maestro_audio_performance": "",
+                "start": "",
+                "end": "",
+                "audio_performance": "",
+            }
+        )
+        annotations[performance_path] = {
+            "performance_beats": performance_beats.tolist(),
+            "performance_downbeats": performance_beats[downbeats].tolist(),
+            "performance_beats_type": dict(
+                zip(map(str, performance_beats), beats_type)
+            ),
+            "perf_time_signatures": {str(performance_beats[0]): time_signature},
+            "perf_key_signatures": {str(performance_beats[0]): key_signature},
+            "midi_score_beats": score_beats.tolist(),
+            "midi_score_downbeats": score_beats[downbeats].tolist(),
+            "midi_score_beats_type": dict(zip(map(str, score_beats), beats_type)),
+            "midi_score_time_signatures": {"0.0": time_signature},
+            "midi_score_key_signatures": {"0.0": key_signature},
+            "downbeats_score_map": list(range(len(downbeats))),
+            "score_and_performance_aligned": True,
+        }
+    return rows, annotations
+
+
+def write_synthetic_asap(
+    dataset_path,
+    n_composers=4,
+    n_pieces=5,
+    n_performances=3,
+    n_measures=32,
+    seed=0,
+    max_workers=None,
+):
+    """
+    Write a fake ASAP dataset: n_composers x n_pieces pieces, each with a
+    MusicXML score, a score MIDI and n_performances jittered performances,
+    plus metadata.csv and asap_annotations.json. Pieces are generated in a
+    process pool, each from its own seed, so the output does not depend
+    on max_workers.
+
+    Args:
+        dataset_path: str or Path to the root of the dataset (created)
+        n_composers: int number of composers
+        n_pieces: int number of pieces per composer
+        n_performances: int number of performances per piece
+        n_measures: int number of measures per piece
+        seed: int global seed
+        max_workers: size of the process pool (None for the number of CPUs)
+
+    Returns:
+        n_written: int number of written performances
+    """
+    dataset_path = Path(dataset_path)
+    dataset_path.mkdir(parents=True, exist_ok=True)
+
+    jobs = [
+        (f"Composer{c:02d}", f"Piece{p:03d}", [seed, c, p])
+        for c in range(n_composers)
+        for p in range(n_pieces)
+    ]
+    composers, titles, seeds = zip(*jobs)
+    n_jobs = len(jobs)
+    arguments = (
+        [dataset_path] * n_jobs,
+        composers,
+        titles,
+        [n_performances] * n_jobs,
+        [n_measures] * n_jobs,
+        seeds,
+    )
+    if max_workers == 1:
+        results = list(map(write_synthetic_piece, *arguments))
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(write_synthetic_piece, *arguments))
+
+    rows = []
+    annotations = {}
+    for piece_rows, piece_annotations in results:
+        rows.extend(piece_rows)
+        annotations.update(piece_annotations)
+
+    with open(dataset_path / "metadata.csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=METADATA_COLUMNS)
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(dataset_path / "asap_annotations.json", "w") as f:
+        json.dump(annotations, f)
+
+    return len(rows)
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(description="Generate a synthetic ASAP dataset")
+
+    args.add_argument("path", type=str, help="Root directory of the dataset")
+
+    args.add_argument(
+        "--composers",
+        default=4,
+        type=int,
+        help="Number of composers (default: 4)",
+    )
+
+    args.add_argument(
+        "--pieces",
+        default=5,
+        type=int,
+        help="Number of pieces per composer (default: 5)",
+    )
+
+    args.add_argument(
+        "--performances",
+        default=3,
+        type=int,
+        help="Number of performances per piece (default: 3)",
+    )
+
+    args.add_argument(
+        "--measures",
+        default=32,
+        type=int,
+        help="Number of measures per piece (default: 32)",
+    )
+
+    args.add_argument(
+        "--seed",
+        default=0,
+        type=int,
+        help="Random seed (default: 0)",
+    )
+
+    args.add_argument(
+        "--workers",
+        default=None,
+        type=int,
+        help="Number of worker processes (default: number of CPUs)",
+    )
+
+    args = args.parse_args()
+
+    n_written = write_synthetic_asap(
+        args.path,
+        n_composers=args.composers,
+        n_pieces=args.pieces,
+        n_performances=args.performances,
+        n_measures=args.measures,
+        seed=args.seed,
+        max_workers=args.workers,
+    )
+    print(f"Wrote {n_written} performances to {args.path}")
@@ -0,0 +1,270 @@
+"""
+Tempo curves learned from the annotated ASAP performances of a piece.
+
+The annotated beats of every performance are converted to a tempo (in
+quarters per minute, using the tempo map of the score MIDI) per inter-beat
+interval, smoothed with a Savitzky-Golay filter (all performances at once),
+and aggregated into a mean and a standard deviation curve per beat. The
+spread of the raw tempos around the smoothed ones (the beat-to-beat jitter of
+the performers) is kept as well. add_tempo_changes samples its tempo curve
+from them instead of the hand-coded model when the piece is annotated.
+
+The curves are cached per piece in data/cache/tempo_curves, keyed by the
+score MIDI, the annotations file and the annotated performances. The batch
+job fills the cache for the whole corpus:
+
+    python -m src.tempo_curves                  # all annotated pieces
+    python -m src.tempo_curves -c Chopin Liszt  # only some composers
+"""
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+from pathlib import Path
+
+import numpy as np
+
+from src.alignment import get_performance_annotation
+from src.data import (
+    ANNOTATIONS_PATH,
+    BROKEN_ANNOTATIONS,
+    DATASET_PATH,
+    ROOT_PATH,
+    get_annotations,
+)
+from src.instrumentation import setup_logging
+from src.note_array import file_signature, get_quarter_positions
+
+logger = logging.getLogger(__name__)
+
+TEMPO_CURVES_CACHE_PATH = ROOT_PATH / "data" / "cache" / "tempo_curves"
+# Savitzky-Golay filter of the beat tempos: window (in beats) and order
+SMOOTHING_WINDOW = 9
+SMOOTHING_ORDER = 2
+
+
+def get_beat_tempos(score_quarters, beat_times):
+    """
+    Tempo of every inter-beat interval of the performances
+
+    Args:
+        score_quarters: score positions (in quarters) of the n_beats beats
+        beat_times: (n_performances, n_beats) array of performed beat times
+
+    Returns:
+        tempos: (n_performances, n_beats - 1) array [quarters per minute],
+                intervals which are not played forward (merged or unordered
+                beats) are interpolated from their neighbours
+    """
+    quarter_lengths = np.diff(score_quarters)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tempos = quarter_lengths * 60 / np.diff(beat_times, axis=1)
+    valid = np.isfinite(tempos) & (tempos > 0)
+    beats = np.arange(tempos.shape[1])
+    for row, row_valid in zip(tempos, valid):
+        if not row_valid.all() and row_valid.any():
+            row[~row_valid] = np.interp(
+                beats[~row_valid], beats[row_valid], row[row_valid]
+            )
+    return tempos
+
+
+def smooth_tempos(tempos, window=SMOOTHING_WINDOW, order=SMOOTHING_ORDER):
+    """Savitzky-Golay smoothing of (n_performances, n_intervals) tempos, per row"""
+    from scipy.signal import savgol_filter
+
+    n_intervals = tempos.shape[1]
+    # the window must be odd and fit in the curves
+    window = min(window, n_intervals - (1 - n_intervals % 2))
+    if window <= order:
+        return tempos.copy()
+    return savgol_filter(tempos, window, order, axis=1, mode="interp")
+
+
+def extract_tempo_curves(unperformed_midi_path, annotations):
+    """
+    Mean and spread of the smoothed tempo curves of annotated performances
+
+    Args:
+        unperformed_midi_path: str path to the score MIDI
+        annotations: list of ASAP annotations of the performances
+
+    Returns:
+        tempo_curves: dict with
+            quarters: score positions (in quarters) of the n_beats beats
+            means, stds: mean and standard deviation of the smoothed tempos
+                         of the n_beats - 1 intervals [quarters per minute]
+            jitters: root mean square of the raw tempos around the smoothed
+                     ones, per interval
+            n_performances: int
+        None if there is no usable annotation
+    """
+    import pretty_midi
+
+    annotations = [
+        annotation
+        for annotation in annotations
+        if len(annotation["midi_score_beats"]) >= 2
+        and len(annotation["midi_score_beats"]) == len(annotation["performance_beats"])
+    ]
+    if not annotations:
+        return None
+
+    # the beats of every performance, on the beats of the first one
+    score_beats = np.asarray(annotations[0]["midi_score_beats"], dtype=np.float64)
+    beat_times = np.array(
+        [
+            np.interp(
+                score_beats,
+                annotation["midi_score_beats"],
+                annotation["performance_beats"],
+            )
+            for annotation in annotations
+        ]
+    )
+    score_quarters = get_quarter_positions(
+        pretty_midi.PrettyMIDI(str(unperformed_midi_path)), score_beats
+    )
+
+    tempos = get_beat_tempos(score_quarters, beat_times)
+    smoothed = smooth_tempos(tempos)
+    return {
+        "quarters": score_quarters,
+        "means": smoothed.mean(axis=0),
+        "stds": smoothed.std(axis=0),
+        "jitters": np.sqrt(np.mean((tempos - smoothed) ** 2, axis=0)),
+        "n_performances": len(annotations),
+    }
+
+
+def get_tempo_curves(
+    unperformed_midi_path,
+    performed_midi_paths,
+    json_data=None,
+    cache_path=TEMPO_CURVES_CACHE_PATH,
+):
+    """
+    Cached version of extract_tempo_curves for the performances of a piece.
+    Performances without annotation are ignored.
+
+    Args:
+        unperformed_midi_path: str path to the score MIDI
+        performed_midi_paths: list of str paths to the performed MIDIs
+        json_data: dict with ASAP annotations (loaded if None)
+        cache_path: directory for cached curves (None to disable)
+
+    Returns:
+        tempo_curves: see extract_tempo_curves, None if no performance
+                      is annotated
+    """
+    if json_data is None:
+        json_data = get_annotations()
+    if json_data is None:
+        return None
+    keys = sorted(
+        Path(path).resolve().relative_to(DATASET_PATH.resolve()).as_posix()
+        for path in performed_midi_paths
+        if get_performance_annotation(path, json_data) is not None
+    )
+    keys = [key for key in keys if not any(path in key for path in BROKEN_ANNOTATIONS)]
+    if not keys:
+        return None
+
+    cache_file = None
+    if cache_path is not None:
+        key = "|".join(
+            [
+                file_signature(unperformed_midi_path),
+                file_signature(ANNOTATIONS_PATH),
+                str(keys),
+                str((SMOOTHING_WINDOW, SMOOTHING_ORDER)),
+            ]
+        )
+        cache_file = Path(cache_path) / (
+            hashlib.sha1(key.encode()).hexdigest() + ".pkl"
+        )
+        if cache_file.exists():
+            with open(cache_file, "rb") as f:
+                return pickle.load(f)
+
+    tempo_curves = extract_tempo_curves(
+        unperformed_midi_path, [json_data[key] for key in keys]
+    )
+    if cache_file is not None:
+        cache_file.parent.mkdir(exist_ok=True, parents=True)
+        # an interrupted run never leaves a partial file
+        tmp_file = cache_file.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp_file, "wb") as f:
+            pickle.dump(tempo_curves, f)
+        os.replace(tmp_file, cache_file)
+    return tempo_curves
+
+
+def build_tempo_curves(composers=None, cache_path=TEMPO_CURVES_CACHE_PATH):
+    """
+    Fill the cache with the tempo curves of every annotated piece
+
+    Args:
+        composers: list of composers to keep (None for all)
+        cache_path: directory for cached curves
+
+    Returns:
+        tempo_curves: dict mapping piece paths to their curves
+    """
+    json_data = get_annotations()
+    if json_data is None:
+        raise FileNotFoundError("The ASAP annotations are not available")
+    pieces = {}
+    for performance_path in sorted(json_data):
+        if composers is None or performance_path.split("/")[0] in composers:
+            piece = performance_path.rsplit("/", 1)[0]
+            pieces.setdefault(piece, []).append(str(DATASET_PATH / performance_path))
+
+    tempo_curves = {}
+    for piece, performed_midi_paths in pieces.items():
+        curves = get_tempo_curves(
+            DATASET_PATH / piece / "midi_score.mid",
+            performed_midi_paths,
+            json_data=json_data,
+            cache_path=cache_path,
+        )
+        if curves is None:
+            logger.warning("skipping %s, it has no usable annotation", piece)
+            continue
+        tempo_curves[piece] = curves
+        logger.debug(
+            "%s: %d beats, %d performances, mean tempo %.1f",
+            piece,
+            len(curves["quarters"]),
+            curves["n_performances"],
+            curves["means"].mean(),
+        )
+    logger.info(
+        "stored the tempo curves of %d pieces in %s", len(tempo_curves), cache_path
+    )
+    return tempo_curves
+
+
+if __name__ == "__main__":
+    args = argparse.ArgumentParser(
+        description="Extract the tempo curves of all annotated pieces"
+    )
+    args.add_argument(
+        "-c",
+        "--composer",
+        default=None,
+        nargs="+",
+        type=str,
+        help="Only extract the pieces of these composers (default: all)",
+    )
+    args.add_argument(
+        "--log_level",
+        default="INFO",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        type=str,
+        help="Logging level (default: INFO)",
+    )
+    args = args.parse_args()
+    setup_logging(args.log_level)
+    build_tempo_curves(composers=args.composer)
@@ -0,0 +1,231 @@
+"""
+Velocity profiles learned from the aligned performances of a piece.
+
+Every note of the score gets a voice (the top or bottom note sounding at its
+onset, or an inner note) and a metrical sub-position (the beat of the
+measure it is on and the subdivision of the beat, on a grid of SUBDIVISIONS).
+The velocities of the aligned performed notes, relative to the mean velocity
+of their measure in their performance, are averaged per voice and
+sub-position in one grouped aggregation over all performances. The result is
+a small (N_VOICES, MAX_BEATS * SUBDIVISIONS) lookup array of velocity
+offsets, e.g. the bell shape of the accompaniment motifs of Schubert's
+Impromptu, which apply_velocity_profile adds to all notes at once.
+"""
+import logging
+
+import numpy as np
+
+from src.alignment import get_alignment, get_performance_annotation
+from src.data import get_annotations, get_metrical_positions
+from src.note_array import load_notes, load_notes_parallel
+
+logger = logging.getLogger(__name__)
+
+# voices of the notes, see get_voices
+TOP_VOICE = 0
+INNER_VOICE = 1
+BASS_VOICE = 2
+N_VOICES = 3
+# subdivisions of a beat (duplets, triplets, quadruplets and sextuplets)
+SUBDIVISIONS = 12
+# beats of a measure with their own profile, the later ones share the last
+MAX_BEATS = 12
+# offsets learned from fewer notes are set to 0
+MIN_PROFILE_NOTES = 8
+# notes starting at most that close [s] are simultaneous
+ONSET_TOLERANCE = 1e-6
+# times are below this bound [s], see get_voices
+PITCH_OFFSET = 1e6
+
+
+def get_voices(notes):
+    """
+    Voice of every note: TOP_VOICE if no sounding note is higher at its
+    onset, BASS_VOICE if no sounding note is lower (and some are higher),
+    INNER_VOICE otherwise
+
+    Args:
+        notes: note array
+
+    Returns:
+        voices: int8 array
+    """
+    starts = notes["start"]
+    pitches = notes["pitch"].astype(np.int64)
+    voices = np.full(len(notes), INNER_VOICE, dtype=np.int8)
+    if len(notes) == 0:
+        return voices
+    onsets = np.unique(starts)
+
+    # number of notes of every pitch sounding at every onset: notes started
+    # minus notes ended, counted with one search per pitch of the piece
+    # (queries are sorted by pitch, then onset)
+    all_pitches = np.arange(pitches.min(), pitches.max() + 1)
+    queries = all_pitches[:, None] * PITCH_OFFSET + onsets + ONSET_TOLERANCE
+    started = np.searchsorted(np.sort(pitches * PITCH_OFFSET + starts), queries)
+    ended = np.searchsorted(np.sort(pitches * PITCH_OFFSET + notes["end"]), queries)
+    sounding = started > ended
+
+    top = np.where(sounding, all_pitches[:, None], -1).max(axis=0)
+    bottom = np.where(sounding, all_pitches[:, None], 128).min(axis=0)
+    onset_index = np.searchsorted(onsets, starts)
+    voices[(pitches == bottom[onset_index]) & (pitches < top[onset_index])] = BASS_VOICE
+    voices[pitches >= top[onset_index]] = TOP_VOICE
+    return voices
+
+
+def get_metrical_subpositions(onsets, beats, downbeats):
+    """
+    Metrical sub-position of onsets: beat of the measure * SUBDIVISIONS +
+    closest subdivision of the beat
+
+    Args:
+        onsets: array of times
+        beats, downbeats: beat and downbeat times, see get_metrical_positions
+
+    Returns:
+        subpositions: int array in 0..MAX_BEATS * SUBDIVISIONS - 1
+    """
+    beats = np.asarray(beats, dtype=np.float64)
+    if len(beats) < 2:
+        return np.zeros(len(onsets), dtype=np.int64)
+    positions = get_metrical_positions(beats, downbeats).astype(np.int64)
+    beat = np.searchsorted(beats, onsets, side="right") - 1
+    beat = np.clip(beat, 0, len(beats) - 2)
+    fractions = (onsets - beats[beat]) / np.diff(beats)[beat]
+    subdivisions = np.rint(fractions * SUBDIVISIONS).astype(np.int64)
+    # onsets closer to the next beat are on it
+    beat = np.clip(beat + subdivisions // SUBDIVISIONS, 0, len(beats) - 1)
+    subdivisions %= SUBDIVISIONS
+    return np.minimum(positions[beat], MAX_BEATS - 1) * SUBDIVISIONS + subdivisions
+
+
+def learn_velocity_profile(
+    score_notes, performed_notes_list, matches_list, score_beats, score_downbeats
+):
+    """
+    Mean velocity offset of the aligned performed notes per voice and
+    metrical sub-position of their score note
+
+    Args:
+        score_notes: note array of the score MIDI
+        performed_notes_list: list of note arrays of the performances
+        matches_list: list of (k, 2) aligned note indices, see align_notes
+        score_beats, score_downbeats: beat and downbeat times in the score MIDI
+
+    Returns:
+        profile: (N_VOICES, MAX_BEATS * SUBDIVISIONS) float array of
+                 velocity offsets, centered on every voice
+    """
+    n_positions = MAX_BEATS * SUBDIVISIONS
+    size = N_VOICES * n_positions
+    if len(score_notes) == 0 or not matches_list:
+        return np.zeros((N_VOICES, n_positions))
+    score_groups = get_voices(score_notes).astype(np.int64) * n_positions
+    score_groups += get_metrical_subpositions(
+        score_notes["start"], score_beats, score_downbeats
+    )
+    measures = np.searchsorted(score_downbeats, score_notes["start"], side="right")
+    n_measures = len(score_downbeats) + 1
+
+    # matched notes of all performances at once
+    score_index = np.concatenate([matches[:, 0] for matches in matches_list])
+    velocities = np.concatenate(
+        [
+            notes["velocity"][matches[:, 1]]
+            for notes, matches in zip(performed_notes_list, matches_list)
+        ]
+    ).astype(np.float64)
+    performances = np.repeat(
+        np.arange(len(matches_list)), [len(matches) for matches in matches_list]
+    )
+
+    # velocities relative to the mean of their measure in their performance
+    measure_groups = performances * n_measures + measures[score_index]
+    n_groups = len(matches_list) * n_measures
+    counts = np.bincount(measure_groups, minlength=n_groups)
+    sums = np.bincount(measure_groups, weights=velocities, minlength=n_groups)
+    offsets = velocities - sums[measure_groups] / counts[measure_groups]
+
+    groups = score_groups[score_index]
+    counts = np.bincount(groups, minlength=size).reshape(N_VOICES, n_positions)
+    sums = np.bincount(groups, weights=offsets, minlength=size)
+    sums = sums.reshape(N_VOICES, n_positions)
+    known = counts >= MIN_PROFILE_NOTES
+    counts, sums = np.where(known, counts, 0), np.where(known, sums, 0.0)
+    # the profile shapes the voices, the balance between them is the one
+    # of the voice highlighting, see get_voice_highlighting
+    means = sums.sum(axis=1) / np.maximum(counts.sum(axis=1), 1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        profile = np.where(known, sums / counts - means[:, None], 0.0)
+    return profile
+
+
+def get_velocity_profile(unperformed_midi_path, performed_midi_paths, json_data=None):
+    """
+    Velocity profile of a piece, learned from all its performances
+
+    Args:
+        unperformed_midi_path: str path to the score MIDI
+        performed_midi_paths: list of str paths to the performed MIDIs
+        json_data: dict with ASAP annotations (loaded if None)
+
+    Returns:
+        profile: see learn_velocity_profile
+    """
+    score_notes = load_notes(unperformed_midi_path)
+    performed_notes_list = load_notes_parallel(performed_midi_paths)
+    if json_data is None:
+        json_data = get_annotations()
+    annotations = [
+        get_performance_annotation(path, json_data) for path in performed_midi_paths
+    ]
+    # alignments are cached per file pair, see idea_13_stats
+    matches_list = [
+        get_alignment(
+            unperformed_midi_path, path, score_notes, notes, annotation=annotation
+        )
+        for path, notes, annotation in zip(
+            performed_midi_paths, performed_notes_list, annotations
+        )
+    ]
+
+    annotated = [a for a in annotations if a is not None]
+    if annotated:
+        score_beats = annotated[0]["midi_score_beats"]
+        score_downbeats = annotated[0]["midi_score_downbeats"]
+    else:
+        import pretty_midi
+
+        logger.info("no beat annotations, using the beats of the score MIDI")
+        midi_data = pretty_midi.PrettyMIDI(str(unperformed_midi_path))
+        score_beats = midi_data.get_beats()
+        score_downbeats = midi_data.get_downbeats()
+    return learn_velocity_profile(
+        score_notes,
+        performed_notes_list,
+        matches_list,
+        np.asarray(score_beats, dtype=np.float64),
+        np.asarray(score_downbeats, dtype=np.float64),
+    )
+
+
+def apply_velocity_profile(notes, profile, beats, downbeats, amplitude=1.0):
+    """
+    Velocities of a note array with the offsets of a velocity profile
+
+    Args:
+        notes: note array
+        profile: (N_VOICES, MAX_BEATS * SUBDIVISIONS) array, see
+                 learn_velocity_profile
+        beats, downbeats: beat and downbeat times of the notes
+        amplitude: factor of the offsets
+
+    Returns:
+        velocities: np.ndarray of int velocities in 1..127
+    """
+    voices = get_voices(notes)
+    subpositions = get_metrical_subpositions(notes["start"], beats, downbeats)
+    velocities = notes["velocity"] + amplitude * profile[voices, subpositions]
+    # velocity 0 would be a note off
+    return np.clip(np.rint(velocities), 1, 127)
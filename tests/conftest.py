@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from src.data import ANNOTATIONS_PATH
+from src.interpret import INTERPRET_PASSES
+from src.pipeline import Pipeline
+from src.synthetic import write_synthetic_piece
+
+# arguments of interpret(), shared by the streaming and editing tests
+PARAMS = {
+    "seed": 0,
+    "pedal_mode": "onset",
+    "rescaling_factor": 10,
+    "onset_percentage": 1,
+    "duration_percentage": 5,
+    "transition_window": 4.0,
+    "profile_amplitude": 1.0,
+}
+
+
+@pytest.fixture(scope="session")
+def piece_paths(tmp_path_factory):
+    """Paths of a small synthetic piece (outside the dataset, so not annotated)"""
+    dataset_path = tmp_path_factory.mktemp("dataset")
+    write_synthetic_piece(dataset_path, "Composer00", "Piece000", 2, 8, [0, 0, 0])
+    piece_path = dataset_path / "Composer00" / "Piece000"
+    performed_midi_paths = sorted(
+        str(path) for path in piece_path.glob("*.mid") if path.name != "midi_score.mid"
+    )
+    return (
+        str(piece_path / "midi_score.mid"),
+        str(piece_path / "xml_score.musicxml"),
+        performed_midi_paths,
+    )
+
+
+@pytest.fixture(scope="session")
+def cache_path(tmp_path_factory):
+    return tmp_path_factory.mktemp("cache")
+
+
+def run_interpret(piece_paths, cache_path, outputs, **params):
+    """Outputs of the interpret() pipeline, with PARAMS overridden by params"""
+    unperformed_midi_path, xml_path, performed_midi_paths = piece_paths
+    return Pipeline(INTERPRET_PASSES, cache_path=cache_path).run(
+        sources={
+            "unperformed_midi_path": unperformed_midi_path,
+            "xml_path": xml_path,
+            "performed_midi_paths": performed_midi_paths,
+            "annotations_path": ANNOTATIONS_PATH,
+        },
+        params={**PARAMS, **params},
+        outputs=outputs,
+    )
+
+
+def sort_notes(notes):
+    return notes[
+        np.lexsort((notes["velocity"], notes["end"], notes["pitch"], notes["start"]))
+    ]
@@ -0,0 +1,50 @@
+import copy
+
+import numpy as np
+import pytest
+
+from src.editing import get_editable_performance
+from src.note_array import notes_from_pretty_midi
+from tests.conftest import PARAMS, run_interpret, sort_notes
+
+
+@pytest.fixture(scope="module")
+def performance(piece_paths, cache_path):
+    return get_editable_performance(*piece_paths, **PARAMS, cache_path=cache_path)
+
+
+def test_editable_performance_matches_interpret(piece_paths, cache_path, performance):
+    expected = run_interpret(piece_paths, cache_path, ["midi_data", "pedal_midi_data"])
+    for pedal, output in [(True, "pedal_midi_data"), (False, "midi_data")]:
+        np.testing.assert_array_equal(
+            sort_notes(notes_from_pretty_midi(performance.to_pretty_midi(pedal=pedal))),
+            sort_notes(notes_from_pretty_midi(expected[output])),
+        )
+
+
+@pytest.mark.parametrize("edit", ["tempo", "dynamic", "both", "slots"])
+def test_update_matches_recompute(performance, edit):
+    edited = copy.deepcopy(performance)
+    measure = len(edited.measure_quarters) // 3
+    if edit in ("tempo", "both"):
+        edited.scale_tempo(measure, measure + 1, 0.7)
+    if edit in ("dynamic", "both"):
+        edited.set_dynamic(float(edited.measure_quarters[measure]), 90)
+    if edit == "slots":
+        edited.set_tempos(9, [60.0])
+    recomputed = copy.deepcopy(edited)
+
+    edited.update()
+    recomputed.recompute()
+
+    notes, expected = edited.get_notes(), recomputed.get_notes()
+    assert len(notes) == len(expected)
+    for field in ["start", "end"]:
+        np.testing.assert_allclose(notes[field], expected[field], atol=1e-9)
+    for field in ["pitch", "velocity", "instrument"]:
+        np.testing.assert_array_equal(notes[field], expected[field])
+    assert len(edited.pedal_changes) == len(recomputed.pedal_changes)
+    np.testing.assert_allclose(
+        edited.pedal_changes, recomputed.pedal_changes, atol=1e-9
+    )
+    assert not np.array_equal(notes, performance.get_notes())
@@ -0,0 +1,98 @@
+import io
+
+import music21
+import numpy as np
+import pretty_midi
+import pytest
+
+from src.interpret import (
+    CompactPrettyMIDI,
+    get_dynamics_timeline,
+    idea_12,
+    overwrite_velocities,
+)
+
+
+def make_score(n_measures=4):
+    """Quarter notes at ppp, with a diminuendo over each of the first two measures"""
+    part = music21.stream.Part()
+    notes = []
+    for number in range(1, n_measures + 1):
+        measure = music21.stream.Measure(number=number)
+        if number == 1:
+            measure.insert(0, music21.dynamics.Dynamic("ppp"))
+        for pitch in range(60, 64):
+            note = music21.note.Note(pitch)
+            measure.append(note)
+            notes.append(note)
+        part.append(measure)
+    part.insert(0, music21.dynamics.Diminuendo(notes[0], notes[3]))
+    part.insert(0, music21.dynamics.Diminuendo(notes[4], notes[7]))
+    score = music21.stream.Score()
+    score.insert(0, part)
+    return score
+
+
+def test_dynamics_timeline_stays_above_zero():
+    score = make_score()
+    offsets, velocities, ramps = get_dynamics_timeline(score, score.parts[0])
+    np.testing.assert_array_equal(offsets, [0, 4, 8])
+    assert velocities.min() >= 1
+    np.testing.assert_array_equal(ramps[1:], [4, 4])
+
+
+@pytest.mark.filterwarnings("error::RuntimeWarning")
+def test_overwrite_velocities_after_ppp_and_diminuendos():
+    score = make_score()
+    overwrite_velocities(score)
+    velocities = [note.volume.velocity for note in score.flatten().notes]
+    assert all(1 <= velocity <= 127 for velocity in velocities)
+    # the wedges ramp down along their span
+    assert velocities[:9] == sorted(velocities[:9], reverse=True)
+
+
+@pytest.mark.filterwarnings("error::RuntimeWarning")
+def test_idea_12_zero_base_velocity():
+    score = make_score()
+    notes = list(score.flatten().notes)
+    for note in notes:
+        note.volume.velocity = 0
+    timeline = (np.array([0.0, 8.0]), np.array([0.0, 30.0]), np.full(2, np.nan))
+    idea_12(score, timeline)
+    assert [note.volume.velocity for note in notes[:4]] == [0] * 4
+
+
+def make_midi_bytes():
+    """Notes long after the last tempo change, at a music21-like resolution"""
+    midi_data = pretty_midi.PrettyMIDI(resolution=10080, initial_tempo=100)
+    instrument = pretty_midi.Instrument(0)
+    for k in range(20):
+        instrument.notes.append(pretty_midi.Note(64, 60 + k, 3.0 * k, 3.0 * k + 1))
+    midi_data.instruments.append(instrument)
+    buffer = io.BytesIO()
+    midi_data.write(buffer)
+    return buffer.getvalue()
+
+
+def test_compact_pretty_midi_matches_pretty_midi():
+    data = make_midi_bytes()
+    compact = CompactPrettyMIDI(io.BytesIO(data))
+    reference = pretty_midi.PrettyMIDI(io.BytesIO(data))
+    assert isinstance(compact._PrettyMIDI__tick_to_time, np.ndarray)
+
+    # repeated calls past the table, in any order
+    for tick in [0, 5, 10**6, 10**6 + 1, 3 * 10**6, 10**6]:
+        assert compact.tick_to_time(tick) == pytest.approx(reference.tick_to_time(tick))
+    for time in [0.0, 1.5, 30.0, 59.0]:
+        assert compact.time_to_tick(time) == reference.time_to_tick(time)
+
+    original_times, new_times = [0.0, 30.0, 60.0], [0.0, 40.0, 70.0]
+    compact.adjust_times(original_times, new_times)
+    reference.adjust_times(original_times, new_times)
+    assert isinstance(compact._PrettyMIDI__tick_to_time, np.ndarray)
+    for time in [0.0, 1.5, 45.0, 69.0]:
+        assert compact.time_to_tick(time) == reference.time_to_tick(time)
+    np.testing.assert_allclose(
+        [note.start for note in compact.instruments[0].notes],
+        [note.start for note in reference.instruments[0].notes],
+    )
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+
+from src.note_array import notes_from_pretty_midi
+from src.streaming import events_to_pretty_midi, stream_performance
+from tests.conftest import PARAMS, run_interpret, sort_notes
+
+
+def get_pedal_changes(midi_data):
+    return [(cc.time, cc.value) for cc in midi_data.instruments[0].control_changes]
+
+
+@pytest.mark.parametrize(
+    "seed, pedal_mode", [(0, "onset"), (1, "bass"), (7, "harmony")]
+)
+def test_stream_performance_matches_interpret(
+    piece_paths, cache_path, seed, pedal_mode
+):
+    expected = run_interpret(
+        piece_paths,
+        cache_path,
+        ["pedal_midi_data"],
+        seed=seed,
+        pedal_mode=pedal_mode,
+    )["pedal_midi_data"]
+
+    params = {**PARAMS, "seed": seed, "pedal_mode": pedal_mode}
+    chunks = [
+        events
+        for _, events in stream_performance(
+            *piece_paths, **params, cache_path=cache_path
+        )
+    ]
+    events = np.concatenate(chunks)
+    assert len(chunks) > 1
+    assert np.all(np.diff(events["time"]) >= 0)
+
+    streamed = events_to_pretty_midi(events)
+    np.testing.assert_array_equal(
+        sort_notes(notes_from_pretty_midi(streamed)),
+        sort_notes(notes_from_pretty_midi(expected)),
+    )
+    assert get_pedal_changes(streamed) == get_pedal_changes(expected)